@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class CitysuggesterConfig(AppConfig):
     name = 'citysuggester'
     default_auto_field = 'django.db.models.AutoField'
+
+    def ready(self):
+        from . import utils
+        from .models import TravelSystem
+
+        # Keep every process's systems up to date
+        post_save.connect(utils.bump_corpus_version_on_commit, sender=TravelSystem)
+        post_delete.connect(utils.bump_corpus_version_on_commit, sender=TravelSystem)
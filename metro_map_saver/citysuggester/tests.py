@@ -1,6 +1,133 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from citysuggester.models import TravelSystem
+from citysuggester.utils import (
+    build_station_index,
+    bump_corpus_version,
+    get_corpus,
+    get_station_count,
+    load_systems,
+    suggest_city,
+    CORPUS_VERSION_KEY,
+)
+from map_saver.templatetags.admin_gallery_tags import stations_in_travelsystem
+
+from django.core.cache import cache
 from django.test import TestCase
 
-# Create your tests here.
+from unittest import mock
+
+
+class SuggestCityTest(TestCase):
+
+    def setUp(self):
+        bump_corpus_version()
+        TravelSystem.objects.create(name='Phonetic', stations='\n'.join(['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot']))
+        TravelSystem.objects.create(name='Greek', stations='\n'.join(['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta']))
+
+    def test_suggest_city(self):
+
+        """ Confirm that systems are suggested by how many stations they have in common,
+                and only with more than station_overlap in common
+        """
+
+        map_stations = {'alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'gamma', 'zeta'}
+        self.assertEqual([('Phonetic (6)', 6)], suggest_city(map_stations))
+        self.assertEqual([('Phonetic (6)', 6), ('Greek (7)', 4)], suggest_city(map_stations, station_overlap=3))
+        self.assertEqual(
+            suggest_city(map_stations, station_overlap=3),
+            suggest_city(map_stations, station_overlap=3, systems=load_systems()),
+        )
+        self.assertEqual([], suggest_city({'omega'}, station_overlap=0))
+
+        # Stations named more than once only count once
+        self.assertEqual([('Greek (7)', 1)], suggest_city(['beta', 'beta', 'beta'], station_overlap=0))
+
+        # Systems passed in are only indexed once
+        systems = dict(load_systems())
+        with mock.patch('citysuggester.utils.build_station_index', wraps=build_station_index) as build:
+            for _ in range(3):
+                suggest_city(map_stations, systems=systems)
+        self.assertEqual(1, build.call_count)
+
+    def test_station_index(self):
+
+        """ Confirm that the station index is only built once,
+                until a TravelSystem changes
+        """
+
+        map_stations = {'alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta'}
+        self.assertEqual([('Greek (7)', 6)], suggest_city(map_stations))
+        with self.assertNumQueries(0):
+            suggest_city(map_stations)
+
+        # (once the change is committed; see test_corpus_version_on_commit)
+        with self.captureOnCommitCallbacks(execute=True):
+            TravelSystem.objects.get(name='Greek').delete()
+        self.assertEqual([], suggest_city(map_stations))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            TravelSystem.objects.create(name='Greek', stations='\n'.join(sorted(map_stations)))
+        self.assertEqual([('Greek (6)', 6)], suggest_city(map_stations))
+
+    def test_corpus_version(self):
+
+        """ Confirm that the systems are only read again once the version changes,
+                even if it was changed by another process
+        """
+
+        corpus = get_corpus()
+        self.assertEqual({'Phonetic': 6, 'Greek': 7}, corpus.station_counts)
+        with self.assertNumQueries(0):
+            self.assertIs(corpus, get_corpus())
+            self.assertIs(corpus.systems, load_systems())
+
+        # Changed without sending the signals, as another process's change would look here
+        TravelSystem.objects.filter(name='Phonetic').update(stations='alpha\nbravo')
+        self.assertIs(corpus, get_corpus())
+
+        cache.set(CORPUS_VERSION_KEY, 'changed elsewhere')
+        self.assertEqual({'Phonetic': 2, 'Greek': 7}, get_corpus().station_counts)
+
+        # Evicted from the cache
+        cache.delete(CORPUS_VERSION_KEY)
+        self.assertIsNot(corpus, get_corpus())
+
+    def test_corpus_version_on_commit(self):
+
+        """ Confirm that saving or deleting a system only changes the version
+                once the change is committed
+        """
+
+        corpus = get_corpus()
+        version = cache.get(CORPUS_VERSION_KEY)
+
+        for change in (
+            lambda: TravelSystem.objects.create(name='Nato', stations='alfa\nbravo'),
+            lambda: TravelSystem.objects.get(name='Nato').delete(),
+        ):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                change()
+                self.assertEqual(version, cache.get(CORPUS_VERSION_KEY))
+                self.assertIs(corpus, get_corpus())
+            self.assertEqual(1, len(callbacks))
+            self.assertNotEqual(version, cache.get(CORPUS_VERSION_KEY))
+            version = cache.get(CORPUS_VERSION_KEY)
+            self.assertIsNot(corpus, get_corpus())
+            corpus = get_corpus()
+
+        self.assertNotIn('Nato', corpus.station_counts)
+
+    def test_stations_in_travelsystem(self):
+
+        """ Confirm that the admin gallery gets station counts without a query per map
+        """
+
+        TravelSystem.objects.create(name='Phonetic (NATO), International', stations='alpha\nbravo')
+        get_corpus()
+        with self.assertNumQueries(0):
+            self.assertEqual(6, stations_in_travelsystem('Phonetic'))
+            self.assertEqual(2, stations_in_travelsystem('Phonetic (NATO)'))
+            self.assertEqual(7, get_station_count('Gr'))
+            self.assertEqual('', get_station_count('Latin'))
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.core.cache import cache
+from django.db import transaction
+
+import collections
 import csv
+import uuid
 
 from .models import TravelSystem
 
@@ -9,9 +14,35 @@ from .models import TravelSystem
 # Only 1 station in common is probably not very useful
 MINIMUM_STATION_OVERLAP = 5
 
-def load_systems():
+# Changed whenever a TravelSystem is saved or deleted;
+#   kept in the cache so every process sees the change
+CORPUS_VERSION_KEY = 'citysuggester:corpus_version'
+
+# All known systems, loaded once per process (see get_corpus)
+_corpus = None
+
+# The last systems passed to suggest_city, and their station index,
+#   so passing the same systems again doesn't build it again
+_passed_systems = (None, None)
+
+
+class SystemCorpus:
+
+    """ All known systems, as of one version:
+        each system's stations and station count,
+        and the station index (see build_station_index)
+    """
+
+    def __init__(self, systems, version):
+        self.systems = systems
+        self.version = version
+        self.index, self.names = build_station_index(systems)
+        self.station_counts = dict(self.names)
+
+
+def _read_systems():
 
-    """ Loads all known systems into a dictionary for processing
+    """ Reads all known systems from the database into a dictionary
     """
 
     systems = {}
@@ -24,23 +55,140 @@ def load_systems():
     return systems
 
 
+def load_systems():
+
+    """ Returns all known systems as a dictionary for processing,
+        of each system's name to its set of stations
+
+        These are shared by the whole process; don't change them
+    """
+
+    return get_corpus().systems
+
+
+def build_station_index(systems):
+
+    """ Given systems (as returned by load_systems),
+        returns an inverted index of each station name
+        to the positions of the systems it's in,
+        and the (name, station count) of each system by position
+    """
+
+    index = {}
+    names = []
+
+    for position, (name, system_stations) in enumerate(systems.items()):
+        names.append((name, len(system_stations)))
+        for station in system_stations:
+            index.setdefault(station, []).append(position)
+
+    return index, names
+
+
+def get_corpus_version():
+
+    """ Returns the current version stamp of the TravelSystems
+    """
+
+    version = cache.get(CORPUS_VERSION_KEY)
+    if version is None:
+        # Never set, or evicted: start a new version,
+        #   since there's no telling what's changed since
+        cache.add(CORPUS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CORPUS_VERSION_KEY)
+    return version
+
+
+def get_corpus():
+
+    """ Returns all known systems (as a SystemCorpus),
+        only reading them from the database again if a TravelSystem
+        has changed (in any process) since they were last read
+    """
+
+    global _corpus
+
+    version = get_corpus_version()
+    if _corpus is None or _corpus.version != version:
+        _corpus = SystemCorpus(_read_systems(), version)
+
+    return _corpus
+
+
+def bump_corpus_version():
+
+    """ Give the systems a new version, so every process reads them again
+    """
+
+    global _corpus
+    cache.set(CORPUS_VERSION_KEY, uuid.uuid4().hex, None)
+    _corpus = None
+
+
+def bump_corpus_version_on_commit(**kwargs):
+
+    """ Called whenever a TravelSystem is saved or deleted (see CitysuggesterConfig.ready);
+        bumped any sooner than the commit, another process could read the systems
+        from before the change and keep them under the new version
+    """
+
+    transaction.on_commit(bump_corpus_version)
+
+
+def get_station_count(name):
+
+    """ Returns how many stations there are in the system with this name,
+        or if there isn't one, the first system whose name starts with it
+        (suggested cities leave off anything in parentheses)
+    """
+
+    station_counts = get_corpus().station_counts
+    if name in station_counts:
+        return station_counts[name]
+
+    for system_name, station_count in station_counts.items():
+        if system_name.startswith(name):
+            return station_count
+
+    return ''
+
+
 def suggest_city(map_stations, station_overlap=MINIMUM_STATION_OVERLAP, systems=None):
 
     """ Given a set of stations from a map,
         suggest a city it might be located in
         based on known stations in known metro systems
-    """
 
-    possible_cities = {}
+        Only looks up the map's own stations (in the station index),
+        so it takes as long as the map is big, not as long as all systems are
 
-    if not systems:
-        systems = load_systems()
+        systems, if given, are indexed once and reused for as long as
+        the same systems are passed in; don't change them in between
+    """
 
-    for name, system_stations in systems.items():
-        common_stations = system_stations.intersection(map_stations)
-        if len(common_stations) > station_overlap:
-            possible_cities['{0} ({1})'.format(name, len(system_stations))] = len(common_stations) # Or maybe: the set itself, rather than the length
-    return sorted(possible_cities.items(), key=lambda kv: kv[1], reverse=True)
+    global _passed_systems
+
+    if systems:
+        if _passed_systems[0] is not systems:
+            _passed_systems = (systems, build_station_index(systems))
+        index, names = _passed_systems[1]
+    else:
+        corpus = get_corpus()
+        index, names = corpus.index, corpus.names
+
+    common_stations = collections.Counter()
+    for station in set(map_stations):
+        common_stations.update(index.get(station, ()))
+
+    # Most stations in common first; ties in the order the systems were loaded
+    possible_cities = sorted(
+        (position for position, count in common_stations.items() if count > station_overlap),
+        key=lambda position: (-common_stations[position], position),
+    )
+    return [
+        ('{0} ({1})'.format(*names[position]), common_stations[position])
+        for position in possible_cities
+    ]
 
 
 def create_systems_from_csv(csv_file):
@@ -0,0 +1,45 @@
+from django.utils.text import compress_string
+
+import re
+
+# Brotli is optional; without it, only gzip is offered
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACCEPTS_ENCODING = {
+    'br': re.compile(r'\bbr\b'),
+    'gzip': re.compile(r'\bgzip\b'),
+}
+
+
+def get_content_encodings():
+
+    """ The encodings responses can be compressed with, most preferred first
+    """
+
+    if brotli:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def get_accepted_encoding(request):
+
+    """ The most preferred encoding that the request accepts,
+            or None if it doesn't accept any of them
+    """
+
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    for encoding in get_content_encodings():
+        if ACCEPTS_ENCODING[encoding].search(accept_encoding):
+            return encoding
+    return None
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content)
+    elif encoding == 'gzip':
+        return compress_string(content)
+    raise ValueError(f'Unsupported encoding: {encoding}')
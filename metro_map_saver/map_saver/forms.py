@@ -1,7 +1,12 @@
 from django import forms
+from django.conf import settings
 
 from .models import SavedMap, IdentifyMap, MAP_TYPE_CHOICES
 from .validator import (
+    check_map_data_budget,
+    check_map_data_size,
+    get_data_hash,
+    get_legacy_urlhash,
     hex64,
     validate_metro_map,
     validate_metro_map_v2,
@@ -18,11 +23,26 @@ RATING_CHOICES = (
     ('dislikes', 'dislikes'),
 )
 
+class MapDataField(forms.JSONField):
+
+    """ A JSONField that won't parse map data that's too big or too deeply nested
+    """
+
+    def to_python(self, value):
+        if isinstance(value, (str, bytes)):
+            check_map_data_size(value)
+        try:
+            return super().to_python(value)
+        except RecursionError:
+            # The parser gives up on data nested too deeply as soon as it finds it
+            raise forms.ValidationError("[VALIDATIONFAILED] B-02 TOO DEEP: This map is not in a format that can be saved.")
+
 class CreateMapForm(forms.Form):
-    mapdata = forms.JSONField()
+    mapdata = MapDataField()
 
     def clean_mapdata(self):
         mapdata = self.cleaned_data['mapdata']
+        check_map_data_budget(mapdata)
 
         data_version = mapdata.get('global', {}).get('data_version', 1)
         if data_version == 3:
@@ -33,8 +53,12 @@ class CreateMapForm(forms.Form):
             mapdata['global']['data_version'] = 2
         else:
             try:
-                mapdata = validate_metro_map(mapdata)
-                mapdata['global']['data_version'] = 1
+                if settings.CONVERT_V1_MAPS_ON_SAVE:
+                    # Saved as v3, so they never need to be converted later
+                    mapdata = validate_metro_map(mapdata, as_v3=True)
+                else:
+                    mapdata = validate_metro_map(mapdata)
+                    mapdata['global']['data_version'] = 1
             except AssertionError as exc:
                 raise forms.ValidationError(exc)
 
@@ -43,7 +67,11 @@ class CreateMapForm(forms.Form):
     def clean(self):
         data = self.cleaned_data
         if data.get('mapdata'):
-            data['urlhash'] = hex64(hashlib.sha256(str(data['mapdata']).encode('utf-8')).hexdigest()[:12])
+            # Hashed as canonical JSON, so the same map always gets the same urlhash
+            data['data_hash'] = get_data_hash(data['mapdata'])
+            data['urlhash'] = hex64(data['data_hash'][:12])
+            # Maps saved before .data_hash was added may still have their old urlhash
+            data['legacy_urlhash'] = get_legacy_urlhash(data['mapdata'])
             data['naming_token'] = hashlib.sha256('{0}'.format(random.randint(1, 100000)).encode('utf-8')).hexdigest()
             data['data_version'] = data['mapdata']['global']['data_version'] # convenience
         return data
@@ -0,0 +1,172 @@
+""" Importing many maps at once, from newline-delimited JSON (one map per line),
+        for migrations and imports (see the import_maps command, and MapImportView's MapJob).
+
+    Each map is validated exactly as /save/ would validate it (with CreateMapForm),
+        spread across worker processes if there are several;
+        maps that were already saved (or appear earlier in the same import) are skipped,
+        and the rest are inserted in batches with bulk_create.
+"""
+
+from django.db import IntegrityError, transaction
+
+from .forms import CreateMapForm
+from .models import MapJob, SavedMap
+from .workers import get_worker_pool
+
+import itertools
+
+# How many lines each worker validates at a time
+POOL_CHUNKSIZE = 64
+
+
+def prepare_map(line):
+
+    """ Validates one line of an import.
+
+        Returns the fields to create the SavedMap with (or None),
+            plus its legacy_urlhash (see SavedMap.get_legacy_urlhashes),
+            and the error (or None)
+    """
+
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+
+    form = CreateMapForm({'mapdata': line})
+    if form.is_valid():
+        map_details = SavedMap.get_map_details(form.cleaned_data)
+        map_details['legacy_urlhash'] = form.cleaned_data['legacy_urlhash']
+        return map_details, None
+    return None, ' '.join(form.errors.get('mapdata', ['Invalid map']))
+
+
+class MapImport:
+
+    """ Imports maps, one line of newline-delimited JSON at a time;
+            see import_lines
+    """
+
+    def __init__(self, workers=1, batch_size=500):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.created = 0
+        self.duplicates = 0
+        # (line number, error)
+        self.errors = []
+
+    def import_lines(self, lines):
+
+        """ Import every map in lines (an iterable of strings or bytes),
+                skipping blank lines
+        """
+
+        # Numbered before blank lines are skipped, so errors point to the right line
+        lines = (
+            (line_number, line)
+            for line_number, line in enumerate(lines, start=1)
+            if line.strip()
+        )
+
+        if self.workers > 1:
+            with get_worker_pool(self.workers) as pool:
+                self.save_prepared(self.prepare_in_pool(pool, lines))
+        else:
+            self.save_prepared((line_number, prepare_map(line)) for line_number, line in lines)
+
+        return self
+
+    def prepare_in_pool(self, pool, lines):
+
+        """ Validate (numbered) lines across the pool's workers,
+                only reading as many lines at a time as will keep them all busy,
+                so a large import is never all in memory at once
+        """
+
+        while True:
+            chunk = list(itertools.islice(lines, self.workers * POOL_CHUNKSIZE))
+            if not chunk:
+                break
+            line_numbers, chunk = zip(*chunk)
+            yield from zip(line_numbers, pool.map(prepare_map, chunk, chunksize=POOL_CHUNKSIZE))
+
+    def save_prepared(self, prepared):
+        batch = {}
+        for line_number, (map_details, error) in prepared:
+            if error:
+                self.errors.append((line_number, error))
+                continue
+
+            if map_details['urlhash'] in batch:
+                self.duplicates += 1
+                continue
+
+            batch[map_details['urlhash']] = map_details
+            if len(batch) >= self.batch_size:
+                self.save_batch(batch)
+                batch = {}
+
+        if batch:
+            self.save_batch(batch)
+
+    def save_batch(self, batch):
+
+        """ Insert a batch of maps (by urlhash) that aren't already saved,
+                then write their data files and queue up their jobs,
+                just as /save/ would
+        """
+
+        existing = set(SavedMap.objects.filter(urlhash__in=batch).values_list('urlhash', flat=True))
+        legacy = SavedMap.get_legacy_urlhashes([map_details['legacy_urlhash'] for map_details in batch.values()])
+        new_maps = {}
+        for urlhash, map_details in batch.items():
+            legacy_urlhash = map_details.pop('legacy_urlhash')
+            if urlhash not in existing and legacy_urlhash not in legacy:
+                new_maps[map_details['data_hash']] = SavedMap(**map_details)
+        self.duplicates += len(batch) - len(new_maps)
+
+        # Usually none have been saved since existing was checked, and they all go in at once;
+        #   but if any were (the unique data_hash catches them), the rest go in one at a time,
+        #   so the ones this import inserted are known for sure
+        try:
+            with transaction.atomic():
+                SavedMap.objects.bulk_create(new_maps.values())
+            inserted = list(new_maps)
+        except IntegrityError:
+            inserted = [
+                data_hash
+                for data_hash, saved_map in new_maps.items()
+                if self.insert(saved_map)
+            ]
+
+        # bulk_create doesn't set the PKs on every database
+        created = SavedMap.objects.filter(data_hash__in=inserted).values_list('pk', 'data_hash')
+        created = list(created)
+        self.duplicates += len(new_maps) - len(created)
+        self.created += len(created)
+
+        for pk, data_hash in created:
+            saved_map = new_maps[data_hash]
+            saved_map.pk = pk
+            saved_map.try_write_data_files()
+            MapJob.enqueue(saved_map)
+
+    def insert(self, saved_map):
+
+        """ Insert one map the way /save/ does,
+                returning False if it turns out to be saved already
+        """
+
+        try:
+            with transaction.atomic():
+                SavedMap.objects.bulk_create([saved_map])
+        except IntegrityError:
+            # Anything else that failed isn't a duplicate
+            if not SavedMap.objects.filter(data_hash=saved_map.data_hash).exists():
+                raise
+            return False
+        return True
+
+    def summary(self):
+        output = f'Imported {self.created} maps; skipped {self.duplicates} already saved and {len(self.errors)} invalid.'
+        for line_number, error in self.errors:
+            output += f'\n\tLine {line_number}: {error}'
+        return output
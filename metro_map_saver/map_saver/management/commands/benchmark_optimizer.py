@@ -0,0 +1,279 @@
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from map_saver.mapdata_optimizer import (
+    find_connected_components,
+    find_lines,
+    get_connected_points,
+    get_svg_from_shapes_by_color,
+    sort_points_by_color,
+)
+from map_saver.occupancy import OccupancyGrid, get_occupancy_grids
+from map_saver.templatetags.metromap_utils import (
+    get_station_index,
+    station_marker,
+)
+from map_saver.validator import validate_metro_map_v3
+
+import copy
+import random
+import sys
+import time
+import tracemalloc
+
+
+def legacy_get_connected_points(x, y, points, connected=None, checked=None, check_next=None):
+
+    """ The original recursive, list-based get_connected_points,
+            kept here only as a baseline to compare against
+    """
+
+    if not connected:
+        connected = [(x, y)]
+
+    if not checked:
+        checked = []
+
+    if not check_next:
+        check_next = []
+
+    to_check = {
+        'S': (x, y + 1),
+        'N': (x, y - 1),
+        'E': (x + 1, y),
+        'W': (x - 1, y),
+        'SE': (x + 1, y + 1),
+        'NE': (x + 1, y - 1),
+        'SW': (x - 1, y + 1),
+        'NW': (x - 1, y - 1),
+    }
+
+    for direction, coords in to_check.items():
+
+        if coords[0] < 0 or coords[1] < 0:
+            continue
+
+        if coords in checked:
+            continue
+
+        if coords not in points:
+            checked.append(coords)
+            continue
+
+        if coords in points and coords not in connected:
+            connected.append(coords)
+            checked.append(coords)
+            check_next.append(coords)
+
+    while check_next:
+        coords = check_next.pop(0)
+        return legacy_get_connected_points(
+            coords[0],
+            coords[1],
+            points,
+            connected,
+            checked,
+            check_next,
+        )
+
+    return connected
+
+
+class Command(BaseCommand):
+    help = """
+        Benchmark the map data optimizer against a synthetic map.
+
+            Times validating a data_version 3 map (with every point drawn twice,
+            the second time in another color) and reading it with sort_points_by_color.
+
+            Compares finding every connected component of a single color
+            using the original recursive get_connected_points (once per component),
+            the iterative get_connected_points, and find_connected_components.
+
+            Also compares find_lines against a set of points and an OccupancyGrid,
+            and drawing the SVG with each settings.SVG_RENDERER.
+
+            Then compares drawing rect-style stations
+            with and without a station index.
+
+            Finally, compares finding lines on a sparse map with many colors
+            (the most common kind) with every color as an OccupancyGrid,
+            and with only the colors dense enough for one (see get_occupancy_grids).
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-m',
+            '--map-size',
+            type=int,
+            dest='map_size',
+            default=360,
+            help='Size of the synthetic map (the map is map_size x map_size).',
+        )
+        parser.add_argument(
+            '-d',
+            '--density',
+            type=float,
+            dest='density',
+            default=0.5,
+            help='Fraction of the map covered by points, between 0 and 1.',
+        )
+        parser.add_argument(
+            '--legacy-limit',
+            type=int,
+            dest='legacy_limit',
+            default=2000,
+            help='Skip the original recursive implementation for maps with more points than this; it is quadratic.',
+        )
+        parser.add_argument(
+            '--stations',
+            type=int,
+            dest='stations',
+            default=2000,
+            help='Number of rect-style stations to draw.',
+        )
+        parser.add_argument(
+            '--sparse-colors',
+            type=int,
+            dest='sparse_colors',
+            default=40,
+            help='Number of colors on the sparse map.',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            dest='seed',
+            default=0,
+            help='Random seed, so runs are comparable.',
+        )
+
+    def get_components_with(self, function, points):
+
+        """ Find every connected component by calling function
+                once per component, the way callers of get_connected_points had to
+        """
+
+        remaining = set(points)
+        components = []
+        while remaining:
+            x, y = min(remaining)
+            connected = function(x, y, points)
+            remaining.difference_update(connected)
+            components.append(connected)
+        return components
+
+    def benchmark_sparse_colors(self, rng, map_size, colors):
+
+        """ Compare all-grid and density-chosen points on a sparse map:
+                each color is a few short line segments
+        """
+
+        points_by_color = {}
+        for color in range(colors):
+            points = set()
+            for _ in range(rng.randrange(2, 8)):
+                x, y = rng.randrange(map_size - 10), rng.randrange(map_size)
+                points.update((x + n, y) for n in range(rng.randrange(2, 10)))
+            points_by_color[f'{color:06x}'] = {'1-solid': points}
+        total = sum(len(points['1-solid']) for points in points_by_color.values())
+
+        all_grids = lambda: {
+            color: {'1-solid': OccupancyGrid(map_size, points['1-solid'])}
+            for color, points in points_by_color.items()
+        }
+        for label, convert in (('every color as an OccupancyGrid', all_grids), ('get_occupancy_grids', lambda: get_occupancy_grids(points_by_color, map_size))):
+            tracemalloc.start()
+            t0 = time.time()
+            converted = convert()
+            for color in converted:
+                find_lines(converted[color]['1-solid'])
+            dt = time.time() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write(f'Sparse map, {colors} colors, {total:,} points ({label}): {dt:.4f}s, {peak / 1024:,.0f}KB peak')
+
+    def handle(self, *args, **kwargs):
+        map_size = kwargs['map_size']
+        density = kwargs['density']
+        legacy_limit = kwargs['legacy_limit']
+
+        rng = random.Random(kwargs['seed'])
+        points = [
+            (x, y)
+            for x in range(map_size)
+            for y in range(map_size)
+            if rng.random() < density
+        ]
+        self.stdout.write(f'Benchmarking {len(points):,} points on a {map_size}x{map_size} map.')
+
+        xys = {}
+        for x, y in points:
+            xys.setdefault(str(x), {})[str(y)] = 1
+        mapdata = {
+            'global': {'data_version': 3, 'map_size': map_size, 'lines': {'bd1038': {}}},
+            'points_by_color': {'bd1038': {'1-solid': xys}},
+            'stations': {},
+        }
+        # Every point again in another color, all of which are skipped
+        hostile_mapdata = copy.deepcopy(mapdata)
+        hostile_mapdata['global']['lines']['0896d7'] = {}
+        hostile_mapdata['points_by_color']['0896d7'] = copy.deepcopy(hostile_mapdata['points_by_color']['bd1038'])
+        t0 = time.time()
+        validate_metro_map_v3(hostile_mapdata)
+        self.stdout.write(f'validate_metro_map_v3 (every point twice): {time.time() - t0:.4f}s')
+
+        t0 = time.time()
+        sort_points_by_color(mapdata, data_version=3)
+        self.stdout.write(f'sort_points_by_color: {time.time() - t0:.4f}s')
+
+        if len(points) > legacy_limit:
+            self.stdout.write(f'Skipping recursive get_connected_points: more than {legacy_limit:,} points (see --legacy-limit).')
+        else:
+            t0 = time.time()
+            try:
+                components = self.get_components_with(legacy_get_connected_points, points)
+            except RecursionError:
+                self.stdout.write(f'Recursive get_connected_points: RecursionError (limit: {sys.getrecursionlimit()}) after {time.time() - t0:.4f}s')
+            else:
+                self.stdout.write(f'Recursive get_connected_points: {len(components):,} components in {time.time() - t0:.4f}s')
+
+        t0 = time.time()
+        components = self.get_components_with(get_connected_points, set(points))
+        self.stdout.write(f'Iterative get_connected_points: {len(components):,} components in {time.time() - t0:.4f}s')
+
+        t0 = time.time()
+        components = find_connected_components(points)
+        self.stdout.write(f'find_connected_components: {len(components):,} components in {time.time() - t0:.4f}s')
+
+        t0 = time.time()
+        lines, singletons = find_lines(set(points))
+        self.stdout.write(f'find_lines (set): {len(lines):,} lines, {len(singletons):,} singletons in {time.time() - t0:.4f}s')
+
+        t0 = time.time()
+        grid = OccupancyGrid(map_size, points)
+        t1 = time.time()
+        lines, singletons = find_lines(grid)
+        self.stdout.write(f'find_lines (OccupancyGrid): {len(lines):,} lines, {len(singletons):,} singletons in {time.time() - t1:.4f}s (+{t1 - t0:.4f}s to build the grid)')
+
+        shapes_by_color = {'bd1038': {'1-solid': {'lines': lines, 'points': singletons}}}
+        points_by_color = {'bd1038': {'1-solid': grid}}
+        for renderer in ('template', 'python'):
+            with override_settings(SVG_RENDERER=renderer):
+                t0 = time.time()
+                svg = get_svg_from_shapes_by_color(shapes_by_color, map_size, 1, 'wmata', points_by_color)
+                self.stdout.write(f'SVG ({renderer}): {len(svg):,} bytes in {time.time() - t0:.4f}s')
+
+        # Stations on every other point of the map's occupied points,
+        #   so plenty of them are adjacent and connect
+        stations = [
+            {'name': '', 'orientation': 0, 'xy': xy, 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'rect'}
+            for xy in points[:kwargs['stations'] * 2:2]
+        ]
+
+        for use_index in (False, True):
+            t0 = time.time()
+            station_index = get_station_index(stations) if use_index else None
+            for station in stations:
+                station_marker(station, 'rect', 1, points_by_color, stations, 3, station_index)
+            self.stdout.write(f'{len(stations):,} stations ({"with" if use_index else "without"} station index): {time.time() - t0:.4f}s')
+
+        self.benchmark_sparse_colors(rng, map_size, kwargs['sparse_colors'])
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from map_saver.importer import MapImport
+
+import sys
+import time
+
+
+class Command(BaseCommand):
+    help = """
+        Import many maps at once from newline-delimited JSON files
+            (one map per line, just as it would be sent to /save/),
+            or from stdin if no files are given.
+
+            Each map is validated just as /save/ would;
+            maps that were already saved are skipped.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'files',
+            nargs='*',
+            help='Newline-delimited JSON files to import; reads from stdin if none are given.',
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            dest='workers',
+            default=1,
+            help='Validate maps in this many processes at once.',
+        )
+        parser.add_argument(
+            '-b',
+            '--batch',
+            type=int,
+            dest='batch',
+            default=500,
+            help='Insert this many maps at once.',
+        )
+
+    def handle(self, *args, **kwargs):
+        files = kwargs['files']
+        workers = kwargs['workers']
+        batch = kwargs['batch']
+
+        for filename in files or ['-']:
+            t0 = time.time()
+            map_import = MapImport(workers=workers, batch_size=batch)
+            if filename == '-':
+                map_import.import_lines(sys.stdin)
+            else:
+                with open(filename, encoding='utf-8') as lines:
+                    map_import.import_lines(lines)
+            self.stdout.write(f'{filename}: {map_import.summary()} ({time.time() - t0:.2f}s)')
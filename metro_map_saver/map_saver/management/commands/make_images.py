@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.db.models import Q
 from map_saver.models import SavedMap
+from map_saver.workers import get_worker_pool
 
+import functools
 import json
 import logging
 import time
@@ -9,6 +11,37 @@ import time
 logger = logging.getLogger(__name__)
 
 
+def make_images(mmap, force=False):
+
+    """ Generate images and thumbnails for a single map.
+
+        Returns the map's urlhash, what to output,
+            whether it failed, and how long it took.
+    """
+
+    t1 = time.time()
+    failed = False
+
+    try:
+        output = mmap.generate_images(force=force)
+    except json.decoder.JSONDecodeError as exc:
+        output = f'[ERROR] Failed to generate images and thumbnails for #{mmap.id} ({mmap.urlhash}): JSONDecodeError: {exc}'
+        failed = True
+    except Exception as exc:
+        output = f'[ERROR] Failed to generate images and thumbnails for #{mmap.id} ({mmap.urlhash}): Exception: {exc}'
+        failed = True
+
+    return mmap.urlhash, output, failed, time.time() - t1
+
+
+def make_images_by_pk(pk, force=False):
+
+    """ Run in each worker process (see --workers)
+    """
+
+    return make_images(SavedMap.objects.get(pk=pk), force)
+
+
 class Command(BaseCommand):
     help = """
         Run on a regular schedule to generate images and thumbnails.
@@ -16,8 +49,13 @@ class Command(BaseCommand):
             This really has multiple modes:
                 * ongoing (no args), less memory-efficient but with fewer database hits,
                     meant to generate maps for the first time automatically on a schedule
-                * urlhash, meant to (re-)generate a single map
+                * urlhash, meant to (re-)generate a single map (always re-drawn, as if --force were set)
                 * start/end, like alltime but meant to handle picking up from a starting point
+
+            Any mode can spread the maps across several processes with --workers
+
+            Maps whose images were already drawn from the same map data
+                by the same version of the renderer are skipped unless --force is set
     """
 
     def add_arguments(self, parser):
@@ -51,7 +89,7 @@ class Command(BaseCommand):
             type=str,
             dest='urlhash',
             default=False,
-            help='Calculate images and thumbnails for only one map in particular.',
+            help='Calculate images and thumbnails for only one map in particular, even if they are up to date.',
         )
 
         parser.add_argument(
@@ -62,14 +100,35 @@ class Command(BaseCommand):
             help='Run another instance of this to keep the latest maps up to date while the backfill is ongoing',
         )
 
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            dest='workers',
+            default=1,
+            help='Generate images for this many maps at once, each in its own process.',
+        )
+
+        parser.add_argument(
+            '-f',
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Re-draw images even if neither the map data nor the renderer have changed since they were last drawn.',
+        )
+
     def handle(self, *args, **kwargs):
         urlhash = kwargs['urlhash']
         start = kwargs['start']
         end = kwargs['end']
         limit = kwargs['limit']
         latest = kwargs['latest']
+        workers = kwargs['workers']
+        force = kwargs['force']
 
         if urlhash:
+            force = True
             limit = total = 1
             needs_images = SavedMap.objects.filter(urlhash=urlhash)
             self.stdout.write(f"Generating images and thumbnails for {urlhash}.")
@@ -96,26 +155,34 @@ class Command(BaseCommand):
 
         errors = []
         t0 = time.time()
-        for mmap in needs_images:
-            t1 = time.time()
-
-            try:
-                self.stdout.write(mmap.generate_images())
-            except json.decoder.JSONDecodeError as exc:
-                self.stdout.write(f'[ERROR] Failed to generate images and thumbnails for #{mmap.id} ({mmap.urlhash}): JSONDecodeError: {exc}')
-                errors.append(mmap.urlhash)
-            except Exception as exc:
-                self.stdout.write(f'[ERROR] Failed to generate images and thumbnails for #{mmap.id} ({mmap.urlhash}): Exception: {exc}')
-                errors.append(mmap.urlhash)
-
-            t2 = time.time()
-            dt = (t2 - t1)
-            if dt > 5:
-                self.stdout.write(f'Generating image for {mmap.urlhash} took a very long time: {dt:.2f}s')
-                logger.warn(f'Generating image for {mmap.urlhash} took a very long time: {dt:.2f}s')
+
+        if workers > 1:
+            pks = list(needs_images.values_list('pk', flat=True))
+            self.stdout.write(f'Using {workers} workers.')
+
+            with get_worker_pool(workers) as pool:
+                results = pool.map(functools.partial(make_images_by_pk, force=force), pks, chunksize=4)
+                self.handle_results(results, errors)
+        else:
+            self.handle_results((make_images(mmap, force) for mmap in needs_images), errors)
 
         t3 = time.time()
         dt = (t3 - t0)
         self.stdout.write(f'Made images and thumbnails in {dt:.2f}s')
         if errors:
             self.stdout.write(f'Failed to generate images and thumbnails for {len(errors)} maps: {errors}')
+
+    def handle_results(self, results, errors):
+
+        """ Output the result of each map as it finishes,
+                and note any errors
+        """
+
+        for urlhash, output, failed, dt in results:
+            self.stdout.write(output)
+            if failed:
+                errors.append(urlhash)
+
+            if dt > 5:
+                self.stdout.write(f'Generating image for {urlhash} took a very long time: {dt:.2f}s')
+                logger.warn(f'Generating image for {urlhash} took a very long time: {dt:.2f}s')
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from map_saver.models import SavedMap
+from map_saver.validator import get_data_hash
+
+import json
+
+
+class Command(BaseCommand):
+    help = """
+        Backfill .data_hash for maps saved before it was added,
+            so saving one of them again finds it instead of storing it twice.
+
+            Their urlhashes stay as they are.
+            If the same map was saved more than once, only the earliest gets the .data_hash.
+            Once this has run, set LEGACY_URLHASH_LOOKUP = False.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Only backfill maps with this PK or higher.',
+        )
+        parser.add_argument(
+            '-l',
+            '--limit',
+            type=int,
+            dest='limit',
+            default=1000,
+            help='Only backfill this many maps at once.',
+        )
+
+    def handle(self, *args, **kwargs):
+        start = kwargs['start']
+        limit = kwargs['limit']
+
+        needs_hash = SavedMap.objects.filter(
+            pk__gte=start,
+            data_hash=None,
+        ).only('pk', 'urlhash', 'data', 'packed_data', 'mapdata').order_by('id')[:limit]
+
+        hashed = duplicates = skipped = 0
+        last_pk = None
+        for mmap in needs_hash:
+            last_pk = mmap.pk
+            try:
+                data = mmap.get_data() or json.loads(mmap.mapdata or 'null')
+            except ValueError as exc:
+                self.stdout.write(f'[WARNING] Could not read #{mmap.id} ({mmap.urlhash}): {exc}; skipping.')
+                skipped += 1
+                continue
+
+            if not data:
+                skipped += 1
+                continue
+
+            # Updated directly, so nothing else about the map is saved again
+            try:
+                with transaction.atomic():
+                    SavedMap.objects.filter(pk=mmap.pk).update(data_hash=get_data_hash(data))
+            except IntegrityError:
+                duplicates += 1
+                continue
+            hashed += 1
+
+        self.stdout.write(f'Backfilled .data_hash for {hashed} maps; {duplicates} were duplicates of earlier maps and {skipped} were skipped.')
+        if last_pk is not None:
+            self.stdout.write(f'To continue, run again with --start {last_pk + 1}')
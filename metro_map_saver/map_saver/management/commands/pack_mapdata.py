@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from map_saver.mapdata_codec import unpack_mapdata
+from map_saver.models import SavedMap
+
+import json
+
+
+class Command(BaseCommand):
+    help = """
+        Backfill .packed_data for maps that have v2+ .data but haven't been packed yet.
+
+            Every packed map is unpacked again and compared against .data
+            before it's saved, so nothing is stored that can't be read back exactly.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Only pack maps with this PK or higher.',
+        )
+        parser.add_argument(
+            '-l',
+            '--limit',
+            type=int,
+            dest='limit',
+            default=1000,
+            help='Only pack this many maps at once.',
+        )
+
+    def handle(self, *args, **kwargs):
+        start = kwargs['start']
+        limit = kwargs['limit']
+
+        needs_packing = SavedMap.objects.filter(
+            pk__gte=start,
+            packed_data=None,
+        ).exclude(data={}).only('pk', 'urlhash', 'data').order_by('id')[:limit]
+
+        packed = skipped = 0
+        json_bytes = packed_bytes = 0
+        for mmap in needs_packing:
+            packed_data = SavedMap.pack_data(mmap.data)
+            if packed_data is None or unpack_mapdata(packed_data) != mmap.data:
+                self.stdout.write(f'[WARNING] Could not pack #{mmap.id} ({mmap.urlhash}) losslessly; skipping.')
+                skipped += 1
+                continue
+
+            mmap.packed_data = packed_data
+            mmap.save(update_fields=['packed_data'])
+            packed += 1
+            json_bytes += len(json.dumps(mmap.data))
+            packed_bytes += len(packed_data)
+
+        self.stdout.write(f'Packed {packed} maps ({json_bytes:,} bytes of JSON down to {packed_bytes:,} bytes); skipped {skipped}.')
@@ -100,8 +100,9 @@ class Command(BaseCommand):
             ids_and_hashes.append(f'{mmap.id},{mmap.urlhash}')
 
             if not dry_run:
-                mmap.data = json.loads(new_data)
+                mmap.set_data(json.loads(new_data))
                 mmap.save()
+                mmap.try_write_data_files()
 
         self.stdout.write(f'Processed the following {len(ids_and_hashes)} maps, worth a spot-check:')
         self.stdout.write('\n'.join(ids_and_hashes))
@@ -0,0 +1,179 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from map_saver.models import MapJob
+
+import datetime
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long a worker has to finish the jobs it took before another worker can take them
+LEASE = datetime.timedelta(minutes=10)
+
+
+class Command(BaseCommand):
+    help = """
+        Run the jobs queued up when maps are saved (see MapJob):
+            drawing images and suggesting cities for new maps.
+
+            Runs until stopped, checking for new jobs every --sleep seconds;
+                or with --once, runs every job that's ready and stops.
+
+            Any number of these can run at once;
+                each job is only taken by one of them.
+
+            A job that fails MAX_ATTEMPTS times is marked failed and not run again;
+                list those with --failed, and run them again with --retry-failed.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Stop once there are no more jobs ready to run.',
+        )
+        parser.add_argument(
+            '-b',
+            '--batch',
+            type=int,
+            dest='batch',
+            default=10,
+            help='Take this many jobs at once.',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            dest='sleep',
+            default=2,
+            help='When there are no jobs ready to run, wait this many seconds before checking again.',
+        )
+        parser.add_argument(
+            '--failed',
+            action='store_true',
+            dest='failed',
+            default=False,
+            help='List the jobs that have failed too many times to be retried, and stop.',
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            dest='retry_failed',
+            default=False,
+            help='Give the jobs that have failed too many times another MAX_ATTEMPTS tries.',
+        )
+
+    def handle(self, *args, **kwargs):
+        once = kwargs['once']
+        batch = kwargs['batch']
+        sleep = kwargs['sleep']
+
+        if kwargs['failed']:
+            self.list_failed()
+            return
+
+        if kwargs['retry_failed']:
+            retried = MapJob.objects.exclude(failed_at=None).update(
+                failed_at=None,
+                attempts=0,
+                run_after=timezone.now(),
+            )
+            self.stdout.write(f'Retrying {retried} failed jobs.')
+
+        while True:
+            self.fail_exhausted()
+            jobs = self.take_jobs(batch)
+            for job in jobs:
+                self.run_job(job)
+
+            if not jobs:
+                if once:
+                    break
+                time.sleep(sleep)
+
+    def take_jobs(self, batch):
+
+        """ Take the next jobs that are ready to run,
+                skipping any that another worker is taking at the same time,
+                and push them back for LEASE so no other worker takes them
+                while these are running
+        """
+
+        now = timezone.now()
+        with transaction.atomic():
+            jobs = list(
+                MapJob.objects.select_for_update(skip_locked=True).filter(
+                    run_after__lte=now,
+                    attempts__lt=MapJob.MAX_ATTEMPTS,
+                    failed_at=None,
+                ).order_by('run_after', 'id')[:batch]
+            )
+            MapJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+                run_after=now + LEASE,
+                attempts=F('attempts') + 1,
+            )
+        return jobs
+
+    def fail_exhausted(self):
+
+        """ Mark jobs failed that used up their last attempt
+                without finishing (their worker stopped partway through),
+                once their LEASE is up
+        """
+
+        now = timezone.now()
+        exhausted = MapJob.objects.filter(
+            run_after__lte=now,
+            attempts__gte=MapJob.MAX_ATTEMPTS,
+            failed_at=None,
+        )
+        for job in exhausted:
+            error = f'[ERROR] Gave up on {job}: attempt {job.attempts} of {MapJob.MAX_ATTEMPTS} never finished'
+            self.stdout.write(error)
+            logger.error(error)
+        exhausted.update(failed_at=now)
+
+    def list_failed(self):
+        failed = MapJob.objects.exclude(failed_at=None).order_by('failed_at')
+        for job in failed:
+            self.stdout.write(f'{job} failed at {job.failed_at}: {job.last_error}')
+        self.stdout.write(f'{len(failed)} failed jobs.')
+
+    def run_job(self, job):
+
+        """ Run a job, and delete it if it worked;
+                if it didn't, it's retried later, waiting longer after each attempt,
+                until it's failed MAX_ATTEMPTS times
+        """
+
+        t0 = time.time()
+        try:
+            output = job.run()
+        except Exception as exc:
+            attempts = job.attempts + 1
+            error = f'[ERROR] Failed to run {job} (attempt {attempts} of {MapJob.MAX_ATTEMPTS}): {type(exc).__name__}: {exc}'
+            self.stdout.write(error)
+            logger.error(error)
+            if attempts >= MapJob.MAX_ATTEMPTS:
+                gave_up = f'[ERROR] Gave up on {job} after {attempts} attempts; see run_jobs --failed'
+                self.stdout.write(gave_up)
+                logger.error(gave_up)
+                MapJob.objects.filter(pk=job.pk).update(
+                    failed_at=timezone.now(),
+                    last_error=error,
+                )
+            else:
+                MapJob.objects.filter(pk=job.pk).update(
+                    run_after=timezone.now() + datetime.timedelta(minutes=2 ** attempts),
+                    last_error=error,
+                )
+            return
+
+        MapJob.objects.filter(pk=job.pk).delete()
+        if output:
+            self.stdout.write(output)
+        self.stdout.write(f'Ran {job} in {time.time() - t0:.2f}s')
@@ -1,7 +1,6 @@
 from django.core.management.base import BaseCommand
 
 from citysuggester.utils import (
-    load_systems,
     suggest_city,
     MINIMUM_STATION_OVERLAP,
 )
@@ -73,11 +72,8 @@ class Command(BaseCommand):
         self.stdout.write(f'Checking {needs_suggestions.count()} maps for suggested cities ...')
         t0 = time.time()
 
-        # Pre-load the travelsystems to save setup time
-        travel_systems = load_systems()
-
         for mmap in needs_suggestions:
-            suggested_city = suggest_city(set(mmap.stations.lower().split(',')), systems=travel_systems)
+            suggested_city = suggest_city(set(mmap.stations.lower().split(',')))
             if suggested_city:
                 mmap.suggested_city = suggested_city[0][0].split("(")[0].strip()
                 mmap.suggested_city_overlap = suggested_city[0][1]
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from map_saver.models import SavedMap, get_data_filepath
+
+import os
+
+
+class Command(BaseCommand):
+    help = """
+        Backfill the static data files (MEDIA_ROOT/data/<thousand>/<urlhash>.json and .json.gz)
+            for maps that don't have them yet.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Only write data files for maps with this PK or higher.',
+        )
+        parser.add_argument(
+            '-l',
+            '--limit',
+            type=int,
+            dest='limit',
+            default=1000,
+            help='Only write data files for this many maps at once.',
+        )
+        parser.add_argument(
+            '-f',
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Re-write data files even if they already exist.',
+        )
+
+    def handle(self, *args, **kwargs):
+        start = kwargs['start']
+        limit = kwargs['limit']
+        force = kwargs['force']
+
+        maps = SavedMap.objects.filter(
+            pk__gte=start,
+        ).only('pk', 'urlhash', 'mapdata', 'data', 'packed_data').order_by('id')[:limit]
+
+        written = skipped = 0
+        last_pk = start
+        for mmap in maps:
+            last_pk = mmap.pk
+            if not force and all(
+                os.path.exists(os.path.join(settings.MEDIA_ROOT, get_data_filepath(mmap, compressed)))
+                for compressed in (False, True)
+            ):
+                skipped += 1
+                continue
+
+            mmap.write_data_files()
+            written += 1
+
+        self.stdout.write(f'Wrote data files for {written} maps; skipped {skipped} that already had them. Next: --start {last_pk + 1}')
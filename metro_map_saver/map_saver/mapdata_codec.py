@@ -0,0 +1,154 @@
+""" A compact, versioned binary encoding for v2+ map data (SavedMap.data).
+
+    In .data, every point of every color (and width/style, for v3)
+        is its own JSON key: points_by_color[color][width_style][x][y] = 1.
+
+    Packed, each color and width/style is instead a bitmap
+        with one bit per square of the map,
+        and the stations are a table of [x, y, station] rows.
+        Everything else (global, and any other top-level keys)
+        is kept as JSON alongside them, and the whole thing is compressed.
+
+    Layout:
+        MAGIC, format version (1 byte), then zlib-compressed:
+            length of the metadata (4 bytes), the metadata as JSON,
+            then one bitmap per layer, in the order listed in the metadata.
+
+    pack_mapdata(data) raises ValueError for any data it can't pack losslessly,
+        so unpack_mapdata(pack_mapdata(data)) == data whenever it succeeds.
+"""
+
+from .validator import XY_INTS
+
+import itertools
+import json
+import struct
+import zlib
+
+MAGIC = b'MMM'
+FORMAT_VERSION = 1
+
+# For converting between a bitmap and one byte per square
+BITS_TO_BYTES = bytes.maketrans(b'01', b'\x00\x01')
+BYTES_TO_BITS = bytes.maketrans(b'\x00\x01', b'01')
+
+
+def get_bitmap_size(size):
+    return (size * size + 7) // 8
+
+
+def pack_mapdata(data):
+
+    """ Given v2+ map data, returns it packed as bytes
+    """
+
+    if not isinstance(data, dict) or not isinstance(data.get('points_by_color'), dict):
+        raise ValueError('Only v2+ map data with points_by_color can be packed')
+
+    stations = data.get('stations', {})
+    if not isinstance(stations, dict):
+        raise ValueError('stations must be a dict')
+
+    highest_seen = 0
+    layers = []
+    for color, width_styles in data['points_by_color'].items():
+        if not isinstance(width_styles, dict):
+            raise ValueError(f'points_by_color[{color}] must be a dict')
+        for width_style, xys in width_styles.items():
+            if not isinstance(xys, dict):
+                raise ValueError(f'points_by_color[{color}][{width_style}] must be a dict')
+            points = []
+            for x, column in xys.items():
+                if x not in XY_INTS or not isinstance(column, dict) or not column:
+                    raise ValueError(f'Invalid x: {x}')
+                x = XY_INTS[x]
+                for y, value in column.items():
+                    if y not in XY_INTS or type(value) is not int or value != 1:
+                        raise ValueError(f'Invalid point: {x},{y}')
+                    y = XY_INTS[y]
+                    points.append((x, y))
+                    if x > highest_seen:
+                        highest_seen = x
+                    if y > highest_seen:
+                        highest_seen = y
+            layers.append((color, width_style, points))
+
+    station_table = []
+    for x, column in stations.items():
+        if x not in XY_INTS or not isinstance(column, dict) or not column:
+            raise ValueError(f'Invalid station x: {x}')
+        for y, station in column.items():
+            if y not in XY_INTS:
+                raise ValueError(f'Invalid station: {x},{y}')
+            station_table.append([XY_INTS[x], XY_INTS[y], station])
+
+    size = highest_seen + 1
+    bitmap_size = get_bitmap_size(size)
+    bitmaps = []
+    for color, width_style, points in layers:
+        # One byte per square, then packed down to one bit per square
+        cells = bytearray(bitmap_size * 8)
+        for x, y in points:
+            cells[x * size + y] = 1
+        bitmaps.append(int(cells.translate(BYTES_TO_BITS), 2).to_bytes(bitmap_size, 'big'))
+
+    metadata = {
+        'keys': list(data),
+        'other': {key: value for key, value in data.items() if key not in ('points_by_color', 'stations')},
+        'size': size,
+        'layers': [[color, width_style] for color, width_style, points in layers],
+        'stations': station_table,
+    }
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+
+    body = zlib.compress(struct.pack('>I', len(metadata)) + metadata + b''.join(bitmaps))
+    return MAGIC + bytes([FORMAT_VERSION]) + body
+
+
+def unpack_mapdata(packed):
+
+    """ Reverses pack_mapdata
+    """
+
+    packed = bytes(packed)
+    if packed[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not packed map data')
+
+    version = packed[len(MAGIC)]
+    if version != FORMAT_VERSION:
+        raise ValueError(f'Unknown packed map data format version: {version}')
+
+    body = zlib.decompress(packed[len(MAGIC) + 1:])
+    metadata_size, = struct.unpack('>I', body[:4])
+    metadata = json.loads(body[4:4 + metadata_size])
+    bitmaps = memoryview(body)[4 + metadata_size:]
+
+    size = metadata['size']
+    bitmap_size = get_bitmap_size(size)
+    xy_strings = [str(n) for n in range(size)]
+
+    points_by_color = {}
+    for n, (color, width_style) in enumerate(metadata['layers']):
+        bitmap = bitmaps[n * bitmap_size:(n + 1) * bitmap_size]
+        # One byte (0 or 1) per square, rather than one bit
+        cells = format(int.from_bytes(bitmap, 'big'), f'0{bitmap_size * 8}b').encode('ascii').translate(BITS_TO_BYTES)
+        xys = {}
+        for x in range(size):
+            row = cells[x * size:(x + 1) * size]
+            if 1 in row:
+                xys[xy_strings[x]] = dict.fromkeys(itertools.compress(xy_strings, row), 1)
+        points_by_color.setdefault(color, {})[width_style] = xys
+
+    stations = {}
+    for x, y, station in metadata['stations']:
+        stations.setdefault(str(x), {})[str(y)] = station
+
+    data = {}
+    for key in metadata['keys']:
+        if key == 'points_by_color':
+            data[key] = points_by_color
+        elif key == 'stations':
+            data[key] = stations
+        else:
+            data[key] = metadata['other'][key]
+    return data
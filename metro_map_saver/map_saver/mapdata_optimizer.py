@@ -1,9 +1,27 @@
+import array
+import hashlib
 import itertools
 import json
+import re
 
+from django.conf import settings
+from django.core.cache import caches
 from django.template import Context, Template
-
-from .validator import VALID_XY, ALLOWED_MAP_SIZES, ALLOWED_ORIENTATIONS
+from django.utils.html import conditional_escape, escape
+
+from .occupancy import OccupancyGrid
+from .templatetags.metromap_utils import (
+    get_line_class_from_width_style,
+    get_line_width_styles_for_svg_style,
+    get_masked_line_class_from_width_style,
+    get_station_index,
+    get_station_styles_in_use,
+    get_style,
+    has_line_style,
+    station_marker,
+    station_text,
+)
+from .validator import XY_INTS, ALLOWED_MAP_SIZES, ALLOWED_ORIENTATIONS
 
 # For use with data version 2
 SVG_TEMPLATE = Template('''
@@ -94,13 +112,32 @@ STATIONS_SVG_TEMPLATE = Template('''
 {% spaceless %}
 {% load metromap_utils %}
 {% for station in stations %}
-    {% station_marker station default_station_shape line_size points_by_color stations data_version %}
-    {% station_text station points_by_color %} {# pbc needed because london-style stations want line direction #}
+    {% station_marker station default_station_shape line_size points_by_color stations data_version station_index line_directions %}
+    {% station_text station points_by_color line_directions %} {# pbc needed because london-style stations want line direction #}
 {% endfor %}
 {% endspaceless %}
 </svg>
 ''')
 
+# How every SVG template above ends
+SVG_CLOSE = '\n</svg>\n'
+
+# What {% spaceless %} does
+SPACELESS = re.compile(r'>\s+<')
+
+# Bump this whenever a change to the optimizer, the templates above, or metromap_utils
+#   changes the SVGs drawn from the same map data,
+#   so make_images knows which maps need to be re-drawn (see SavedMap.get_render_key)
+RENDERER_VERSION = 2
+
+# Shapes are cached in their own cache (see settings.CACHES),
+#   so they don't push everything else out of the default one
+SHAPES_CACHE_ALIAS = 'shapes'
+
+# Memcached's default limit on the size of a single item is 1MB;
+#   shapes bigger than this aren't worth caching anyway
+SHAPES_CACHE_MAX_BYTES = 1000 * 1000
+
 # Largest square worth checking with find_squares()
 LARGEST_SQUARE = 6
 USE_SQUARES_THRESHOLD = 1000 # If there are this many points in a single color, use squares even if the line width is thin
@@ -142,10 +179,10 @@ def sort_points_by_color(mapdata, map_type='classic', data_version=1):
     if map_type == 'classic' and data_version == 1:
         # Ex: [0][1]['line']: 'bd1038'
         for x in sorted(mapdata):
-            if x not in VALID_XY:
+            if x not in XY_INTS:
                 continue
             for y in sorted(mapdata[x]):
-                if y not in VALID_XY:
+                if y not in XY_INTS:
                     continue
 
                 line_color = mapdata[str(x)][y].get('line')
@@ -197,70 +234,60 @@ def sort_points_by_color(mapdata, map_type='classic', data_version=1):
 
         default_station_shape = mapdata['global'].get('style', {}).get('mapStationStyle', 'wmata')
 
-        for line_color in mapdata['points_by_color']:
-            for x in mapdata['points_by_color'][line_color]['xys']:
-                for y in mapdata['points_by_color'][line_color]['xys'][x]:
-                    x = str(x)
-                    y = str(y)
-                    if x not in VALID_XY or y not in VALID_XY:
-                        continue
+        for line_color, line in mapdata['points_by_color'].items():
+            points = None
+            for x, column in line['xys'].items():
+                x = XY_INTS.get(x)
+                if x is None:
+                    continue
 
-                    if mapdata['points_by_color'][line_color]['xys'][x][y] != 1:
+                for y, value in column.items():
+                    y = XY_INTS.get(y)
+                    if y is None or value != 1:
                         continue
 
-                    if line_color not in points_by_color:
-                        points_by_color[line_color] = {
-                            'xy': set(),
-                        }
-
-                    colors_by_xy[f'{x},{y}'] = line_color
-
-                    x = int(x)
-                    y = int(y)
+                    if points is None:
+                        points = points_by_color.setdefault(line_color, {'xy': set()})['xy']
 
                     if x > highest_seen:
                         highest_seen = x
                     if y > highest_seen:
                         highest_seen = y
 
-                    points_by_color[line_color]['xy'].add((x, y))
+                    point = (x, y)
+                    colors_by_xy[point] = line_color
+                    points.add(point)
 
     elif map_type == 'classic' and data_version == 3:
         colors_by_xy = {}
 
         default_station_shape = mapdata['global'].get('style', {}).get('mapStationStyle', 'wmata')
 
-        for line_color in mapdata['points_by_color']:
-            for width_style in mapdata['points_by_color'][line_color]:
-                for x in mapdata['points_by_color'][line_color][width_style]:
-                    for y in mapdata['points_by_color'][line_color][width_style][x]:
-                        x = str(x)
-                        y = str(y)
-                        if x not in VALID_XY or y not in VALID_XY:
-                            continue
+        for line_color, width_styles in mapdata['points_by_color'].items():
+            for width_style, xys in width_styles.items():
+                points = None
+                for x, column in xys.items():
+                    x = XY_INTS.get(x)
+                    if x is None:
+                        continue
 
-                        if mapdata['points_by_color'][line_color][width_style][x][y] != 1:
+                    for y, value in column.items():
+                        y = XY_INTS.get(y)
+                        if y is None or value != 1:
                             continue
 
-                        if line_color not in points_by_color:
-                            points_by_color[line_color] = {
-                                width_style: set(),
-                            }
-                        elif width_style not in points_by_color[line_color]:
-                            points_by_color[line_color][width_style] = set()
-
-                        colors_by_xy[f'{x},{y}'] = line_color
-                        linewidthstyles_by_xy[f'{x},{y}'] = width_style
-
-                        x = int(x)
-                        y = int(y)
+                        if points is None:
+                            points = points_by_color.setdefault(line_color, {}).setdefault(width_style, set())
 
                         if x > highest_seen:
                             highest_seen = x
                         if y > highest_seen:
                             highest_seen = y
 
-                        points_by_color[line_color][width_style].add((x, y))
+                        point = (x, y)
+                        colors_by_xy[point] = line_color
+                        linewidthstyles_by_xy[point] = width_style
+                        points.add(point)
 
     if map_type == 'classic' and data_version >= 2:
 
@@ -268,18 +295,18 @@ def sort_points_by_color(mapdata, map_type='classic', data_version=1):
         default_line_style = mapdata['global'].get('style', {}).get('mapLineStyle', 'solid')
         default_line_width_style = f'{default_line_width}-{default_line_style}'
 
-        for x in mapdata['stations']:
-            for y in mapdata['stations'][x]:
-                if x not in VALID_XY or y not in VALID_XY:
+        for x, column in mapdata['stations'].items():
+            for y, station in column.items():
+                xy = (XY_INTS.get(x), XY_INTS.get(y))
+                if None in xy:
                     continue
 
-                station = mapdata['stations'][x][y]
                 station_data = {
                     'name': station.get('name', ''),
                     'orientation': station.get('orientation', 0),
-                    'xy': (int(x), int(y)),
-                    'color': colors_by_xy[f'{x},{y}'],
-                    'line_width_style': linewidthstyles_by_xy.get(f'{x},{y}', default_line_width_style)
+                    'xy': xy,
+                    'color': colors_by_xy[xy],
+                    'line_width_style': linewidthstyles_by_xy.get(xy, default_line_width_style)
                 }
                 if station.get('transfer'):
                     station_data['transfer'] = 1
@@ -293,66 +320,80 @@ def sort_points_by_color(mapdata, map_type='classic', data_version=1):
 
     return points_by_color, stations, map_size
 
-def get_connected_points(x, y, points, connected=None, checked=None, check_next=None):
+# All eight neighbors of a point; used to walk connected points
+NEIGHBORS = (
+    (0, 1), # S
+    (0, -1), # N
+    (1, 0), # E
+    (-1, 0), # W
+    (1, 1), # SE
+    (1, -1), # NE
+    (-1, 1), # SW
+    (-1, -1), # NW
+)
+
+def get_connected_points(x, y, points):
 
-    """ Recursively find all connected points for x, y.
+    """ Find all connected points for x, y (inclusive).
 
-        This is useful if points is a list of 2-tuple (x, y) coordinate pairs
+        This is useful if points is a list (or set) of 2-tuple (x, y) coordinate pairs
             pre-sorted by a single color.
 
-        May hit recursion depth if more than 1k points are connected,
-            in which case some pre-optimizations should be done.
+        Walks the points iteratively with a set of points not yet visited,
+            so there's no recursion depth to hit no matter how many points are connected.
     """
 
-    if not connected:
-        connected = [(x, y)]
+    unvisited = set(points)
+    unvisited.discard((x, y))
 
-    if not checked:
-        checked = []
+    connected = [(x, y)]
+    check_next = [(x, y)]
 
-    if not check_next:
-        check_next = []
+    while check_next:
+        x, y = check_next.pop()
+        for dx, dy in NEIGHBORS:
+            coords = (x + dx, y + dy)
+            if coords in unvisited:
+                unvisited.remove(coords)
+                connected.append(coords)
+                check_next.append(coords)
 
-    to_check = {
-        'S': (x, y + 1),
-        'N': (x, y - 1),
-        'E': (x + 1, y),
-        'W': (x - 1, y),
-        'SE': (x + 1, y + 1),
-        'NE': (x + 1, y - 1),
-        'SW': (x - 1, y + 1),
-        'NW': (x - 1, y - 1),
-    }
+    return connected
 
-    for direction, coords in to_check.items():
+def find_connected_components(points):
 
-        if coords[0] < 0 or coords[1] < 0:
-            continue
+    """ Flood-fill every connected component of points at once.
 
-        if coords in checked:
-            continue
+        Each point is visited exactly once, so this is linear in the number of points,
+            compared to calling get_connected_points once for each component.
+
+        Returns a list of sets, one per component,
+            in the order the first point of each component appears in points.
+    """
+
+    unvisited = set(points)
+    components = []
 
-        if coords not in points:
-            checked.append(coords)
+    for start in points:
+        if start not in unvisited:
             continue
 
-        if coords in points and coords not in connected:
-            connected.append(coords)
-            checked.append(coords)
-            check_next.append(coords)
-    
-    while check_next:
-        coords = check_next.pop(0)
-        return get_connected_points(
-            coords[0],
-            coords[1],
-            points,
-            connected,
-            checked,
-            check_next,
-        )
+        unvisited.remove(start)
+        component = {start}
+        check_next = [start]
 
-    return connected
+        while check_next:
+            x, y = check_next.pop()
+            for dx, dy in NEIGHBORS:
+                coords = (x + dx, y + dy)
+                if coords in unvisited:
+                    unvisited.remove(coords)
+                    component.add(coords)
+                    check_next.append(coords)
+
+        components.append(component)
+
+    return components
 
 def is_adjacent(point1, point2):
 
@@ -462,6 +503,16 @@ def get_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_s
             so don't delete stations from the context or the argument
     """
 
+    return ''.join(iter_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations, data_version))
+
+def iter_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations=False, data_version=3, close=True):
+
+    """ Same as get_svg_from_shapes_by_color, but yields the SVG in chunks.
+
+        With close=False, stops just short of the closing </svg> (SVG_CLOSE),
+            so more can be added to the SVG (see write_svgs)
+    """
+
     context = {
         'shapes_by_color': shapes_by_color,
         'points_by_color': points_by_color,
@@ -472,10 +523,80 @@ def get_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_s
         'color_map': {color: f'c{index}' for index, color in enumerate(points_by_color.keys())},
     }
 
-    if data_version >= 3:
-        return SVG_TEMPLATE_V3.render(Context(context))
+    if data_version >= 3 and settings.SVG_RENDERER == 'python':
+        yield from iter_svg_v3(**context)
+    elif data_version >= 3:
+        yield SVG_TEMPLATE_V3.render(Context(context)).removesuffix(SVG_CLOSE)
     else:
-        return SVG_TEMPLATE.render(Context(context))
+        yield SVG_TEMPLATE.render(Context(context)).removesuffix(SVG_CLOSE)
+
+    if close:
+        yield SVG_CLOSE
+
+def iter_svg_v3(shapes_by_color, points_by_color, canvas_size, stations, line_size, default_station_shape, color_map):
+
+    """ Draws exactly the same SVG as SVG_TEMPLATE_V3 (with the same context),
+            up to SVG_CLOSE, but by yielding strings as it goes instead of
+            going through the template engine for every line.
+
+        If you change one, change the other;
+            use settings.SVG_RENDERER to switch between them and compare.
+    """
+
+    canvas_size = canvas_size or 80
+
+    colors_css = ''.join(f' .{class_name} {{ stroke: #{escape(color)} }}' for color, class_name in color_map.items())
+    line_css = f'line {{ stroke-width: {line_size or 1}; fill: none; stroke-linecap: round; stroke-linejoin: round; }}{colors_css} {get_line_width_styles_for_svg_style(shapes_by_color)}'
+
+    yield f'\n<svg version="1.1" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {canvas_size} {canvas_size}">\n'
+
+    if stations:
+        yield f'<style>text {{ font: 1px Helvetica; font-weight: 600; white-space: pre; dominant-baseline: central; }} {line_css}</style>'
+        yield get_station_styles_in_use(stations, default_station_shape, line_size)
+    else:
+        yield f'<style>{line_css}</style>'
+
+    if has_line_style(shapes_by_color, 'color_outline'):
+        yield '<filter id="fco" filterUnits="userSpaceOnUse"><feBlend in="SourceGraphic" in2="SourceGraphic" mode="screen"/></filter>'
+
+    for color_index, (color, line_width_style) in enumerate(shapes_by_color.items(), 1):
+        color_class = color_map[color]
+        fill = escape(color)
+        for width_style_index, (width_style, shapes) in enumerate(line_width_style.items(), 1):
+            line_style = get_style(width_style)
+            line_class = get_line_class_from_width_style(width_style, line_size)
+            masked_line_class = get_masked_line_class_from_width_style(width_style, line_size)
+
+            if 'hollow' in line_style or line_style == 'color_outline':
+                for line_index, line in enumerate(shapes['lines'], 1):
+                    coords = f'x1="{line[0]}" y1="{line[1]}" x2="{line[2]}" y2="{line[3]}"'
+                    mask_id = f'k{color_index}-{width_style_index}-{line_index}'
+                    yield f'<mask id="{mask_id}" maskUnits="userSpaceOnUse"><line class="{line_class}" {coords} stroke="#fff"/><line class="{masked_line_class}" {coords} stroke="#000"/></mask>'
+                    if line_style == 'color_outline':
+                        yield f'<line class="{color_class} {line_class}" {coords} filter="url(#fco)"/>'
+                    yield f'<line class="{color_class} {line_class}" {coords} mask="url(#{mask_id})"/>'
+            elif 'stripes' in line_style:
+                width_class = get_line_class_from_width_style(width_style, line_size, True)
+                linecap_class = 'sl-sq' if line_style == 'wide_stripes' else 'sl-b'
+                for line_index, line in enumerate(shapes['lines'], 1):
+                    coords = f'x1="{line[0]}" y1="{line[1]}" x2="{line[2]}" y2="{line[3]}"'
+                    mask_id = f'k{color_index}-{width_style_index}-{line_index}'
+                    yield f'<mask id="{mask_id}" maskUnits="userSpaceOnUse"><line class="{width_class} {linecap_class}" {coords} stroke="#fff"/><line class="{masked_line_class}" {coords} stroke="#000"/></mask>'
+                    yield f'<line class="{color_class} {width_class} {linecap_class}" {coords} mask="url(#{mask_id})"/>'
+                    yield f'<line class="{color_class} {line_class}" {coords}/>'
+            else:
+                if line_style == 'dotted_square':
+                    line_class = f'{line_class} {masked_line_class}'
+                for line in shapes['lines']:
+                    yield f'<line class="{color_class} {line_class}" x1="{line[0]}" y1="{line[1]}" x2="{line[2]}" y2="{line[3]}"/>'
+
+            # Same as the template: |add:-0.5 truncates to |add:0 for integers
+            if default_station_shape == 'rect':
+                for point in shapes['points']:
+                    yield f'<rect x="{point[0]}" y="{point[1]}" w="1" h="1" fill="#{fill}" />'
+            else:
+                for point in shapes['points']:
+                    yield f'<circle cx="{point[0]}" cy="{point[1]}" r="1" fill="#{fill}" />'
 
 def add_stations_to_svg(thumbnail_svg, line_size, default_station_shape, points_by_color, stations, data_version):
 
@@ -488,20 +609,68 @@ def add_stations_to_svg(thumbnail_svg, line_size, default_station_shape, points_
         and when displaying a lot of thumbnails on a screen.
     """
 
-    context = {
-        'line_size': line_size,
-        'default_station_shape': default_station_shape,
-        'points_by_color': points_by_color,
-        'stations': stations,
-        "data_version": data_version,
-    }
+    return thumbnail_svg.replace('</svg>', ''.join(iter_stations_svg(line_size, default_station_shape, points_by_color, stations, data_version)))
+
+def iter_stations_svg(line_size, default_station_shape, points_by_color, stations, data_version):
+
+    """ Yields the same SVG as STATIONS_SVG_TEMPLATE, one station at a time
+            (unless settings.SVG_RENDERER is 'template')
+    """
+
+    # Built once for the whole map, rather than once per station
+    station_index = get_station_index(stations)
+    line_directions = {}
+
+    if settings.SVG_RENDERER != 'python':
+        context = {
+            'line_size': line_size,
+            'default_station_shape': default_station_shape,
+            'points_by_color': points_by_color,
+            'stations': stations,
+            "data_version": data_version,
+            'station_index': station_index,
+            'line_directions': line_directions,
+        }
+        yield STATIONS_SVG_TEMPLATE.render(Context(context))
+        return
+
+    yield '\n'
+    for station in stations:
+        # Each station's marker and text start with < and end with >,
+        #   so {% spaceless %} removes everything between stations
+        marker = conditional_escape(station_marker(station, default_station_shape, line_size, points_by_color, stations, data_version, station_index, line_directions))
+        text = conditional_escape(station_text(station, points_by_color, line_directions))
+        yield SPACELESS.sub('><', f'{marker}{text}')
+    yield SVG_CLOSE
+
+def write_svgs(thumbnail_file, svg_file, shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations, data_version):
+
+    """ Writes the thumbnail SVG (no stations) and the full SVG (with stations)
+            to two binary files at the same time, as they're drawn,
+            so neither SVG has to be held in memory as a whole.
+
+        Writes exactly what get_svg_from_shapes_by_color and add_stations_to_svg would.
+    """
 
-    return thumbnail_svg.replace('</svg>', STATIONS_SVG_TEMPLATE.render(Context(context)))
+    for chunk in iter_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations, data_version, close=False):
+        chunk = chunk.encode()
+        thumbnail_file.write(chunk)
+        svg_file.write(chunk)
+
+    thumbnail_file.write(SVG_CLOSE.encode())
+
+    # Same as add_stations_to_svg: the stations replace the </svg> in SVG_CLOSE
+    svg_file.write(b'\n')
+    for chunk in iter_stations_svg(line_size, default_station_shape, points_by_color, stations, data_version):
+        svg_file.write(chunk.encode())
+    svg_file.write(b'\n')
 
 def find_squares(points_this_color, width=5, already_found=None):
 
-    """ Must be called before get_connected_points, because this is meant to
-        prevent recursion depth problems on maps with a lot of "terrain"
+    """ Originally meant to be called before get_connected_points, to
+        prevent recursion depth problems on maps with a lot of "terrain";
+        get_connected_points is no longer recursive, but squares are still a
+        compact way to draw large filled areas
 
         Returns two lists:
             a list of the outlining points of each square
@@ -584,8 +753,15 @@ def find_lines(points_this_color):
     """ Better drawing algorithm,
             returning a small number of lines,
             and still has fidelity with classic omnidirectional style
+
+        Returns the lines and singletons as sorted lists,
+            so they're always drawn in the same order
+            (whether from a set of points or an OccupancyGrid)
     """
 
+    if isinstance(points_this_color, OccupancyGrid):
+        return find_lines_in_grid(points_this_color)
+
     directions = 'E S NE SE' # Don't need to draw N, W, NW, SW
     skip_points = {d: set() for d in directions.split()}
 
@@ -617,11 +793,181 @@ def find_lines(points_this_color):
 
     # Some of the points that we thought were singletons at the time might not be,
     #   if we haven't processed those points yet
-    return lines, (singletons - not_singletons)
+    return sorted(lines), sorted(singletons - not_singletons)
+
+def find_lines_in_grid(grid):
+
+    """ Same as find_lines, but for an OccupancyGrid:
+            finds whole runs of points at a time with OccupancyGrid.runs()
+            instead of checking each point in each direction.
+
+        Every line find_lines draws is a maximal run in one direction,
+            starting from the run's first point in sorted order,
+            and a point is a singleton only if it isn't part of any run,
+            so this returns exactly the same sorted lists as find_lines.
+    """
+
+    cells = grid.cells
+    stride = grid.stride
+    size = len(cells)
+
+    # Don't need to draw N, W, NW, SW
+    steps = (
+        stride, # E
+        1, # S
+        stride - 1, # NE
+        stride + 1, # SE
+    )
+
+    lines = []
+    not_singletons = bytearray(size)
+
+    for step in steps:
+        for start, end in grid.runs(step):
+            run = slice(start, end + 1, step)
+            not_singletons[run] = b'\x01' * ((end - start) // step + 1)
+            x, y = divmod(start, stride)
+            x1, y1 = divmod(end, stride)
+            lines.append((x - 1, y - 1, x1 - 1, y1 - 1))
+
+    # The bytes are all 0 or 1, so bitwise operations on them as (very large) integers
+    #   work on every square at once.
+    singletons = int.from_bytes(cells, 'big') & ~int.from_bytes(not_singletons, 'big')
+
+    return sorted(lines), list(grid.points_at(singletons.to_bytes(size, 'big')))
+
+def get_shapes_cache_key(points_this_color):
+
+    """ Identifies a set of points (or an OccupancyGrid) by its content,
+            so the same points on any map share a cache key
+    """
+
+    if isinstance(points_this_color, OccupancyGrid):
+        digest = hashlib.sha256(points_this_color.cells).hexdigest()
+        return f'shapes:{RENDERER_VERSION}:{points_this_color.size}:{digest}'
+
+    digest = hashlib.sha256(repr(sorted(points_this_color)).encode()).hexdigest()
+    return f'shapes:{RENDERER_VERSION}:{digest}'
+
+def pack_shapes(lines, singletons):
+
+    """ Packs the lines and singletons from find_lines_cached
+            into two bytestrings of unsigned shorts
+            (coordinates are always less than MAX_MAP_SIZE),
+            keeping the order they're drawn in
+    """
+
+    return (
+        array.array('H', itertools.chain.from_iterable(lines)).tobytes(),
+        array.array('H', itertools.chain.from_iterable(singletons)).tobytes(),
+    )
+
+def unpack_shapes(packed):
+
+    """ Reverses pack_shapes
+    """
+
+    lines = array.array('H')
+    lines.frombytes(packed[0])
+    singletons = array.array('H')
+    singletons.frombytes(packed[1])
+    return list(zip(*[iter(lines)] * 4)), list(zip(*[iter(singletons)] * 2))
+
+def find_lines_cached(points_this_color):
+
+    """ find_lines, but cached by the content of points_this_color,
+            so re-drawing a map (or drawing an edited copy of one)
+            only needs to find the lines for the colors and width/styles that changed.
+
+        Returns the same sorted lists as find_lines,
+            so the SVG is drawn exactly the same
+            whether or not the shapes came from the cache.
+
+        Set settings.SHAPES_CACHE_TIMEOUT to 0 (or leave out the 'shapes' cache) to turn this off.
+    """
+
+    timeout = settings.SHAPES_CACHE_TIMEOUT
+    if not timeout or SHAPES_CACHE_ALIAS not in settings.CACHES:
+        return find_lines(points_this_color)
+
+    cache = caches[SHAPES_CACHE_ALIAS]
+    key = get_shapes_cache_key(points_this_color)
+    packed = cache.get(key)
+    if packed is not None:
+        return unpack_shapes(packed)
+
+    lines, singletons = find_lines(points_this_color)
+    packed = pack_shapes(lines, singletons)
+    if len(packed[0]) + len(packed[1]) < SHAPES_CACHE_MAX_BYTES:
+        cache.set(key, packed, timeout)
+    return lines, singletons
+
+def get_mapdata_as_lines(mapdata):
+
+    """ Given v2+ map data, return it with points_by_color
+            replaced by lines_by_color, which has the lines and singletons
+            (from find_lines) for each color and width/style
+            rather than every single point:
+
+                lines_by_color[color][width_style] = {
+                    'lines': [[x1, y1, x2, y2], ...],
+                    'points': [[x, y], ...],
+                }
+
+            For data_version 2, width_style is 'xys', same as in points_by_color.
+
+        Everything else in mapdata is left as-is.
+    """
+
+    highest_seen = 0
+    points_by_color = {}
+    for color, width_styles in mapdata['points_by_color'].items():
+        points_by_color[color] = {}
+        for width_style, xys in width_styles.items():
+            points = []
+            for x, column in xys.items():
+                x = XY_INTS.get(x)
+                if x is None:
+                    continue
+                for y, value in column.items():
+                    y = XY_INTS.get(y)
+                    if y is None or value != 1:
+                        continue
+                    points.append((x, y))
+                    if x > highest_seen:
+                        highest_seen = x
+                    if y > highest_seen:
+                        highest_seen = y
+            points_by_color[color][width_style] = points
+
+    # Same map size as sort_points_by_color, so the lines cached for drawing the SVG are reused
+    map_size = 80
+    for size in reversed(ALLOWED_MAP_SIZES):
+        if highest_seen < size:
+            map_size = size
+
+    lines_by_color = {}
+    for color, width_styles in points_by_color.items():
+        lines_by_color[color] = {}
+        for width_style, points in width_styles.items():
+            lines, singletons = find_lines_cached(OccupancyGrid(map_size, points))
+            lines_by_color[color][width_style] = {
+                'lines': list(lines),
+                'points': list(singletons),
+            }
+
+    data = {}
+    for key, value in mapdata.items():
+        if key == 'points_by_color':
+            data['lines_by_color'] = lines_by_color
+        else:
+            data[key] = value
+    return data
 
 def find_endpoint_of_line(x, y, points, direction):
 
-    """ Given x, y, and a set of coordinate pairs (points),
+    """ Given x, y, and a set of coordinate pairs (points)
+            or an OccupancyGrid,
         find the endpoint of the line originating at (x, y)
         for a given direction
     """
@@ -640,6 +986,29 @@ def find_endpoint_of_line(x, y, points, direction):
     dx = directions[direction]['dx']
     dy = directions[direction]['dy']
 
+    if isinstance(points, OccupancyGrid) and points.in_bounds(x, y):
+        # Step through the grid's cells directly instead of
+        #   building and hashing a tuple for every point;
+        #   the grid's empty border guarantees this stops in bounds
+        cells = points.cells
+        step = dx * points.stride + dy
+        index = points.index(x, y) + step
+
+        if not cells[index]:
+            return
+
+        (x1, y1) = (x, y)
+        while cells[index]:
+            (x1, y1) = (x1 + dx, y1 + dy)
+            between.append((x1, y1))
+            index += step
+
+        return {
+            'between': between,
+            'x1': x1,
+            'y1': y1,
+        }
+
     (x1, y1) = (x + dx, y + dy)
 
     if (x1, y1) not in points:
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0033_savedmap_browse_visible_and_more'),
+        ('taggit', '0006_rename_taggeditem_content_type_object_id_taggit_tagg_content_8fc721_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='render_key',
+            field=models.CharField(blank=True, default='', max_length=80),
+        ),
+        migrations.AddField(
+            model_name='savedmap',
+            name='svg_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='savedmap',
+            index=models.Index(fields=['render_key'], name='map_saver_s_render__abe99c_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0034_savedmap_render_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='packed_data',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
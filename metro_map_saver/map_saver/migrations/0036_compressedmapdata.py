@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0035_savedmap_packed_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompressedMapData',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(blank=True, default='', max_length=16)),
+                ('encoding', models.CharField(max_length=16)),
+                ('body', models.BinaryField()),
+                ('saved_map', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compressed_data', to='map_saver.savedmap')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('saved_map', 'format', 'encoding'), name='unique_compressed_map_data')],
+            },
+        ),
+    ]
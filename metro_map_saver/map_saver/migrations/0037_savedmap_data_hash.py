@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0036_compressedmapdata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='data_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:13
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0037_savedmap_data_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(choices=[('images', 'Generate images and thumbnails'), ('suggest_city', 'Suggest a city')], max_length=32)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('saved_map', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='map_saver.savedmap')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['run_after'], name='map_saver_m_run_aft_5b5986_idx')],
+                'constraints': [models.UniqueConstraint(fields=('saved_map', 'task'), name='unique_map_job')],
+            },
+        ),
+    ]
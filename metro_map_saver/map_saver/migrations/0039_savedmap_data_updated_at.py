@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0038_mapjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='data_updated_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
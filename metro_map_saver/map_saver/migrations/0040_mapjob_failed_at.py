@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 20:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0039_savedmap_data_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapjob',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
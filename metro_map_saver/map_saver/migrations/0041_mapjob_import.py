@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 21:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0040_mapjob_failed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mapjob',
+            name='import_file',
+            field=models.FileField(blank=True, null=True, upload_to='imports/'),
+        ),
+        migrations.AlterField(
+            model_name='mapjob',
+            name='saved_map',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='map_saver.savedmap'),
+        ),
+        migrations.AlterField(
+            model_name='mapjob',
+            name='task',
+            field=models.CharField(choices=[('images', 'Generate images and thumbnails'), ('suggest_city', 'Suggest a city'), ('import', 'Import maps')], max_length=32),
+        ),
+    ]
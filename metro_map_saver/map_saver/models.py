@@ -1,16 +1,23 @@
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import File
 from django.core.files.images import ImageFile
 from django.db import models
+from django.utils import timezone
 
 from citysuggester.utils import suggest_city
 from taggit.managers import TaggableManager
 
 import datetime
+import gzip
+import hashlib
 import json
-import subprocess
+import logging
+import os
+import shutil
+import tempfile
 import time
 
+logger = logging.getLogger(__name__)
 
 PUBLICLY_VISIBLE_TAGS = [
     'real',
@@ -46,6 +53,13 @@ def get_image_filepath(instance, original):
     filename = f'{instance.urlhash}.{ftype}'
     return f'images/{str(thousand)}/{filename}'
 
+def get_data_filepath(instance, compressed=False):
+    thousand = instance.pk // 1000
+    filename = f'{instance.urlhash}.json'
+    if compressed:
+        filename = f'{filename}.gz'
+    return f'data/{str(thousand)}/{filename}'
+
 class SavedMap(models.Model):
 
     """ Saves map data and its corresponding urlhash together so that maps can be easily shared
@@ -55,6 +69,13 @@ class SavedMap(models.Model):
     mapdata = models.TextField(blank=True) # Consider: Delete after migration to v2 representation
     # v2+ representation of map data
     data = models.JSONField(default=dict, blank=True)
+    # sha256 of the map data as canonical JSON, which the urlhash is made from;
+    #   unique, so saving the same map twice (even at the same time) only stores it once.
+    #   Maps saved before this was added don't have one.
+    data_hash = models.CharField(max_length=64, null=True, blank=True, unique=True, editable=False)
+    # .data, packed into a much smaller binary format (see mapdata_codec);
+    #   when it's set, loading a map reads this instead of .data
+    packed_data = models.BinaryField(null=True, blank=True, editable=False)
     # gallery_visible: should this be shown in the default view of the Admin Gallery?
     #   Essentially -- which maps have I already reviewed?
     gallery_visible = models.BooleanField(default=True, help_text='Should this be shown in the default view of the Admin Gallery?')
@@ -71,6 +92,9 @@ class SavedMap(models.Model):
     stations = models.TextField(blank=True, default='')
     station_count = models.IntegerField(default=-1)
     created_at = models.DateTimeField(auto_now_add=True)
+    # When the map data was last changed after it was saved (see set_data), if ever;
+    #   /load/ builds its ETag and Last-Modified from this without loading the data
+    data_updated_at = models.DateTimeField(null=True, blank=True, editable=False)
 
     likes = models.IntegerField(default=0)
     dislikes = models.IntegerField(default=0)
@@ -90,6 +114,13 @@ class SavedMap(models.Model):
 
     map_size = models.IntegerField(default=-1)
 
+    # What the images were last drawn from (see get_render_key),
+    #   so they're only re-drawn when the map data or the renderer changes
+    render_key = models.CharField(max_length=80, blank=True, default='')
+    # Hash of the SVGs as they were last drawn,
+    #   so re-drawing a map whose SVGs came out the same can skip the PNGs
+    svg_hash = models.CharField(max_length=64, blank=True, default='')
+
     city = models.ForeignKey(
         'City',
         null=True,
@@ -167,6 +198,57 @@ class SavedMap(models.Model):
 
         return stations
 
+    @staticmethod
+    def get_legacy_urlhashes(legacy_urlhashes):
+
+        """ Of legacy_urlhashes (see validator.get_legacy_urlhash),
+                the set of those that maps saved before .data_hash was added still have,
+                so saving one of those again doesn't store it twice.
+
+            Once oneoff_backfill_data_hash has been run, those maps have a .data_hash
+                and are found by it instead; turn off settings.LEGACY_URLHASH_LOOKUP then.
+        """
+
+        if not settings.LEGACY_URLHASH_LOOKUP:
+            return set()
+
+        return set(SavedMap.objects.filter(
+            urlhash__in=legacy_urlhashes,
+            data_hash=None,
+        ).values_list('urlhash', flat=True))
+
+    @staticmethod
+    def get_map_details(cleaned_data):
+
+        """ The fields to create a new SavedMap with,
+                given the cleaned_data of a valid CreateMapForm
+        """
+
+        from citysuggester.utils import MINIMUM_STATION_OVERLAP
+
+        mapdata = cleaned_data['mapdata']
+        data_version = cleaned_data['data_version']
+        stations = SavedMap.get_stations(mapdata, data_version)
+        map_details = {
+            'urlhash': cleaned_data['urlhash'],
+            'data_hash': cleaned_data['data_hash'],
+            'naming_token': cleaned_data['naming_token'],
+            'station_count': len(stations),
+            'stations': ','.join(stations),
+            'map_size': mapdata.get('global', {}).get('map_size', -1) or -1,
+        }
+        if data_version >= 2:
+            map_details['data'] = mapdata
+            map_details['packed_data'] = SavedMap.pack_data(mapdata)
+        else:
+            map_details['mapdata'] = json.dumps(mapdata)
+
+        if len(stations) < MINIMUM_STATION_OVERLAP:
+            # Don't need to check these ever
+            map_details['suggested_city_overlap'] = -2
+
+        return map_details
+
     def convert_mapdata_v1_to_v2(self):
 
         """ Convert mapdata (classic) from v1 to v2
@@ -203,8 +285,9 @@ class SavedMap(models.Model):
         for index, station in enumerate(mapdata_v2['stations']):
             mapdata_v2['stations'][index].pop('lines', None)
 
-        self.data = self.data_optimized_for_js_performance(mapdata_v2)
+        self.set_data(self.data_optimized_for_js_performance(mapdata_v2))
         self.save()
+        self.try_write_data_files()
 
     def data_optimized_for_js_performance(self, mapdata_v2):
 
@@ -262,21 +345,192 @@ class SavedMap(models.Model):
 
         return mapdata_v2
 
-    def generate_images(self):
+    @staticmethod
+    def pack_data(data):
+
+        """ Returns data packed for .packed_data,
+                or None if it can't be packed losslessly
+        """
+
+        from .mapdata_codec import pack_mapdata
+
+        try:
+            return pack_mapdata(data)
+        except ValueError:
+            return None
+
+    def set_data(self, data):
+
+        """ Set .data, and re-pack .packed_data to match.
+
+            Also marks when the data changed (for /load/'s ETag),
+                and clears any stored /load/ responses for this map,
+                which would otherwise still send the old data;
+                call try_write_data_files() after saving to update its data files.
+        """
+
+        self.data = data
+        self.packed_data = self.pack_data(data)
+        if self.pk:
+            self.data_updated_at = timezone.now()
+            self.compressed_data.all().delete()
+
+    def get_data(self):
+
+        """ Returns the v2+ map data,
+                unpacked from .packed_data if it's set (so .data can be deferred)
+        """
+
+        from .mapdata_codec import unpack_mapdata
+
+        if self.packed_data:
+            return unpack_mapdata(self.packed_data)
+        return self.data
+
+    def get_data_json(self):
+
+        """ The map data as JSON, exactly as /load/ sends it
+        """
+
+        data = self.get_data()
+        if data:
+            return json.dumps(data)
+        return self.mapdata or '{}'
+
+    def write_data_files(self):
+
+        """ Writes the map data to static files under MEDIA_ROOT
+                (see get_data_filepath), both as-is and gzipped,
+                so it can be served without Django or the database.
+
+            Each file is written to a temporary file first and then moved into place,
+                so a partly-written file is never served.
+        """
+
+        content = self.get_data_json().encode('utf-8')
+        for compressed in (False, True):
+            path = os.path.join(settings.MEDIA_ROOT, get_data_filepath(self, compressed))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+                try:
+                    if compressed:
+                        # mtime=0 so the same data always gives the same file
+                        f.write(gzip.compress(content, mtime=0))
+                    else:
+                        f.write(content)
+                    f.close()
+                    os.chmod(f.name, 0o644)
+                    os.replace(f.name, path)
+                except OSError:
+                    os.unlink(f.name)
+                    raise
+
+    def try_write_data_files(self):
+
+        """ Like write_data_files, but if the files can't be written,
+                logs it rather than failing; /load/ still serves the data.
+        """
+
+        if not settings.WRITE_MAP_DATA_FILES:
+            return False
+
+        try:
+            self.write_data_files()
+        except OSError as exc:
+            logger.error(f'[ERROR] [DATAFILES] Could not write data files for #{self.pk} ({self.urlhash}): {exc}')
+            return False
+        return True
+
+    def get_render_key(self):
+
+        """ Identifies everything the images are drawn from:
+                the renderer version, the settings that choose how
+                SVGs and PNGs are drawn, and the map data.
+
+            Maps with the same render key draw identical images.
+        """
+
+        from .mapdata_optimizer import RENDERER_VERSION
+        from .validator import canonical_json
+
+        if self.data:
+            mapdata = canonical_json(self.data)
+        else:
+            mapdata = self.mapdata
+        rendered_by = canonical_json([
+            getattr(settings, 'SVG_RENDERER', None),
+            getattr(settings, 'PNG_RASTERIZER', None),
+            settings.PNG_CONVERSION_ARGS,
+            settings.PNG_CONVERSION_ARGS_THUMBNAIL,
+        ])
+        data_hash = hashlib.sha256(f'{rendered_by}\n{mapdata}'.encode('utf-8')).hexdigest()
+        return f'{RENDERER_VERSION}:{data_hash}'
+
+    def has_images(self):
+
+        """ Whether all four image files exist
+        """
+
+        for image in (self.thumbnail_svg, self.thumbnail_png, self.svg, self.png):
+            if not image or not image.storage.exists(image.name):
+                return False
+        return True
+
+    def copy_images_from(self, other):
+
+        """ Use copies of another map's images, which must have the same render key
+        """
+
+        with other.thumbnail_svg.open('rb') as thumbnail_svg_file, other.svg.open('rb') as svg_file:
+            self.thumbnail_svg = File(thumbnail_svg_file, name=f"t{self.urlhash}.svg")
+            self.svg = File(svg_file, name=f"{self.urlhash}.svg")
+            self.save()
+
+        thumbnail_png_filename = self.thumbnail_svg.path.removesuffix('.svg') + '.png'
+        png_filename = self.svg.path.removesuffix('.svg') + '.png'
+        shutil.copyfile(other.thumbnail_png.path, thumbnail_png_filename)
+        shutil.copyfile(other.png.path, png_filename)
+
+        self.thumbnail_png = thumbnail_png_filename.removeprefix(settings.MEDIA_ROOT)
+        self.png = png_filename.removeprefix(settings.MEDIA_ROOT)
+        self.render_key = other.render_key
+        self.svg_hash = other.svg_hash
+        self.save()
+
+    def generate_images(self, force=False):
 
         """ Generates full-size images and thumbnails
                 (PNG and SVG for both)
+
+            Unless force is set, skips maps whose images
+                were already drawn from the same render key,
+                and copies the images of any other map with the same render key.
+
+            If the SVGs come out the same as the ones already drawn,
+                they're left as-is and the PNGs aren't re-drawn.
         """
 
         from .mapdata_optimizer import (
-            add_stations_to_svg,
-            find_lines,
+            find_lines_cached,
             sort_points_by_color,
-            get_svg_from_shapes_by_color,
+            write_svgs,
         )
+        from .occupancy import get_occupancy_grids
+        from .rasterizer import get_rasterizer
 
         t0 = time.time()
 
+        render_key = self.get_render_key()
+        if not force:
+            now = datetime.datetime.now().replace(microsecond=0)
+            if render_key == self.render_key and self.has_images():
+                return f'[{now}] Images for #{self.pk} ({self.created_at.date()}) are already up to date.'
+
+            for other in SavedMap.objects.filter(render_key=render_key).exclude(pk=self.pk).exclude(svg_hash=''):
+                if other.has_images():
+                    self.copy_images_from(other)
+                    return f'[{now}] Copied images for #{self.pk} ({self.created_at.date()}) from #{other.pk}, which has the same map data.'
+
         mapdata = self.data or json.loads(self.mapdata)
         data_version = mapdata['global'].get('data_version', 1)
 
@@ -288,42 +542,61 @@ class SavedMap(models.Model):
             default_station_shape = 'wmata'
 
         points_by_color, stations, map_size = sort_points_by_color(mapdata, data_version=data_version)
+        # Occupancy grids are much smaller than sets of points for dense colors,
+        #   and much faster for finding lines and line directions;
+        #   sparse colors stay as sets, which are smaller and faster for them
+        points_by_color = get_occupancy_grids(points_by_color, map_size, data_version)
         shapes_by_color = {}
         if data_version <= 2:
             for color in points_by_color:
                 points_this_color = points_by_color[color]['xy']
 
-                lines, singletons = find_lines(points_this_color)
+                lines, singletons = find_lines_cached(points_this_color)
                 shapes_by_color[color] = {'lines': lines, 'points': singletons}
         elif data_version >= 3:
             for color in points_by_color:
                 shapes_by_color[color] = {}
                 for width_style in points_by_color[color]:
                     points_this_color_width_style = points_by_color[color][width_style]
-                    lines, singletons = find_lines(points_this_color_width_style)
+                    lines, singletons = find_lines_cached(points_this_color_width_style)
                     shapes_by_color[color][width_style] = {'lines': lines, 'points': singletons}
 
-        thumbnail_svg = get_svg_from_shapes_by_color(shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations, data_version)
-
-        thumbnail_svg_file = ContentFile(thumbnail_svg, name=f"t{self.urlhash}.svg")
-        self.thumbnail_svg = thumbnail_svg_file
-
-        svg = add_stations_to_svg(thumbnail_svg, line_size, default_station_shape, points_by_color, stations, data_version)
-        svg_file = ContentFile(svg, name=f"{self.urlhash}.svg")
-        self.svg = svg_file
-        self.save()
+        # Stream both SVGs to temporary files as they're drawn,
+        #   rather than building them in memory
+        with tempfile.TemporaryFile() as thumbnail_svg_file, tempfile.TemporaryFile() as svg_file:
+            write_svgs(thumbnail_svg_file, svg_file, shapes_by_color, map_size, line_size, default_station_shape, points_by_color, stations, data_version)
+
+            svg_hash = hashlib.sha256()
+            for f in (thumbnail_svg_file, svg_file):
+                f.seek(0)
+                for chunk in iter(lambda: f.read(65536), b''):
+                    svg_hash.update(chunk)
+                f.seek(0)
+            svg_hash = svg_hash.hexdigest()
+
+            if svg_hash == self.svg_hash and self.has_images():
+                self.render_key = render_key
+                self.save(update_fields=['render_key'])
+                now = datetime.datetime.now().replace(microsecond=0)
+                return f'[{now}] Images for #{self.pk} ({self.created_at.date()}) are unchanged ({time.time() - t0:.2f}s to check).'
+
+            self.thumbnail_svg = File(thumbnail_svg_file, name=f"t{self.urlhash}.svg")
+            self.svg = File(svg_file, name=f"{self.urlhash}.svg")
+            self.save()
 
         t1 = time.time()
 
         thumbnail_png_filename = self.thumbnail_svg.path.removesuffix('.svg') + '.png'
         png_filename = self.svg.path.removesuffix('.svg') + '.png'
 
-        subprocess.run([settings.PNG_CONVERSION_APP_PATH, *settings.PNG_CONVERSION_ARGS_THUMBNAIL, thumbnail_png_filename, self.thumbnail_svg.path], capture_output=True)
-
-        subprocess.run([settings.PNG_CONVERSION_APP_PATH, *settings.PNG_CONVERSION_ARGS, png_filename, self.svg.path], capture_output=True)
+        rasterizer = get_rasterizer()
+        rasterizer.rasterize(self.thumbnail_svg.path, thumbnail_png_filename, thumbnail=True)
+        rasterizer.rasterize(self.svg.path, png_filename)
 
         self.thumbnail_png = thumbnail_png_filename.removeprefix(settings.MEDIA_ROOT)
         self.png = png_filename.removeprefix(settings.MEDIA_ROOT)
+        self.render_key = render_key
+        self.svg_hash = svg_hash
         self.save()
 
         t2 = time.time()
@@ -341,11 +614,49 @@ class SavedMap(models.Model):
     def save(self, *args, **kwargs):
         self.name = self.name.strip()
         self.thumbnail = self.thumbnail.strip()
+
+        # .data can be changed without set_data (like in the Django admin);
+        #   if it no longer matches .packed_data, /load/ would keep sending the old map
+        data_changed = self.repack_if_changed(kwargs.get('update_fields'))
+        if data_changed and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'packed_data', 'data_updated_at'}
+
         super().save(*args, **kwargs)
 
+        if data_changed:
+            self.try_write_data_files()
+
+    def repack_if_changed(self, update_fields=None):
+
+        """ If .data has changed since it was packed,
+                re-pack it (clearing stored /load/ responses) with set_data.
+
+            Returns whether it had changed
+        """
+
+        if update_fields is not None and 'data' not in update_fields:
+            return False
+        if {'data', 'packed_data'} & self.get_deferred_fields():
+            return False
+        # Maps are packed as they're created (see get_map_details)
+        if self._state.adding and self.packed_data is not None:
+            return False
+        # A packed map doesn't need .data; clearing it isn't an edit
+        if not self.data:
+            return False
+
+        packed_data = self.pack_data(self.data)
+        current = bytes(self.packed_data) if self.packed_data is not None else None
+        if packed_data == current:
+            return False
+
+        self.set_data(self.data)
+        return not self._state.adding
+
     DEFER_FIELDS = (
         'mapdata',
         'data',
+        'packed_data',
         'thumbnail',
         'stations',
     )
@@ -368,6 +679,7 @@ class SavedMap(models.Model):
             models.Index(fields=["png"]),
             models.Index(fields=["thumbnail_svg"]),
             models.Index(fields=["thumbnail_png"]),
+            models.Index(fields=["render_key"]),
         ]
 
         permissions = (
@@ -402,6 +714,134 @@ class IdentifyMap(models.Model):
     def __str__(self):
         return f'Identification #{self.id} for Map #{self.saved_map.id} ({self.saved_map.urlhash})'
 
+class CompressedMapData(models.Model):
+
+    """ The body of a /load/ response for a map, compressed once
+            and stored so it can be sent as-is every time after that
+            (maps don't change once they're saved)
+    """
+
+    saved_map = models.ForeignKey(
+        'SavedMap',
+        on_delete=models.CASCADE,
+        related_name='compressed_data',
+    )
+    # '' for the default format; see MapDataView.get
+    format = models.CharField(max_length=16, blank=True, default='')
+    # The Content-Encoding: 'gzip' or 'br'
+    encoding = models.CharField(max_length=16)
+    body = models.BinaryField()
+
+    def __str__(self):
+        return f'{self.encoding} /load/ response ({self.format or "default"}) for Map #{self.saved_map_id}'
+
+    class Meta:
+
+        constraints = [
+            models.UniqueConstraint(fields=['saved_map', 'format', 'encoding'], name='unique_compressed_map_data'),
+        ]
+
+class MapJob(models.Model):
+
+    """ Work to be done for a map after it's saved
+            (drawing its images, suggesting a city),
+            queued here so it can be done right away by run_jobs
+            rather than found later by polling the whole SavedMap table;
+            also imports of many maps at once (see MapImportView), which have no map
+
+        A job is deleted once it's done; one that fails is retried later,
+            up to MAX_ATTEMPTS times. After that it's marked failed (.failed_at)
+            and kept, but never run again unless it's retried (see run_jobs --failed).
+    """
+
+    IMAGES = 'images'
+    SUGGEST_CITY = 'suggest_city'
+    IMPORT = 'import'
+    TASK_CHOICES = (
+        (IMAGES, 'Generate images and thumbnails'),
+        (SUGGEST_CITY, 'Suggest a city'),
+        (IMPORT, 'Import maps'),
+    )
+
+    MAX_ATTEMPTS = 5
+
+    saved_map = models.ForeignKey(
+        'SavedMap',
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='jobs',
+    )
+    task = models.CharField(max_length=32, choices=TASK_CHOICES)
+    # For IMPORT: the newline-delimited JSON to import; deleted once it's imported
+    import_file = models.FileField(upload_to='imports/', null=True, blank=True)
+    # Not run before this; pushed back while a worker has the job, and after it fails
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    # When it was given up on, after MAX_ATTEMPTS
+    failed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def enqueue(cls, saved_map, tasks=None):
+
+        """ Queue up tasks (by default, all of them that apply) for a saved map;
+                any that are already queued for it aren't queued twice
+        """
+
+        from citysuggester.utils import MINIMUM_STATION_OVERLAP
+
+        if tasks is None:
+            tasks = [cls.IMAGES]
+            # Maps with too few stations are never suggested a city
+            if saved_map.station_count > MINIMUM_STATION_OVERLAP:
+                tasks.append(cls.SUGGEST_CITY)
+
+        cls.objects.bulk_create(
+            [cls(saved_map=saved_map, task=task) for task in tasks],
+            ignore_conflicts=True,
+        )
+
+    def run(self):
+
+        """ Do the work, returning what to output
+        """
+
+        saved_map = self.saved_map
+        if self.task == self.IMAGES:
+            return saved_map.generate_images()
+        elif self.task == self.SUGGEST_CITY:
+            city, overlap = SavedMap.get_suggested_city(saved_map.stations.lower().split(','))
+            # See the suggest_city command for why it's -2
+            saved_map.suggested_city = city
+            saved_map.suggested_city_overlap = overlap if city else -2
+            saved_map.save(update_fields=['suggested_city', 'suggested_city_overlap'])
+            if city:
+                return f'#{saved_map.id}: {saved_map.urlhash} might be {city} ({overlap} stations in common)'
+            return f'#{saved_map.id}: {saved_map.urlhash} did not match any cities currently in the system.'
+        elif self.task == self.IMPORT:
+            from .importer import MapImport
+            with self.import_file.open('rb') as import_file:
+                map_import = MapImport().import_lines(import_file)
+            self.import_file.delete(save=False)
+            return map_import.summary()
+        raise ValueError(f'Unknown task: {self.task}')
+
+    def __str__(self):
+        if self.task == self.IMPORT:
+            return f'{self.task} of {self.import_file.name}'
+        return f'{self.task} for Map #{self.saved_map_id}'
+
+    class Meta:
+
+        constraints = [
+            models.UniqueConstraint(fields=['saved_map', 'task'], name='unique_map_job'),
+        ]
+        indexes = [
+            models.Index(fields=['run_after']),
+        ]
+
 class City(models.Model):
 
 
@@ -0,0 +1,167 @@
+import re
+
+# Two or more occupied squares in a row
+RUN = re.compile(b'\x01{2,}')
+
+# An OccupancyGrid costs the same no matter how few points it has;
+#   below this share of the map's squares, a set of points is both smaller and faster
+MIN_GRID_DENSITY = 1 / 64
+
+
+class OccupancyGrid:
+
+    """ A compact, fixed-size stand-in for a set of (x, y) coordinate pairs
+            on a map of a given map_size.
+
+        One byte per grid square rather than a tuple per point,
+            so a single color on a 360x360 map takes ~130KB no matter
+            how many points it has.
+
+        Supports the subset of the set interface that the optimizer uses
+            (in, len, iteration in sorted order), so it can be passed
+            anywhere a set of points is expected.
+
+        The grid is padded with an empty border one square wide,
+            so any in-bounds point's eight neighbors can be read
+            without a bounds check, and walking in any direction
+            from an in-bounds point always stops before leaving the grid.
+    """
+
+    __slots__ = ('size', 'stride', 'cells', 'count')
+
+    def __init__(self, map_size, points=()):
+        self.size = map_size
+        self.stride = map_size + 2
+        self.cells = bytearray(self.stride * self.stride)
+        self.count = 0
+        for point in points:
+            self.add(point)
+
+    def index(self, x, y):
+
+        """ Position of x, y in self.cells
+        """
+
+        return (x + 1) * self.stride + (y + 1)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.size and 0 <= y < self.size
+
+    def add(self, point):
+        x, y = point
+        if not self.in_bounds(x, y):
+            raise ValueError(f'{point} is outside of a {self.size}x{self.size} grid')
+        index = self.index(x, y)
+        if not self.cells[index]:
+            self.cells[index] = 1
+            self.count += 1
+
+    def __contains__(self, point):
+        x, y = point
+        if not self.in_bounds(x, y):
+            return False
+        return self.cells[self.index(x, y)] == 1
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __iter__(self):
+
+        """ Yields each point in the same order as sorted() would
+        """
+
+        return self.points_at(self.cells)
+
+    def runs(self, step):
+
+        """ Finds every maximal run of two or more occupied squares
+                in one direction, where step is the distance in self.cells
+                between one square and the next square in that direction
+                (see find_lines_in_grid).
+
+            Rather than walking point by point, this takes every row, column,
+                or diagonal at once as a strided slice of self.cells and
+                scans it with a regular expression.
+                The empty border means that a run never wraps around
+                from the end of one row, column, or diagonal to the start of the next.
+
+            Returns a list of (start, end) indexes into self.cells,
+                sorted by start.
+        """
+
+        cells = bytes(self.cells)
+        runs = []
+
+        if step == 1:
+            slices = [(0, cells)]
+        else:
+            slices = [(offset, cells[offset::step]) for offset in range(step)]
+
+        for offset, line in slices:
+            for match in RUN.finditer(line):
+                runs.append((
+                    offset + match.start() * step,
+                    offset + (match.end() - 1) * step,
+                ))
+
+        if step != 1:
+            runs.sort()
+
+        return runs
+
+    def points_at(self, cells):
+
+        """ Yields the point for every occupied square in cells,
+                a bytes-like object the same shape as self.cells,
+                in the same order as sorted() would
+        """
+
+        stride = self.stride
+        index = cells.find(1)
+        while index != -1:
+            x, y = divmod(index, stride)
+            yield (x - 1, y - 1)
+            index = cells.find(1, index + 1)
+
+    def __repr__(self):
+        return f'<OccupancyGrid {self.size}x{self.size}: {self.count} points>'
+
+
+def use_occupancy_grid(points, map_size):
+
+    """ Whether points are dense enough on a map of map_size
+            to be worth an OccupancyGrid rather than a set (see MIN_GRID_DENSITY)
+    """
+
+    return len(points) >= MIN_GRID_DENSITY * (map_size + 2) ** 2
+
+
+def get_occupancy_grids(points_by_color, map_size, data_version=3):
+
+    """ Given points_by_color from sort_points_by_color,
+            return the same structure with each set of points
+            that's dense enough (see use_occupancy_grid)
+            replaced by an OccupancyGrid; sparser ones are left as sets.
+
+        For data_version <= 2, only the 'xy' key is converted,
+            since 'x' and 'y' aren't coordinate pairs.
+    """
+
+    def to_grid(points):
+        if use_occupancy_grid(points, map_size):
+            return OccupancyGrid(map_size, points)
+        return points
+
+    grids = {}
+    for color in points_by_color:
+        if data_version <= 2:
+            grids[color] = {'xy': to_grid(points_by_color[color]['xy'])}
+        else:
+            grids[color] = {
+                width_style: to_grid(points)
+                for width_style, points in points_by_color[color].items()
+            }
+    return grids
@@ -0,0 +1,222 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+import atexit
+import os
+import select
+import shutil
+import subprocess
+import time
+
+
+def get_export_size(args):
+
+    """ Given PNG_CONVERSION_ARGS or PNG_CONVERSION_ARGS_THUMBNAIL,
+            which are command-line arguments like
+            ['-w', '1600', '-h', '1600', '--export-filename'],
+            return the (width, height) they ask for.
+
+        Either may be None if it isn't set.
+    """
+
+    width = height = None
+    for flag, value in zip(args, args[1:]):
+        if flag in ('-w', '--export-width'):
+            width = int(value)
+        elif flag in ('-h', '--export-height'):
+            height = int(value)
+    return width, height
+
+
+class SubprocessRasterizer:
+
+    """ Launches settings.PNG_CONVERSION_APP_PATH once per PNG.
+
+        Simple, but most of the time is spent starting the app up,
+            not drawing the PNG.
+    """
+
+    def rasterize(self, svg_path, png_path, thumbnail=False):
+        args = settings.PNG_CONVERSION_ARGS_THUMBNAIL if thumbnail else settings.PNG_CONVERSION_ARGS
+        subprocess.run([settings.PNG_CONVERSION_APP_PATH, *args, png_path, svg_path], capture_output=True)
+
+    def close(self):
+        pass
+
+
+class InkscapeShellRasterizer:
+
+    """ Keeps a single `inkscape --shell` running
+            and feeds it one SVG after another,
+            so Inkscape only has to start up once per process
+            instead of twice per map.
+
+        Each PNG is one line of actions; Inkscape prints its prompt
+            once it's finished with the line, so rasterize()
+            doesn't return until the PNG has been written.
+
+        If the shell exits (or this process was forked from the one that started it),
+            a new one is started on the next call to rasterize().
+            So is one that takes longer than settings.PNG_CONVERSION_TIMEOUT,
+            since it's killed rather than left to hang whatever is waiting on it.
+    """
+
+    PROMPT = b'> '
+
+    def __init__(self):
+        self.process = None
+        self.pid = None
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [settings.PNG_CONVERSION_APP_PATH, '--shell'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self.pid = os.getpid()
+        self.wait_for_prompt()
+
+    def is_running(self):
+        return self.process is not None and self.pid == os.getpid() and self.process.poll() is None
+
+    def wait_for_prompt(self):
+
+        """ Read everything the shell writes until it's ready for the next line,
+                killing it if that takes longer than PNG_CONVERSION_TIMEOUT
+        """
+
+        timeout = getattr(settings, 'PNG_CONVERSION_TIMEOUT', 120)
+        deadline = time.monotonic() + timeout
+        output = b''
+        fd = self.process.stdout.fileno()
+        while not output.endswith(self.PROMPT):
+            ready, _, _ = select.select([fd], [], [], max(deadline - time.monotonic(), 0))
+            if not ready:
+                self.kill()
+                raise RuntimeError(f'{settings.PNG_CONVERSION_APP_PATH} --shell timed out after {timeout}s')
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                self.close()
+                raise RuntimeError(f'{settings.PNG_CONVERSION_APP_PATH} --shell exited unexpectedly')
+            output += chunk
+        return output
+
+    def rasterize(self, svg_path, png_path, thumbnail=False):
+        if not self.is_running():
+            self.start()
+
+        width, height = get_export_size(settings.PNG_CONVERSION_ARGS_THUMBNAIL if thumbnail else settings.PNG_CONVERSION_ARGS)
+        actions = [f'file-open:{svg_path}']
+        if width:
+            actions.append(f'export-width:{width}')
+        if height:
+            actions.append(f'export-height:{height}')
+        actions.extend([
+            f'export-filename:{png_path}',
+            'export-do',
+            'file-close',
+        ])
+
+        try:
+            self.process.stdin.write(';'.join(actions).encode() + b'\n')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            self.close()
+            raise RuntimeError(f'{settings.PNG_CONVERSION_APP_PATH} --shell exited unexpectedly')
+        self.wait_for_prompt()
+
+    def kill(self):
+        if self.process is not None and self.pid == os.getpid():
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def close(self):
+        if self.process is None or self.pid != os.getpid():
+            self.process = None
+            return
+
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b'quit\n')
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (BrokenPipeError, subprocess.TimeoutExpired):
+                self.kill()
+        self.process = None
+
+
+class CairoSVGRasterizer:
+
+    """ Draws PNGs in this process with CairoSVG (an optional dependency),
+            so nothing needs to be started up at all.
+
+        Used as a fallback when PNG_CONVERSION_APP_PATH isn't available.
+    """
+
+    def __init__(self):
+        try:
+            import cairosvg
+        except ImportError:
+            raise ImproperlyConfigured('PNG_RASTERIZER is "cairosvg" but cairosvg is not installed.')
+        self.cairosvg = cairosvg
+
+    def rasterize(self, svg_path, png_path, thumbnail=False):
+        width, height = get_export_size(settings.PNG_CONVERSION_ARGS_THUMBNAIL if thumbnail else settings.PNG_CONVERSION_ARGS)
+        self.cairosvg.svg2png(url=svg_path, write_to=png_path, output_width=width, output_height=height)
+
+    def close(self):
+        pass
+
+
+RASTERIZERS = {
+    'subprocess': SubprocessRasterizer,
+    'inkscape-shell': InkscapeShellRasterizer,
+    'cairosvg': CairoSVGRasterizer,
+}
+
+_rasterizer = None
+
+
+def get_rasterizer():
+
+    """ Returns the rasterizer for settings.PNG_RASTERIZER,
+            shared by every map drawn in this process.
+
+        If PNG_RASTERIZER needs PNG_CONVERSION_APP_PATH
+            but it isn't installed, fall back to CairoSVG if that is.
+    """
+
+    global _rasterizer
+
+    if _rasterizer is None:
+        name = getattr(settings, 'PNG_RASTERIZER', 'subprocess')
+        if name not in RASTERIZERS:
+            raise ImproperlyConfigured(f'Unknown PNG_RASTERIZER "{name}"; choose from: {", ".join(RASTERIZERS)}')
+
+        if name != 'cairosvg' and not shutil.which(settings.PNG_CONVERSION_APP_PATH):
+            try:
+                _rasterizer = CairoSVGRasterizer()
+            except ImproperlyConfigured:
+                pass
+
+        if _rasterizer is None:
+            _rasterizer = RASTERIZERS[name]()
+
+    return _rasterizer
+
+
+def close_rasterizer():
+
+    """ Stop any converter process that get_rasterizer() started
+    """
+
+    global _rasterizer
+
+    if _rasterizer is not None:
+        _rasterizer.close()
+        _rasterizer = None
+
+
+atexit.register(close_rasterizer)
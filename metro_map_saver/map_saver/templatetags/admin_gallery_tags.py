@@ -1,6 +1,6 @@
 from django import template
 from map_saver.models import SavedMap
-from citysuggester.models import TravelSystem
+from citysuggester.utils import get_station_count
 
 register = template.Library()
 
@@ -42,4 +42,4 @@ def stations_in_travelsystem(name):
     """ Use to get a count of how many stations
         there are in a given TravelSystem
     """
-    return TravelSystem.objects.get(name__startswith=name)._station_count()
+    return get_station_count(name)
@@ -3,6 +3,7 @@ from django.conf import settings
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 
+from map_saver.occupancy import OccupancyGrid
 from map_saver.validator import (
     ALLOWED_ORIENTATIONS,
     ALLOWED_LINE_STYLES,
@@ -36,8 +37,35 @@ TWOTONE_LINESTYLES = [
     'stripes',
 ]
 
+def get_station_index(stations):
+
+    """ Index the stations by their coordinates, once per map,
+            so finding a station's neighbors is O(1) instead of
+            a scan through every station on the map.
+
+        'connecting': coordinates of every station eligible to connect
+            (see ALLOWED_CONNECTING_STATIONS)
+        'london': coordinates of every London-style transfer station
+    """
+
+    station_index = {
+        'connecting': set(),
+        'london': set(),
+    }
+
+    default_style = list(ALLOWED_STATION_STYLES.keys())[0]
+    for station in stations:
+        xy = (station['xy'][0], station['xy'][1])
+        style = station.get('style', default_style)
+        if style in ALLOWED_CONNECTING_STATIONS:
+            station_index['connecting'].add(xy)
+        elif style == 'london' and station.get('transfer'):
+            station_index['london'].add(xy)
+
+    return station_index
+
 @register.simple_tag
-def station_marker(station, default_shape, line_size, points_by_color, stations, data_version):
+def station_marker(station, default_shape, line_size, points_by_color, stations, data_version, station_index=None, line_directions=None):
 
     """ Generate the SVG shape for a station based on
             whether it's a transfer station and what its shape is.
@@ -47,6 +75,10 @@ def station_marker(station, default_shape, line_size, points_by_color, stations,
             For example, a WMATA transfer station is currently 4 circles, but could be 2 circles with strokes.
 
             Only worth doing if it would be a real byte savings and not a loss of image quality / fidelity to the canvas-rendered version.
+
+        Pass in station_index from get_station_index(stations)
+            and a shared line_directions dict (see get_line_direction)
+            when drawing more than one station from the same map.
     """
 
     assert isinstance(station['xy'][0], int)
@@ -79,7 +111,7 @@ def station_marker(station, default_shape, line_size, points_by_color, stations,
         line_size, line_style = line_width_style.split('-')
         line_size = float(line_size)
 
-        line_direction_info = get_line_direction(x, y, color, points_by_color, line_width_style)
+        line_direction_info = get_line_direction(x, y, color, points_by_color, line_width_style, line_directions)
         line_direction = line_direction_info["direction"]
 
         # Vary the size of the marker based on the line width
@@ -103,7 +135,7 @@ def station_marker(station, default_shape, line_size, points_by_color, stations,
 
         if station.get('transfer') or line_direction == 'singleton':
             svg.append(use_defs(x, y, 'l'))
-            for london_connection in get_london_connections(x, y, stations):
+            for london_connection in get_london_connections(x, y, stations, station_index):
                 dx = x - london_connection[0]
                 dy = y - london_connection[1]
                 x_offset = (-0.25 * dx)
@@ -204,9 +236,9 @@ def station_marker(station, default_shape, line_size, points_by_color, stations,
             # line_width and style are set globally in data_version 2
             line_width_style = None
 
-        line_direction_info = get_line_direction(x, y, color, points_by_color, line_width_style)
+        line_direction_info = get_line_direction(x, y, color, points_by_color, line_width_style, line_directions)
         line_direction = line_direction_info['direction']
-        station_direction = get_connected_stations(x, y, stations)
+        station_direction = get_connected_stations(x, y, stations, station_index)
         draw_as_connected = False
 
         if station_direction == 'internal':
@@ -346,14 +378,26 @@ def svg_line(x1, y1, x2, y2, classes='', **kwargs):
     kwargs = ' '.join([f'{k}="{v}"' for k, v in kwargs.items()])
     return f'<line x1="{x1}" y1="{y1}" x2="{x2}" y2="{y2}"{classes}{kwargs}/>'
 
-def get_line_direction(x, y, color, points_by_color, line_width_style=None):
+def get_line_direction(x, y, color, points_by_color, line_width_style=None, line_directions=None):
 
     """ Returns which direction this line is going in,
         to help draw the positioning of rectangle stations
+
+        line_directions is an optional dict, shared for the whole map,
+            that holds the results already worked out,
+            since station_marker and station_text may both need
+            the same station's line direction.
+            Don't modify what this returns.
     """
 
     color = color.removeprefix('#')
 
+    if line_directions is not None:
+        key = (x, y, color, line_width_style)
+        if key not in line_directions:
+            line_directions[key] = get_line_direction(x, y, color, points_by_color, line_width_style)
+        return line_directions[key]
+
     info = {
         "direction": None,
         "endcap": False,
@@ -367,14 +411,30 @@ def get_line_direction(x, y, color, points_by_color, line_width_style=None):
         #   line width and style.
         line_width_style = 'xy'
 
-    NW = (x-1, y-1) in points_by_color[color][line_width_style]
-    NE = (x+1, y-1) in points_by_color[color][line_width_style]
-    SW = (x-1, y+1) in points_by_color[color][line_width_style]
-    SE = (x+1, y+1) in points_by_color[color][line_width_style]
-    N = (x, y-1) in points_by_color[color][line_width_style]
-    E = (x+1, y) in points_by_color[color][line_width_style]
-    S = (x, y+1) in points_by_color[color][line_width_style]
-    W = (x-1, y) in points_by_color[color][line_width_style]
+    points = points_by_color[color][line_width_style]
+
+    if isinstance(points, OccupancyGrid) and points.in_bounds(x, y):
+        # All eight neighbors are in the grid's padded border at worst
+        cells = points.cells
+        stride = points.stride
+        index = points.index(x, y)
+        NW = cells[index - stride - 1] == 1
+        NE = cells[index + stride - 1] == 1
+        SW = cells[index - stride + 1] == 1
+        SE = cells[index + stride + 1] == 1
+        N = cells[index - 1] == 1
+        E = cells[index + stride] == 1
+        S = cells[index + 1] == 1
+        W = cells[index - stride] == 1
+    else:
+        NW = (x-1, y-1) in points
+        NE = (x+1, y-1) in points
+        SW = (x-1, y+1) in points
+        SE = (x+1, y+1) in points
+        N = (x, y-1) in points
+        E = (x+1, y) in points
+        S = (x, y+1) in points
+        W = (x-1, y) in points
 
     neighboring_points = [
         NW, NE, SW, SE,
@@ -410,7 +470,7 @@ def get_line_direction(x, y, color, points_by_color, line_width_style=None):
 
     return info
 
-def get_connected_stations(x, y, stations):
+def get_connected_stations(x, y, stations, station_index=None):
 
     """ Returns connected stations along a SINGLE direction,
         with the goal of getting the xy coords of the ending connecting station
@@ -422,10 +482,11 @@ def get_connected_stations(x, y, stations):
             'internal' if this is an interior station and shouldn't be drawn
     """
 
-    eligible_stations = [
-        # Each station must be circles-thin, rect, or rect-round in order to qualify for connection
-        (s['xy'][0], s['xy'][1]) for s in stations if s.get('style', list(ALLOWED_STATION_STYLES.keys())[0]) in ALLOWED_CONNECTING_STATIONS
-    ]
+    if station_index is None:
+        station_index = get_station_index(stations)
+
+    # Each station must be circles-thin, rect, or rect-round in order to qualify for connection
+    eligible_stations = station_index['connecting']
 
     if (x, y) not in eligible_stations:
         return 'singleton'
@@ -590,7 +651,7 @@ def lengthen_connecting_station(length):
     else:
         return length + round((length - 2) / 2)
 
-def get_london_connections(x, y, stations):
+def get_london_connections(x, y, stations, station_index=None):
 
     """ Get all* London-style connecting stations adjacent to (x, y)
 
@@ -598,10 +659,11 @@ def get_london_connections(x, y, stations):
             because we don't need to draw the other directions twice.
     """
 
-    eligible_stations = [
-        # Only London transfer stations connect
-        (s['xy'][0], s['xy'][1]) for s in stations if s.get('style') == 'london' and s.get('transfer')
-    ]
+    if station_index is None:
+        station_index = get_station_index(stations)
+
+    # Only London transfer stations connect
+    eligible_stations = station_index['london']
 
     NW = (x-1, y-1)
     NE = (x+1, y-1)
@@ -620,7 +682,7 @@ def get_london_connections(x, y, stations):
     return connected
 
 @register.simple_tag
-def station_text(station, points_by_color=None):
+def station_text(station, points_by_color=None, line_directions=None):
 
     """ Generate the SVG text tag for a station based on
             whether it's a transfer station, and
@@ -633,6 +695,9 @@ def station_text(station, points_by_color=None):
             don't 100% translate here, because of slight differences
             in the SVG and HTML Canvas calculations.
             (That's why the station orientations are being re-written below.)
+
+        Doesn't modify station, so it doesn't matter whether
+            this or station_marker runs first.
     """
 
     text_anchor = ''
@@ -647,10 +712,13 @@ def station_text(station, points_by_color=None):
     assert isinstance(station['xy'][1], int)
     assert station['orientation'] in ALLOWED_ORIENTATIONS
 
-    # Other transformations are done to station['orientation'] below to handle the differences
+    # Other transformations are done to the rotation below to handle the differences
     #   between the SVG/Canvas implementations, so this preserves the original orientation
     #   which is necessary for London-style stations later.
     orientation = station['orientation']
+    rotation = orientation
+
+    transfer = station.get('transfer')
 
     if station.get('style') == 'london':
         line_width_style = station['line_width_style']
@@ -659,11 +727,13 @@ def station_text(station, points_by_color=None):
             f"#{station['color']}",
             points_by_color,
             line_width_style,
+            line_directions,
         )
         if line_direction['endcap']:
-            station['transfer'] = True
+            # Endcaps are offset like transfer stations
+            transfer = True
 
-    if station.get('transfer'):
+    if transfer:
         x_text_offset = 1.5
     else:
         x_text_offset = 0.75
@@ -675,56 +745,56 @@ def station_text(station, points_by_color=None):
     x_val = station['xy'][0]
     y_val = station['xy'][1]
 
-    if station['orientation'] == 0:
+    if rotation == 0:
         # Right
         pass
-    elif station['orientation'] in (
+    elif rotation in (
         45, # Below right, 45
         90, # Above, 90 -> SVG: (-90)
         -45, # Below right, 45
         ):
-        if station['orientation'] == 90:
-            station['orientation'] = -90
+        if rotation == 90:
+            rotation = -90
 
-        transform = f' transform="rotate({station["orientation"]} {station["xy"][0]}, {station["xy"][1]})"'
-    elif station['orientation'] in (
+        transform = f' transform="rotate({rotation} {station["xy"][0]}, {station["xy"][1]})"'
+    elif rotation in (
         180, # Left
         135, # Below left, 45 -> SVG: (-45)
         -135, # Above left, 45 -> SVG: (45)
         -90, # Below, 90
     ):
         text_anchor = ' text-anchor="end"'
-        if station.get('transfer'):
+        if transfer:
             x_text_offset *= -1
         else:
             x_text_offset *= -1
 
-        if station['orientation'] == 135:
-            station['orientation'] = -45
-        elif station['orientation'] == -135:
-            station['orientation'] = 45
+        if rotation == 135:
+            rotation = -45
+        elif rotation == -135:
+            rotation = 45
 
-        if station['orientation'] == 180:
+        if rotation == 180:
             transform = ''
         else:
-            transform = f' transform="rotate({station["orientation"]} {station["xy"][0]}, {station["xy"][1]})"'
-    elif station['orientation'] == 1:
+            transform = f' transform="rotate({rotation} {station["xy"][0]}, {station["xy"][1]})"'
+    elif rotation == 1:
         text_anchor = ' text-anchor="middle"'
-        if station.get('transfer'):
+        if transfer:
             y_text_offset -= 1.75
         else:
             y_text_offset -= 1.25
-    elif station['orientation'] == -1:
+    elif rotation == -1:
         text_anchor = ' text-anchor="middle"'
-        if station.get('transfer'):
+        if transfer:
             y_text_offset += 1.75
         else:
             y_text_offset += 1.25
 
     # London needs to offset the station names based on the line direction and orientation
     #   (though transfer stations already have plenty of offset, so skip for those)
-    #   (Note: endcap stations are set above as transfer stations for purposes of these offsets)
-    if station.get('style') == 'london' and not station.get('transfer'):
+    #   (Note: endcap stations are treated as transfer stations above for purposes of these offsets)
+    if station.get('style') == 'london' and not transfer:
         # mmm.js's drawStyledStation_London() has only a handful of conditionals,
         #   and so looks very simple and straightforward compared to the mess below.
         #   But this is because SVG rotation is handled differently than on the canvas
@@ -871,7 +941,7 @@ def station_text(station, points_by_color=None):
             if line_width >= 0.75:
                 x_offset *= marker_main_size_offset
                 y_offset *= marker_main_size_offset
-    elif station.get('style') == 'london' and station.get('transfer'):
+    elif station.get('style') == 'london' and transfer:
         if orientation in (-1, 1):
             x_text_offset = 0
 
@@ -961,7 +1031,7 @@ def get_station_styles_in_use(stations, default_shape, line_size):
     svg = []
     if styles or color_variants:
         svg.append('<defs>')
-        for style in list(styles) + list(color_variants.keys()):
+        for style in sorted(styles) + list(color_variants.keys()):
             if style in SVG_DEFS:
                 for variant in SVG_DEFS[style]:
                     svg.append(f'<g id="{variant}">')
@@ -1023,11 +1093,11 @@ def get_line_width_styles_for_svg_style(shapes_by_color):
             if width_style in SVG_STYLES:
                 css_styles.append(f".{SVG_STYLES[width_style]['class']} {{ {SVG_STYLES[width_style]['style']} }}")
 
-    for width in widths:
+    for width in sorted(widths):
         if width in SVG_STYLES:
             css_styles.append(f".{SVG_STYLES[width]['class']} {{ {SVG_STYLES[width]['style']} }}")
 
-    for style in styles:
+    for style in sorted(styles):
         if style in SVG_STYLES:
             css_styles.append(f".{SVG_STYLES[style]['class']} {{ {SVG_STYLES[style]['style']} }}")
 
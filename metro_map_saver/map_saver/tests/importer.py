@@ -0,0 +1,141 @@
+from map_saver.importer import prepare_map
+from map_saver.models import MapJob, SavedMap, get_data_filepath
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import Client, TestCase, override_settings
+
+from unittest import mock
+import io
+import json
+import os
+import tempfile
+
+
+class MapImportTest(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media_root.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+
+    def make_map(self, n):
+
+        """ Helper function: a small, valid map that's different for every n
+        """
+
+        return json.dumps({
+            'global': {'data_version': 3, 'lines': {'bd1038': {'displayName': 'Red Line'}}},
+            'points_by_color': {'bd1038': {'1-solid': {str(n): {'0': 1, '1': 1}}}},
+            'stations': {},
+        })
+
+    def import_lines(self, lines, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as import_file:
+            import_file.write('\n'.join(lines))
+            import_file.flush()
+            output = io.StringIO()
+            call_command('import_maps', import_file.name, *args, stdout=output)
+        return output.getvalue()
+
+    def test_import_maps(self):
+
+        """ Confirm that import_maps saves every valid map once,
+                with its data files and jobs,
+                skipping invalid lines and maps that are already saved
+        """
+
+        client = Client()
+        client.post('/save/', {'metroMap': self.make_map(0)})
+
+        lines = [self.make_map(n) for n in range(5)]
+        lines += [self.make_map(1), '', 'not a map', '{"global": {}}']
+        output = self.import_lines(lines, '--batch', '2')
+
+        self.assertIn('Imported 4 maps; skipped 2 already saved and 2 invalid.', output)
+        self.assertIn('Line 8:', output)
+        self.assertIn('Line 9:', output)
+        self.assertEqual(5, SavedMap.objects.count())
+        self.assertEqual(5, SavedMap.objects.values('data_hash').distinct().count())
+        self.assertEqual(5, MapJob.objects.filter(task=MapJob.IMAGES).count())
+        for saved_map in SavedMap.objects.all():
+            self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, get_data_filepath(saved_map))))
+
+        # The imported maps are the same as if they had been saved one at a time
+        response = client.post('/save/', {'metroMap': self.make_map(3)})
+        self.assertEqual(5, SavedMap.objects.count())
+        saved_map = SavedMap.objects.get(urlhash=response.content.decode('utf-8').strip().split(',')[0])
+        self.assertEqual(json.loads(self.make_map(3))['points_by_color'], saved_map.data['points_by_color'])
+
+        # Importing it all again saves nothing new
+        output = self.import_lines(lines)
+        self.assertIn('Imported 0 maps; skipped 6 already saved and 2 invalid.', output)
+
+    def test_import_maps_saved_meanwhile(self):
+
+        """ Confirm that a map saved by someone else while a batch is being imported
+                isn't counted as imported, and the rest of the batch still is
+        """
+
+        lines = [self.make_map(n) for n in range(3)]
+        map_details, error = prepare_map(self.make_map(1))
+        map_details.pop('legacy_urlhash')
+
+        # Right after the batch is checked for maps that are already saved
+        def save_meanwhile(legacy_urlhashes):
+            SavedMap.objects.create(**map_details)
+            return set()
+
+        with mock.patch.object(SavedMap, 'get_legacy_urlhashes', side_effect=save_meanwhile):
+            output = self.import_lines(lines)
+
+        self.assertIn('Imported 2 maps; skipped 1 already saved and 0 invalid.', output)
+        self.assertEqual(3, SavedMap.objects.count())
+
+    def test_import_maps_workers(self):
+
+        """ Confirm that import_maps validates the same way in worker processes,
+                a few lines at a time
+        """
+
+        lines = [self.make_map(n) for n in range(10)] + ['', '[]']
+        with mock.patch('map_saver.importer.POOL_CHUNKSIZE', 2):
+            output = self.import_lines(lines, '--workers', '2')
+        self.assertIn('Imported 10 maps; skipped 0 already saved and 1 invalid.', output)
+        self.assertIn('Line 12:', output)
+        self.assertEqual(10, SavedMap.objects.count())
+
+    def test_import_view(self):
+
+        """ Confirm that only staff can import maps,
+                and that the import is queued up for run_jobs
+        """
+
+        client = Client()
+        body = '\n'.join(self.make_map(n) for n in range(3))
+
+        response = client.post('/admin/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(SavedMap.objects.exists())
+
+        User.objects.create_user(username='staff', password='1X<ISRUkw+tuK', is_staff=True)
+        client.login(username='staff', password='1X<ISRUkw+tuK')
+        response = client.post('/admin/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(202, response.status_code)
+        self.assertFalse(SavedMap.objects.exists())
+        job = MapJob.objects.get(task=MapJob.IMPORT)
+        self.assertIn(f'job #{job.pk}', response.content.decode('utf-8'))
+        import_path = job.import_file.path
+        with open(import_path) as import_file:
+            self.assertEqual(body, import_file.read())
+
+        output = io.StringIO()
+        with mock.patch.object(SavedMap, 'generate_images', return_value=''):
+            call_command('run_jobs', '--once', stdout=output)
+        self.assertIn('Imported 3 maps', output.getvalue())
+        self.assertEqual(3, SavedMap.objects.count())
+        self.assertFalse(MapJob.objects.exists())
+        self.assertFalse(os.path.exists(import_path))
@@ -0,0 +1,148 @@
+from citysuggester.models import TravelSystem
+from map_saver.models import MapJob, SavedMap
+
+from django.core.management import call_command
+from django.test import Client, TestCase
+from django.utils import timezone
+
+from unittest import mock
+import datetime
+import io
+import json
+
+
+class MapJobTest(TestCase):
+
+    stations = ['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo', 'Foxtrot']
+
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            TravelSystem.objects.create(name='Phonetic (Alphabet)', stations='\n'.join(self.stations))
+        self.saved_map = SavedMap.objects.create(
+            urlhash='jobs',
+            stations=','.join(station.lower() for station in self.stations),
+            station_count=len(self.stations),
+        )
+
+    def run_jobs(self):
+        output = io.StringIO()
+        call_command('run_jobs', '--once', stdout=output)
+        return output.getvalue()
+
+    def test_save_enqueues_jobs(self):
+
+        """ Confirm that saving a map queues up its images,
+                and a suggested city only if it has enough stations
+        """
+
+        client = Client()
+        stations = {str(n): {'0': {'name': station}} for n, station in enumerate(self.stations)}
+        mapdata = {
+            'global': {'data_version': 3, 'lines': {'bd1038': {'displayName': 'Red Line'}}},
+            'points_by_color': {'bd1038': {'1-solid': {str(n): {'0': 1} for n in range(len(self.stations))}}},
+            'stations': stations,
+        }
+        response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+        urlhash = response.content.decode('utf-8').strip().split(',')[0]
+        saved_map = SavedMap.objects.get(urlhash=urlhash)
+        self.assertEqual(
+            {MapJob.IMAGES, MapJob.SUGGEST_CITY},
+            set(saved_map.jobs.values_list('task', flat=True)),
+        )
+
+        # Saving the same map again doesn't queue anything else
+        client.post('/save/', {'metroMap': json.dumps(mapdata)})
+        self.assertEqual(2, MapJob.objects.count())
+
+        mapdata['stations'] = {}
+        response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+        urlhash = response.content.decode('utf-8').strip().split(',')[0]
+        saved_map = SavedMap.objects.get(urlhash=urlhash)
+        self.assertEqual([MapJob.IMAGES], list(saved_map.jobs.values_list('task', flat=True)))
+
+    def test_run_jobs(self):
+
+        """ Confirm that run_jobs runs each job once and deletes it
+        """
+
+        MapJob.enqueue(self.saved_map)
+        with mock.patch.object(SavedMap, 'generate_images', return_value='Drew images') as generate_images:
+            output = self.run_jobs()
+        generate_images.assert_called_once_with()
+        self.assertIn('Drew images', output)
+        self.assertFalse(MapJob.objects.exists())
+
+        self.saved_map.refresh_from_db()
+        self.assertEqual('Phonetic', self.saved_map.suggested_city)
+        self.assertEqual(len(self.stations), self.saved_map.suggested_city_overlap)
+
+        # Nothing left to do
+        self.assertEqual('', self.run_jobs())
+
+    def test_run_jobs_retries(self):
+
+        """ Confirm that a job that fails is kept and retried later,
+                until it's been tried MAX_ATTEMPTS times;
+                then it's marked failed, listed by --failed,
+                and only run again with --retry-failed
+        """
+
+        MapJob.enqueue(self.saved_map, [MapJob.IMAGES])
+        with mock.patch.object(SavedMap, 'generate_images', side_effect=ValueError('Bad map')):
+            self.assertIn('Bad map', self.run_jobs())
+
+            job = MapJob.objects.get()
+            self.assertEqual(1, job.attempts)
+            self.assertIn('ValueError: Bad map', job.last_error)
+            self.assertGreater(job.run_after, timezone.now())
+
+            # Not ready to retry yet
+            self.assertEqual('', self.run_jobs())
+
+            for attempt in range(MapJob.MAX_ATTEMPTS - 2):
+                MapJob.objects.update(run_after=timezone.now())
+                self.assertIsNone(MapJob.objects.get().failed_at)
+                self.run_jobs()
+
+            # The last attempt
+            MapJob.objects.update(run_after=timezone.now())
+            self.assertIn(f'Gave up on {job} after {MapJob.MAX_ATTEMPTS} attempts', self.run_jobs())
+            job = MapJob.objects.get()
+            self.assertEqual(MapJob.MAX_ATTEMPTS, job.attempts)
+            self.assertIsNotNone(job.failed_at)
+
+            # Given up
+            MapJob.objects.update(run_after=timezone.now())
+            self.assertEqual('', self.run_jobs())
+
+            output = io.StringIO()
+            call_command('run_jobs', '--failed', stdout=output)
+            self.assertIn(f'{job} failed at', output.getvalue())
+            self.assertIn('ValueError: Bad map', output.getvalue())
+            self.assertIn('1 failed jobs.', output.getvalue())
+
+        output = io.StringIO()
+        with mock.patch.object(SavedMap, 'generate_images', return_value='Drew images'):
+            call_command('run_jobs', '--once', '--retry-failed', stdout=output)
+        self.assertIn('Retrying 1 failed jobs.', output.getvalue())
+        self.assertIn('Drew images', output.getvalue())
+        self.assertFalse(MapJob.objects.exists())
+
+    def test_run_jobs_exhausted(self):
+
+        """ Confirm that a job whose last attempt never finished
+                (its worker stopped) is marked failed once its lease is up
+        """
+
+        MapJob.enqueue(self.saved_map, [MapJob.IMAGES])
+        MapJob.objects.update(attempts=MapJob.MAX_ATTEMPTS, run_after=timezone.now() + datetime.timedelta(minutes=5))
+
+        # Its worker could still be running it
+        self.assertEqual('', self.run_jobs())
+        self.assertIsNone(MapJob.objects.get().failed_at)
+
+        MapJob.objects.update(run_after=timezone.now())
+        with mock.patch.object(SavedMap, 'generate_images') as generate_images:
+            self.assertIn('never finished', self.run_jobs())
+        generate_images.assert_not_called()
+        self.assertIsNotNone(MapJob.objects.get().failed_at)
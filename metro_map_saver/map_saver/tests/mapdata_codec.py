@@ -0,0 +1,126 @@
+from map_saver.mapdata_codec import (
+    FORMAT_VERSION,
+    MAGIC,
+    pack_mapdata,
+    unpack_mapdata,
+)
+from map_saver.models import SavedMap
+
+from django.core.management import call_command
+from django.test import Client, TestCase
+
+import io
+import json
+
+
+class MapDataCodecTest(TestCase):
+
+    v3_map = {
+        'global': {
+            'data_version': 3,
+            'map_size': 360,
+            'lines': {'bd1038': {'displayName': 'Red Line'}, '0896d7': {'displayName': 'Blue Line'}},
+            'style': {'mapLineWidth': 1, 'mapStationStyle': 'wmata'},
+        },
+        'points_by_color': {
+            'bd1038': {
+                '1-solid': {'0': {'0': 1, '1': 1, '2': 1}, '359': {'359': 1}},
+                '0.5-dashed': {'10': {'5': 1}},
+            },
+            '0896d7': {'1-solid': {'2': {'0': 1}, '1': {'300': 1}}},
+        },
+        'stations': {
+            '0': {'1': {'name': 'Metro_Center', 'orientation': 45, 'transfer': 1, 'style': 'rect'}},
+            '359': {'359': {'name': 'End_of_the_Line', 'orientation': 0}},
+        },
+    }
+
+    def test_roundtrip(self):
+
+        """ Confirm that packing and unpacking gives back exactly the same data,
+                for v3 and v2 maps, and that it's smaller
+        """
+
+        v2_map = {
+            'global': {'data_version': 2, 'map_size': 80, 'lines': {'bd1038': {'displayName': 'Red Line'}}},
+            'points_by_color': {'bd1038': {'xys': {'1': {'1': 1, '2': 1}, '3': {'79': 1}}}},
+            'stations': {},
+        }
+
+        for mapdata in (self.v3_map, v2_map):
+            packed = pack_mapdata(mapdata)
+            self.assertTrue(packed.startswith(MAGIC + bytes([FORMAT_VERSION])))
+            self.assertEqual(mapdata, unpack_mapdata(packed))
+            self.assertEqual(mapdata, unpack_mapdata(memoryview(packed)))
+            self.assertEqual(list(mapdata), list(unpack_mapdata(packed)))
+
+        dense = {
+            'global': {'data_version': 3, 'map_size': 360, 'lines': {'bd1038': {}}},
+            'points_by_color': {'bd1038': {'1-solid': {
+                str(x): {str(y): 1 for y in range(360) if (x + y) % 3}
+                for x in range(360)
+            }}},
+            'stations': {},
+        }
+        packed = pack_mapdata(dense)
+        self.assertEqual(dense, unpack_mapdata(packed))
+        self.assertLess(len(packed) * 50, len(json.dumps(dense)))
+
+    def test_cannot_pack(self):
+
+        """ Confirm that data that can't be packed losslessly raises a ValueError
+        """
+
+        unpackable = [
+            {'global': {}},
+            {'points_by_color': {'bd1038': {'1-solid': {'0': {'0': 2}}}}},
+            {'points_by_color': {'bd1038': {'1-solid': {'0': {'0': True}}}}},
+            {'points_by_color': {'bd1038': {'1-solid': {'01': {'0': 1}}}}},
+            {'points_by_color': {'bd1038': {'1-solid': {'0': {'360': 1}}}}},
+            {'points_by_color': {'bd1038': {'1-solid': {'0': {}}}}},
+            {'points_by_color': {'bd1038': {'1-solid': {0: {'0': 1}}}}},
+            {'points_by_color': {}, 'stations': {'-1': {'0': {}}}},
+        ]
+
+        for mapdata in unpackable:
+            with self.assertRaises(ValueError):
+                pack_mapdata(mapdata)
+            self.assertIsNone(SavedMap.pack_data(mapdata))
+
+        with self.assertRaises(ValueError):
+            unpack_mapdata(b'{"global": {}}')
+
+        with self.assertRaises(ValueError):
+            unpack_mapdata(MAGIC + bytes([FORMAT_VERSION + 1]))
+
+    def test_load_packed_map(self):
+
+        """ Confirm that a saved map is packed,
+                and that /load/ serves the packed data
+        """
+
+        client = Client()
+        response = client.post('/save/', {'metroMap': json.dumps(self.v3_map)})
+        urlhash = response.content.decode('utf-8').strip().split(',')[0]
+
+        saved_map = SavedMap.objects.get(urlhash=urlhash)
+        self.assertTrue(saved_map.packed_data)
+        self.assertEqual(saved_map.data, unpack_mapdata(saved_map.packed_data))
+
+        # If .data and .packed_data differ, /load/ uses .packed_data
+        saved_map.data = {}
+        saved_map.save()
+        response = client.get(f'/load/{urlhash}')
+        self.assertEqual(unpack_mapdata(saved_map.packed_data), json.loads(response.content))
+
+    def test_pack_mapdata_command(self):
+
+        """ Confirm that the backfill command packs maps that haven't been packed yet
+        """
+
+        SavedMap.objects.create(urlhash='packme', data=self.v3_map)
+        SavedMap.objects.create(urlhash='classic', mapdata='{"global": {"lines": {}}}')
+
+        call_command('pack_mapdata', stdout=io.StringIO())
+        self.assertEqual(self.v3_map, SavedMap.objects.get(urlhash='packme').get_data())
+        self.assertIsNone(SavedMap.objects.get(urlhash='classic').packed_data)
@@ -1,20 +1,48 @@
 from map_saver.mapdata_optimizer import (
+    add_stations_to_svg,
+    iter_stations_svg,
     find_endpoint_of_line,
     find_lines,
+    find_lines_cached,
+    find_connected_components,
     find_squares,
     get_adjacent_point,
     get_connected_points,
+    get_mapdata_as_lines,
+    get_shapes_cache_key,
+    get_svg_from_shapes_by_color,
     is_adjacent,
     reduce_straight_line,
+    SHAPES_CACHE_ALIAS,
     sort_points_by_color,
+    write_svgs,
+)
+from map_saver.occupancy import (
+    OccupancyGrid,
+    get_occupancy_grids,
 )
 
 from map_saver.templatetags.metromap_utils import (
     get_line_direction,
     get_connected_stations,
+    get_london_connections,
+    get_station_index,
+)
+
+from map_saver.validator import (
+    ALLOWED_LINE_STYLES,
+    ALLOWED_LINE_WIDTHS,
+    ALLOWED_MAP_SIZES,
 )
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.test import Client, TestCase, override_settings
+
+import copy
+import io
+import json
+import random
 
 class OptimizeMapTest(TestCase):
 
@@ -140,6 +168,35 @@ class OptimizeMapTest(TestCase):
         points_by_color, stations, map_size = sort_points_by_color(mapdata, map_type='classic', data_version=2)
         self.confirm_map_for_sort_points_by_color(2, points_by_color, stations, map_size)
 
+    def test_sort_points_by_color_v3_invalid_points(self):
+
+        """ Confirm that sort_points_by_color skips coordinates that aren't in VALID_XY
+                and points that aren't set, and that neither affects the map size
+        """
+
+        mapdata = {
+            'global': {'data_version': 3, 'lines': {'bd1038': {}, '0896d7': {}}},
+            'points_by_color': {
+                'bd1038': {
+                    '1-solid': {'1': {'1': 1, '2': 1, '-1': 1, '01': 1, '360': 1}, '200': {'3': 0}, 'x': {'1': 1}},
+                    '0.5-dashed': {'300': {'300': 0}},
+                },
+                '0896d7': {'1-solid': {'400': {'2': 1}}},
+            },
+            'stations': {
+                '1': {'2': {'name': 'Valid'}, '01': {'name': 'Invalid'}},
+                '-1': {'1': {'name': 'Invalid'}},
+            },
+        }
+
+        points_by_color, stations, map_size = sort_points_by_color(mapdata, map_type='classic', data_version=3)
+        self.assertEqual({'bd1038': {'1-solid': {(1, 1), (1, 2)}}}, points_by_color)
+        self.assertEqual(80, map_size)
+        self.assertEqual(1, len(stations))
+        self.assertEqual((1, 2), stations[0]['xy'])
+        self.assertEqual('bd1038', stations[0]['color'])
+        self.assertEqual('1-solid', stations[0]['line_width_style'])
+
     def test_get_connected_points(self):
 
         """ Confirm that get_connected_points returns
@@ -166,6 +223,54 @@ class OptimizeMapTest(TestCase):
         for point in connected_points:
             self.assertNotIn(point, unconnected)
 
+    def test_get_connected_points_large(self):
+
+        """ Confirm that get_connected_points handles
+            far more connected points than the recursion limit allows
+        """
+
+        points = {(x, y) for x in range(360) for y in range(360) if x % 4 != 3 or y == 0}
+        connected_points = get_connected_points(0, 0, points)
+        self.assertEqual(len(connected_points), len(points))
+        self.assertEqual(connected_points[0], (0, 0))
+        self.assertEqual(set(connected_points), points)
+
+    def test_find_connected_components(self):
+
+        """ Confirm that find_connected_components returns
+            every connected component at once, each exactly once
+        """
+
+        connected = [
+            (1,1), (1,2), (1,3), (1,4), # S
+            (2,5), (3,6), (4,6), (5,6), # SE, E
+            (6,5), (7,4), (6,3), (7,2), # NE, NW
+            (8,1), (7,0), (6,0), (5,1), # NE, NW, W, SW
+            (4,2), (3,2), (3,1), (3,0), # SW, W, N
+        ]
+
+        unconnected = [
+            (10,10), (12,12), (4,4),
+        ]
+
+        components = find_connected_components(connected + unconnected)
+        self.assertEqual(components, [
+            set(connected),
+            {(10,10)},
+            {(12,12)},
+            {(4,4)},
+        ])
+
+        self.assertEqual(find_connected_components([]), [])
+
+        # A large map with a lot of "terrain" and many columns
+        points = {(x, y) for x in range(360) for y in range(360) if x % 4 != 3}
+        components = find_connected_components(sorted(points))
+        self.assertEqual(len(components), 90)
+        self.assertEqual(sum(len(c) for c in components), len(points))
+        for component in components:
+            self.assertEqual(len({x for (x, y) in component}), 3)
+
     def test_is_adjacent(self):
 
         """ Confirm that is_adjacent()
@@ -409,6 +514,7 @@ class OptimizeMapTest(TestCase):
             {'xy': (12,2), 'style': 'rect', 'expected': 'conflicting'},
         ]
 
+        station_index = get_station_index(stations)
         for station in stations:
             result = get_connected_stations(station['xy'][0], station['xy'][1], stations)
             if isinstance(result, dict):
@@ -417,6 +523,29 @@ class OptimizeMapTest(TestCase):
             else:
                 self.assertEqual(result, station['expected'])
 
+            # Same result using the station index
+            self.assertEqual(result, get_connected_stations(station['xy'][0], station['xy'][1], stations, station_index))
+
+    def test_get_london_connections(self):
+
+        """ Confirm that metromap_utils.get_london_connections
+            returns adjacent London-style transfer stations to the N, W, SW, and NW,
+            with or without the station index
+        """
+
+        stations = [
+            {'xy': (5,5), 'style': 'london', 'transfer': 1},
+            {'xy': (5,4), 'style': 'london', 'transfer': 1}, # N
+            {'xy': (4,5), 'style': 'london'}, # W, but not a transfer station
+            {'xy': (4,6), 'style': 'rect', 'transfer': 1}, # SW, but not London
+            {'xy': (4,4), 'style': 'london', 'transfer': 1}, # NW
+            {'xy': (6,5), 'style': 'london', 'transfer': 1}, # E, not checked
+        ]
+
+        station_index = get_station_index(stations)
+        self.assertEqual(get_london_connections(5, 5, stations), [(5,4), (4,4)])
+        self.assertEqual(get_london_connections(5, 5, stations, station_index), [(5,4), (4,4)])
+
     def test_find_endpoint_of_line(self):
 
         """ Confirm that find_endpoint_of_line
@@ -492,3 +621,298 @@ class OptimizeMapTest(TestCase):
 
         for exp in expected:
             self.assertIn(exp, lines)
+
+    def test_occupancy_grid(self):
+
+        """ Confirm that an OccupancyGrid behaves like a set of points
+        """
+
+        points = [(0,0), (79,79), (3,4), (4,3), (3,4)]
+        grid = OccupancyGrid(80, points)
+
+        self.assertEqual(len(grid), 4)
+        self.assertEqual(list(grid), sorted(set(points)))
+        for point in points:
+            self.assertIn(point, grid)
+        for point in [(4,4), (-1,0), (0,-1), (80,79), (79,80), (500,500)]:
+            self.assertNotIn(point, grid)
+
+        with self.assertRaises(ValueError):
+            grid.add((80,0))
+
+        dense = {(x, y) for x in range(80) for y in range(10)}
+        grids = get_occupancy_grids({'bd1038': {'x': [1], 'y': [2], 'xy': dense}}, 80, data_version=2)
+        self.assertEqual(list(grids), ['bd1038'])
+        self.assertEqual(list(grids['bd1038']), ['xy'])
+        self.assertIsInstance(grids['bd1038']['xy'], OccupancyGrid)
+        self.assertEqual(list(grids['bd1038']['xy']), sorted(dense))
+
+        # Sparse points stay a set, which is smaller and faster for them
+        sparse = {(1,2), (3,4)}
+        grids = get_occupancy_grids({'bd1038': {'1-solid': sparse, '2-solid': dense}}, 80)
+        self.assertIs(grids['bd1038']['1-solid'], sparse)
+        self.assertIsInstance(grids['bd1038']['2-solid'], OccupancyGrid)
+
+    def test_find_lines_occupancy_grid(self):
+
+        """ Confirm that find_lines, find_endpoint_of_line, and get_line_direction
+                give identical results for an OccupancyGrid and a set of points,
+                including the order of the lines and singletons,
+                since that determines the order they're drawn in the SVG
+        """
+
+        points = self.convert_to_xy_pairs(' '.join([
+            '0,0 1,0 2,0 3,0 4,0',
+            '0,1 0,2 0,3 0,4 0,5',
+            '1,1 2,2 3,3 4,4 5,5',
+            '10,4 11,3 12,2 13,1 14,0',
+            '24,0 23,1 22,2 21,3',
+            '0,7 80,40 100,1 100,20 119,119',
+        ]))
+
+        rng = random.Random(0)
+        maps = [set(points)]
+        for density in (0.01, 0.1, 0.5, 0.9):
+            maps.append({(x, y) for x in range(120) for y in range(120) if rng.random() < density})
+
+        for points in maps:
+            grid = OccupancyGrid(120, points)
+            lines, singletons = find_lines(points)
+            grid_lines, grid_singletons = find_lines(grid)
+            self.assertEqual(list(lines), list(grid_lines))
+            self.assertEqual(list(singletons), list(grid_singletons))
+
+            points_by_color = {'bd1038': {'xy': points}}
+            grids = {'bd1038': {'xy': grid}}
+            for x, y in sorted(points)[:200]:
+                self.assertEqual(
+                    get_line_direction(x, y, 'bd1038', points_by_color),
+                    get_line_direction(x, y, 'bd1038', grids),
+                )
+                for direction in ('E', 'S', 'NE', 'SE', 'SW'):
+                    self.assertEqual(
+                        find_endpoint_of_line(x, y, points, direction),
+                        find_endpoint_of_line(x, y, grid, direction),
+                    )
+
+    def test_find_lines_in_grid_parity(self):
+
+        """ Confirm that the run-based find_lines for an OccupancyGrid
+                returns exactly what find_lines returns for a set of points,
+                both sorted, for random maps of many sizes and densities,
+                and for points along the edges of the largest map,
+                where a run could wrap around if the grid weren't padded
+        """
+
+        rng = random.Random()
+        seed = rng.randrange(2 ** 32)
+        rng.seed(seed)
+
+        maps = []
+        for _ in range(20):
+            # The larger sizes are only slower, not different
+            map_size = rng.choice(ALLOWED_MAP_SIZES[:4])
+            density = rng.choice((0.001, 0.01, 0.1, 0.3, 0.5, 0.8, 0.95, 1))
+            maps.append((map_size, {
+                (x, y)
+                for x in range(map_size)
+                for y in range(map_size)
+                if rng.random() < density
+            }))
+
+        edges = set()
+        for n in range(360):
+            edges.update([(0, n), (359, n), (n, 0), (n, 359), (n, n), (n, 359 - n)])
+        maps.append((360, edges))
+
+        for map_size, points in maps:
+            lines, singletons = find_lines(points)
+            self.assertEqual(sorted(lines), lines)
+            self.assertEqual(sorted(singletons), singletons)
+            self.assertEqual(
+                (lines, singletons),
+                find_lines(OccupancyGrid(map_size, points)),
+                f'Different lines for a {map_size}x{map_size} map with {len(points)} points (seed {seed})',
+            )
+
+    @override_settings(SHAPES_CACHE_TIMEOUT=60)
+    def test_find_lines_cached(self):
+
+        """ Confirm that find_lines_cached returns the same lines and singletons
+                as find_lines, in the same order, whether or not they were cached,
+                and that the same points on a different map reuse the cached shapes
+        """
+
+        shapes_cache = caches[SHAPES_CACHE_ALIAS]
+        cache.clear()
+        shapes_cache.clear()
+        points = {(x, y) for x in range(40) for y in range(40) if (x * y) % 7}
+        points.update({(50, 50), (52, 52), (54, 50)})
+        lines, singletons = find_lines(OccupancyGrid(80, points))
+
+        for _ in range(2):
+            cached_lines, cached_singletons = find_lines_cached(OccupancyGrid(80, points))
+            self.assertEqual(list(lines), cached_lines)
+            self.assertEqual(list(singletons), cached_singletons)
+        self.assertIsNotNone(shapes_cache.get(get_shapes_cache_key(OccupancyGrid(80, points))))
+        # Kept out of the default cache
+        self.assertIsNone(cache.get(get_shapes_cache_key(OccupancyGrid(80, points))))
+
+        # Changing one point means a different key
+        self.assertIsNone(shapes_cache.get(get_shapes_cache_key(OccupancyGrid(80, points | {(70, 70)}))))
+
+        with override_settings(SHAPES_CACHE_TIMEOUT=0):
+            shapes_cache.clear()
+            find_lines_cached(OccupancyGrid(80, points))
+            self.assertIsNone(shapes_cache.get(get_shapes_cache_key(OccupancyGrid(80, points))))
+
+        # Without the shapes cache, nothing is cached
+        with override_settings(CACHES={'default': settings.CACHES['default']}):
+            self.assertEqual((list(lines), list(singletons)), find_lines_cached(OccupancyGrid(80, points)))
+
+    def test_get_mapdata_as_lines(self):
+
+        """ Confirm that the lines format has exactly the same points as points_by_color,
+                and that /load/ only sends it when asked for
+        """
+
+        mapdata = {
+            'global': {'data_version': 3, 'map_size': 80, 'lines': {'bd1038': {}, '0896d7': {}}},
+            'points_by_color': {
+                'bd1038': {
+                    '1-solid': {str(x): {'5': 1} for x in range(20)},
+                    '0.5-dashed': {'30': {'30': 1}, '31': {'31': 1, '40': 1}, '32': {'32': 1}},
+                },
+                '0896d7': {'1-solid': {'3': {str(y): 1 for y in range(10, 60)}, '70': {'70': 1}}},
+            },
+            'stations': {'3': {'10': {'name': 'North'}}},
+        }
+
+        as_lines = get_mapdata_as_lines(mapdata)
+        self.assertEqual(['global', 'lines_by_color', 'stations'], list(as_lines))
+        self.assertEqual(mapdata['stations'], as_lines['stations'])
+
+        for color, width_styles in mapdata['points_by_color'].items():
+            self.assertEqual(list(width_styles), list(as_lines['lines_by_color'][color]))
+            for width_style, xys in width_styles.items():
+                expected = {(int(x), int(y)) for x in xys for y in xys[x]}
+                shapes = as_lines['lines_by_color'][color][width_style]
+                points = {tuple(point) for point in shapes['points']}
+                for x1, y1, x2, y2 in shapes['lines']:
+                    dx = (x2 > x1) - (x2 < x1)
+                    dy = (y2 > y1) - (y2 < y1)
+                    for step in range(max(abs(x2 - x1), abs(y2 - y1)) + 1):
+                        points.add((x1 + dx * step, y1 + dy * step))
+                self.assertEqual(expected, points)
+
+        self.assertEqual(1, len(as_lines['lines_by_color']['bd1038']['1-solid']['lines']))
+        self.assertEqual([[3, 10, 3, 59]], [list(line) for line in as_lines['lines_by_color']['0896d7']['1-solid']['lines']])
+
+        client = Client()
+        response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+        urlhash = response.content.decode('utf-8').strip().split(',')[0]
+        self.assertIn('points_by_color', json.loads(client.get(f'/load/{urlhash}').content))
+        self.assertIn('lines_by_color', json.loads(client.get(f'/load/{urlhash}?format=lines').content))
+
+    def test_svg_renderers_match(self):
+
+        """ Confirm that the pure-Python SVG renderer draws
+                exactly the same SVG as SVG_TEMPLATE_V3
+                for every line width and style
+        """
+
+        points = set(self.convert_to_xy_pairs(' '.join([
+            '0,0 1,0 2,0 3,0 4,0',
+            '0,1 0,2 0,3 0,4 0,5',
+            '1,1 2,2 3,3 4,4 5,5',
+            '10,4 11,3 12,2 13,1 14,0',
+            '0,7 80,40 100,1 100,20',
+        ])))
+        lines, singletons = find_lines(points)
+
+        width_styles = [f'{width}-{style}' for width in ALLOWED_LINE_WIDTHS for style in ALLOWED_LINE_STYLES]
+        points_by_color = {
+            color: {width_style: points for width_style in width_styles[index::3]}
+            for index, color in enumerate(['bd1038', '00b251', '0896d7'])
+        }
+        shapes_by_color = {
+            color: {width_style: {'lines': lines, 'points': singletons} for width_style in points_by_color[color]}
+            for color in points_by_color
+        }
+        stations = [
+            {'name': 'Transfer', 'orientation': 0, 'xy': (0, 0), 'color': 'bd1038', 'line_width_style': width_styles[0], 'transfer': 1, 'style': 'wmata'},
+            {'name': 'Circle', 'orientation': 0, 'xy': (1, 1), 'color': 'bd1038', 'line_width_style': width_styles[0], 'style': 'circles-md'},
+        ]
+
+        for default_station_shape in ('wmata', 'rect'):
+            for line_size in (1, 0.5):
+                for map_stations in (stations, []):
+                    args = (shapes_by_color, 120, line_size, default_station_shape, points_by_color, map_stations, 3)
+                    with override_settings(SVG_RENDERER='template'):
+                        expected = get_svg_from_shapes_by_color(*args)
+                    with override_settings(SVG_RENDERER='python'):
+                        self.assertEqual(get_svg_from_shapes_by_color(*args), expected)
+
+    def test_write_svgs(self):
+
+        """ Confirm that write_svgs streams exactly the same thumbnail and full SVG
+                as get_svg_from_shapes_by_color and add_stations_to_svg
+                draw with the templates
+        """
+
+        points = set(self.convert_to_xy_pairs('0,0 1,0 2,0 3,0 4,0 0,1 0,2 0,3 4,4 5,5 6,6 9,9'))
+        lines, singletons = find_lines(points)
+        points_by_color = {'bd1038': {'1-solid': points}}
+        shapes_by_color = {'bd1038': {'1-solid': {'lines': lines, 'points': singletons}}}
+        stations = [
+            {'name': 'Rect', 'orientation': 90, 'xy': (0, 0), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'rect'},
+            {'name': 'Rect Two', 'orientation': 0, 'xy': (1, 0), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'rect'},
+            {'name': 'London', 'orientation': -135, 'xy': (0, 3), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'london'},
+            {'name': '  ', 'orientation': 0, 'xy': (5, 5), 'color': 'bd1038', 'line_width_style': '1-solid', 'transfer': 1, 'style': 'wmata'},
+            {'name': 'A & <B>', 'orientation': 1, 'xy': (9, 9), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'circles-lg'},
+        ]
+
+        with override_settings(SVG_RENDERER='template'):
+            template_stations = copy.deepcopy(stations)
+            thumbnail = get_svg_from_shapes_by_color(shapes_by_color, 80, 1, 'wmata', points_by_color, template_stations, 3)
+            svg = add_stations_to_svg(thumbnail, 1, 'wmata', points_by_color, template_stations, 3)
+
+        for renderer in ('template', 'python'):
+            with override_settings(SVG_RENDERER=renderer):
+                thumbnail_file = io.BytesIO()
+                svg_file = io.BytesIO()
+                write_svgs(thumbnail_file, svg_file, shapes_by_color, 80, 1, 'wmata', points_by_color, copy.deepcopy(stations), 3)
+                self.assertEqual(thumbnail_file.getvalue().decode(), thumbnail)
+                self.assertEqual(svg_file.getvalue().decode(), svg)
+
+    def test_stations_drawn_independently(self):
+
+        """ Confirm that drawing stations doesn't modify them,
+                so each station is drawn the same way
+                no matter which order the stations are drawn in
+        """
+
+        # An endcap at (0,0), then a vertical line
+        points = set(self.convert_to_xy_pairs('0,0 0,1 0,2 0,3'))
+        points_by_color = {'bd1038': {'1-solid': points}}
+        stations = [
+            {'name': 'Endcap', 'orientation': 90, 'xy': (0, 0), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'london'},
+            {'name': 'Transfer', 'orientation': 135, 'xy': (0, 1), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'london', 'transfer': 1},
+            {'name': 'London', 'orientation': -135, 'xy': (0, 3), 'color': 'bd1038', 'line_width_style': '1-solid', 'style': 'london'},
+        ]
+        original = copy.deepcopy(stations)
+
+        for renderer in ('template', 'python'):
+            with override_settings(SVG_RENDERER=renderer):
+                forwards = ''.join(iter_stations_svg(1, 'wmata', points_by_color, stations, 3))
+                self.assertEqual(stations, original)
+                backwards = ''.join(iter_stations_svg(1, 'wmata', points_by_color, stations[::-1], 3))
+                self.assertEqual(stations, original)
+
+            # The endcap isn't a transfer station, so nothing connects to it
+            self.assertNotIn('class="lxci"', forwards)
+
+            for station in ('Endcap', 'Transfer', 'London'):
+                forwards_text = forwards[:forwards.index(f'>{station}</text>')].rsplit('<text', 1)[1]
+                backwards_text = backwards[:backwards.index(f'>{station}</text>')].rsplit('<text', 1)[1]
+                self.assertEqual(forwards_text, backwards_text)
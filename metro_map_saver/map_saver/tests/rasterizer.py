@@ -0,0 +1,136 @@
+from map_saver.rasterizer import (
+    InkscapeShellRasterizer,
+    SubprocessRasterizer,
+    close_rasterizer,
+    get_export_size,
+    get_rasterizer,
+)
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+import os
+import stat
+import sys
+import tempfile
+
+# Stands in for `inkscape --shell`: prints a prompt,
+#   then for each line of actions, writes the export-filename
+#   with the width and height it was given, and prompts again
+FAKE_SHELL = f'''#!{sys.executable}
+import sys
+assert sys.argv[1:] == ['--shell']
+out = sys.stdout
+out.write('Inkscape interactive shell mode.\\n> ')
+out.flush()
+for line in sys.stdin:
+    if line.strip() == 'quit':
+        break
+    actions = dict(action.partition(':')[::2] for action in line.strip().split(';'))
+    if 'hang' in actions['file-open']:
+        __import__('time').sleep(60)
+    with open(actions['export-filename'], 'w') as f:
+        f.write(f"{{actions['file-open']}} {{actions.get('export-width')}}x{{actions.get('export-height')}} {{__import__('os').getpid()}}")
+    out.write('> ')
+    out.flush()
+'''
+
+
+class RasterizerTest(TestCase):
+
+    def setUp(self):
+        close_rasterizer()
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.app_path = os.path.join(self.tempdir.name, 'fake-inkscape')
+        with open(self.app_path, 'w') as f:
+            f.write(FAKE_SHELL)
+        os.chmod(self.app_path, os.stat(self.app_path).st_mode | stat.S_IEXEC)
+
+    def tearDown(self):
+        close_rasterizer()
+        self.tempdir.cleanup()
+
+    def test_get_export_size(self):
+
+        """ Confirm the width and height are read from the conversion args
+        """
+
+        self.assertEqual((1600, 1600), get_export_size(['-w', '1600', '-h', '1600', '--export-filename']))
+        self.assertEqual((160, None), get_export_size(['--export-width', '160', '--export-filename']))
+        self.assertEqual((None, None), get_export_size([]))
+
+    def test_get_rasterizer(self):
+
+        """ Confirm the rasterizer is chosen by PNG_RASTERIZER
+                and shared until it's closed
+        """
+
+        with override_settings(PNG_RASTERIZER='subprocess', PNG_CONVERSION_APP_PATH=self.app_path):
+            rasterizer = get_rasterizer()
+            self.assertIsInstance(rasterizer, SubprocessRasterizer)
+            self.assertIs(rasterizer, get_rasterizer())
+            close_rasterizer()
+
+        with override_settings(PNG_RASTERIZER='inkscape-shell', PNG_CONVERSION_APP_PATH=self.app_path):
+            self.assertIsInstance(get_rasterizer(), InkscapeShellRasterizer)
+            close_rasterizer()
+
+        with override_settings(PNG_RASTERIZER='bogus'):
+            with self.assertRaises(ImproperlyConfigured):
+                get_rasterizer()
+
+    @override_settings(
+        PNG_CONVERSION_ARGS=['-w', '1600', '-h', '1600', '--export-filename'],
+        PNG_CONVERSION_ARGS_THUMBNAIL=['-w', '160', '-h', '160', '--export-filename'],
+    )
+    def test_inkscape_shell_rasterizer(self):
+
+        """ Confirm that one shell process draws every PNG,
+                and a new one is started if it exits
+        """
+
+        with override_settings(PNG_CONVERSION_APP_PATH=self.app_path):
+            rasterizer = InkscapeShellRasterizer()
+            pids = set()
+            for n in range(3):
+                for thumbnail in (True, False):
+                    svg_path = os.path.join(self.tempdir.name, f'{n}.svg')
+                    png_path = os.path.join(self.tempdir.name, f'{n}-{thumbnail}.png')
+                    rasterizer.rasterize(svg_path, png_path, thumbnail=thumbnail)
+                    with open(png_path) as f:
+                        drawn_svg_path, size, pid = f.read().split()
+                    self.assertEqual(svg_path, drawn_svg_path)
+                    self.assertEqual('160x160' if thumbnail else '1600x1600', size)
+                    pids.add(pid)
+            self.assertEqual(1, len(pids))
+
+            rasterizer.process.kill()
+            rasterizer.process.wait()
+            png_path = os.path.join(self.tempdir.name, 'restarted.png')
+            rasterizer.rasterize(svg_path, png_path)
+            with open(png_path) as f:
+                self.assertNotIn(f.read().split()[-1], pids)
+
+            rasterizer.close()
+            self.assertIsNone(rasterizer.process)
+
+    def test_inkscape_shell_rasterizer_timeout(self):
+
+        """ Confirm that a shell that hangs is killed,
+                and a new one draws the next PNG
+        """
+
+        with override_settings(PNG_CONVERSION_APP_PATH=self.app_path, PNG_CONVERSION_TIMEOUT=0.5):
+            rasterizer = InkscapeShellRasterizer()
+            rasterizer.rasterize('first.svg', os.path.join(self.tempdir.name, 'first.png'))
+            process = rasterizer.process
+
+            with self.assertRaisesRegex(RuntimeError, 'timed out'):
+                rasterizer.rasterize('hang.svg', os.path.join(self.tempdir.name, 'hang.png'))
+            self.assertIsNotNone(process.poll())
+            self.assertIsNone(rasterizer.process)
+
+            png_path = os.path.join(self.tempdir.name, 'next.png')
+            rasterizer.rasterize('next.svg', png_path)
+            self.assertTrue(os.path.exists(png_path))
+            rasterizer.close()
@@ -1,8 +1,19 @@
-from map_saver.models import SavedMap
+from map_saver.models import CompressedMapData, SavedMap, get_data_filepath
 from map_saver.templatetags.admin_gallery_tags import existing_maps
 
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import Client
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils.http import http_date
+
+from unittest import mock
+import copy
+import gzip
+import io
+import json
+import os
+import tempfile
 
 class SavedMapTest(TestCase):
 
@@ -118,3 +129,242 @@ class SavedMapTest(TestCase):
             saved_map.save()
 
             self.assertEqual(count, existing_maps(saved_map, 'real'))
+
+    def test_render_key(self):
+
+        """ Confirm the render key is the same for the same map data
+                no matter what order its keys are in,
+                and changes along with the map data, the renderer version,
+                or the settings for how images are drawn
+        """
+
+        data = {
+            'global': {'data_version': 3, 'map_size': 80, 'lines': {'0896d7': {'displayName': 'Blue Line'}}},
+            'points_by_color': {'0896d7': {'xys': {'1': {'1': 1, '2': 1}}}},
+        }
+        reordered = {
+            'points_by_color': {'0896d7': {'xys': {'1': {'2': 1, '1': 1}}}},
+            'global': {'lines': {'0896d7': {'displayName': 'Blue Line'}}, 'map_size': 80, 'data_version': 3},
+        }
+
+        render_key = SavedMap(urlhash='abc123', data=data).get_render_key()
+        self.assertEqual(render_key, SavedMap(urlhash='abc123', data=reordered).get_render_key())
+
+        # Maps without v2+ data use their mapdata
+        self.assertNotEqual(render_key, self.saved_map.get_render_key())
+        self.assertEqual(self.saved_map.get_render_key(), SavedMap(mapdata=self.saved_map.mapdata).get_render_key())
+
+        data['points_by_color']['0896d7']['xys']['1']['3'] = 1
+        self.assertNotEqual(render_key, SavedMap(urlhash='abc123', data=data).get_render_key())
+
+        with mock.patch('map_saver.mapdata_optimizer.RENDERER_VERSION', 3):
+            self.assertNotEqual(render_key, SavedMap(urlhash='abc123', data=reordered).get_render_key())
+
+        render_key = SavedMap(urlhash='abc123', data=reordered).get_render_key()
+        for setting, value in (
+                ('SVG_RENDERER', 'other'),
+                ('PNG_RASTERIZER', 'other'),
+                ('PNG_CONVERSION_ARGS', ['-w', '800', '-h', '800', '--export-filename']),
+                ('PNG_CONVERSION_ARGS_THUMBNAIL', ['-w', '80', '-h', '80', '--export-filename'])):
+            with self.settings(**{setting: value}):
+                self.assertNotEqual(render_key, SavedMap(urlhash='abc123', data=reordered).get_render_key())
+
+    def test_load_compressed(self):
+
+        """ Confirm that /load/ is compressed once and stored,
+                and the stored response is sent from then on
+        """
+
+        client = Client()
+        plain = client.get('/load/abc123')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        self.assertFalse(CompressedMapData.objects.exists())
+
+        response = client.get('/load/abc123', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(plain.content, gzip.decompress(response.content))
+        self.assertEqual(1, CompressedMapData.objects.filter(saved_map=self.saved_map, encoding='gzip').count())
+
+        # Served from the stored response, not the map data
+        cache.clear()
+        SavedMap.objects.filter(pk=self.saved_map.pk).update(mapdata='')
+        response = client.get('/load/abc123', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(plain.content, gzip.decompress(response.content))
+
+        # Changing the map data clears the stored responses
+        self.saved_map.set_data({'global': {'data_version': 3}, 'points_by_color': {}, 'stations': {}})
+        self.saved_map.save()
+        self.assertFalse(CompressedMapData.objects.exists())
+
+        response = client.get('/load/nonexistent', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertFalse(CompressedMapData.objects.exists())
+
+    def test_load_compressed_duplicate_urlhash(self):
+
+        """ Confirm that when more than one map has the same urlhash,
+                the stored compressed response is always the earliest map's
+        """
+
+        later = SavedMap.objects.create(urlhash='abc123', mapdata='{"global": {"lines": {}}}')
+        CompressedMapData.objects.create(
+            saved_map=later,
+            format='',
+            encoding='gzip',
+            body=gzip.compress(b'the later map'),
+        )
+
+        client = Client()
+        plain = client.get('/load/abc123')
+        self.assertIn('Blue Line', plain.content.decode('utf-8'))
+        for _ in range(2):
+            response = client.get('/load/abc123', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(plain.content, gzip.decompress(response.content))
+        self.assertEqual(1, CompressedMapData.objects.filter(saved_map=self.saved_map).count())
+
+    def test_load_conditional(self):
+
+        """ Confirm that /load/ answers conditional requests with a 304
+                before loading the map data, with an ETag and Last-Modified
+                that change along with the map data;
+                maps are cached for good until they're edited,
+                but never stored by the cache middleware
+        """
+
+        client = Client()
+        response = client.get('/load/abc123')
+        self.assertEqual(200, response.status_code)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertEqual(http_date(self.saved_map.created_at.timestamp()), response['Last-Modified'])
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        gzipped = client.get('/load/abc123', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotEqual(etag, gzipped['ETag'])
+        self.assertEqual(last_modified, gzipped['Last-Modified'])
+
+        # Answered from the map's row alone: no map data, no stored response
+        for encoding, old_etag in (('', etag), ('gzip', gzipped['ETag'])):
+            with self.assertNumQueries(1):
+                response = client.get('/load/abc123', HTTP_ACCEPT_ENCODING=encoding, HTTP_IF_NONE_MATCH=old_etag)
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(old_etag, response['ETag'])
+
+        response = client.get('/load/abc123', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+
+        response = client.get('/load/abc123', HTTP_IF_NONE_MATCH='"something-else"')
+        self.assertEqual(200, response.status_code)
+
+        # Not kept by the cache middleware: a change that skips set_data still shows up
+        cache.clear()
+        client.get('/load/abc123')
+        SavedMap.objects.filter(pk=self.saved_map.pk).update(mapdata='{"global": {"lines": {}}}')
+        self.assertNotIn('Blue Line', client.get('/load/abc123').content.decode('utf-8'))
+
+        # Editing the map changes the ETag and Last-Modified, so the old copy isn't used,
+        #   and from then on it has to be checked each time
+        self.saved_map.set_data({
+            'global': {'data_version': 3, 'map_size': 80, 'lines': {'0896d7': {'displayName': 'Blue Line'}}},
+            'points_by_color': {'0896d7': {'1-solid': {'1': {'1': 1, '2': 1}}}},
+        })
+        self.saved_map.save()
+        for encoding, old_etag in (('', etag), ('gzip', gzipped['ETag'])):
+            response = client.get('/load/abc123', HTTP_ACCEPT_ENCODING=encoding, HTTP_IF_NONE_MATCH=old_etag)
+            self.assertEqual(200, response.status_code)
+            self.assertNotEqual(old_etag, response['ETag'])
+            self.assertEqual(http_date(self.saved_map.data_updated_at.timestamp()), response['Last-Modified'])
+            self.assertIn('must-revalidate', response['Cache-Control'])
+            self.assertNotIn('immutable', response['Cache-Control'])
+        self.assertNotEqual(response['ETag'], client.get('/load/abc123?format=lines', HTTP_ACCEPT_ENCODING='gzip')['ETag'])
+
+        # Only once the map is found
+        response = client.get('/load/nonexistent', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_edit_data(self):
+
+        """ Confirm that editing .data directly (like in the Django admin)
+                re-packs it, clears the stored /load/ responses,
+                and re-writes the data files, so /load/ sends the edited map
+        """
+
+        client = Client()
+        mapdata = {
+            'global': {'data_version': 3, 'map_size': 80, 'lines': {'bd1038': {'displayName': 'Red Line'}}},
+            'points_by_color': {'bd1038': {'1-solid': {'1': {'1': 1, '2': 1}}}},
+            'stations': {},
+        }
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+            urlhash = response.content.decode('utf-8').strip().split(',')[0]
+            client.get(f'/load/{urlhash}', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertTrue(CompressedMapData.objects.exists())
+
+            # Saving without changing .data leaves everything alone
+            saved_map = SavedMap.objects.get(urlhash=urlhash)
+            saved_map.name = 'Unchanged'
+            saved_map.save()
+            self.assertTrue(CompressedMapData.objects.exists())
+
+            for y, update_fields in ((3, None), (4, ['data'])):
+                saved_map = SavedMap.objects.get(urlhash=urlhash)
+                saved_map.data['points_by_color']['bd1038']['1-solid']['1'][str(y)] = 1
+                saved_map.save(update_fields=update_fields)
+                edited = copy.deepcopy(saved_map.data)
+
+                self.assertFalse(CompressedMapData.objects.exists())
+                for encoding in ('', 'gzip'):
+                    response = client.get(f'/load/{urlhash}', HTTP_ACCEPT_ENCODING=encoding)
+                    content = gzip.decompress(response.content) if encoding else response.content
+                    self.assertEqual(edited, json.loads(content))
+                with open(os.path.join(media_root, get_data_filepath(saved_map)), 'rb') as f:
+                    self.assertEqual(edited, json.loads(f.read()))
+
+    def test_write_data_files(self):
+
+        """ Confirm that saving a map writes its data files,
+                with the same data /load/ sends,
+                and that the backfill command writes any that are missing
+        """
+
+        client = Client()
+        mapdata = {
+            'global': {'data_version': 3, 'map_size': 80, 'lines': {'bd1038': {'displayName': 'Red Line'}}},
+            'points_by_color': {'bd1038': {'1-solid': {'1': {'1': 1, '2': 1}}}},
+            'stations': {},
+        }
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+            urlhash = response.content.decode('utf-8').strip().split(',')[0]
+            saved_map = SavedMap.objects.get(urlhash=urlhash)
+
+            self.assertEqual(f'data/{saved_map.pk // 1000}/{urlhash}.json', get_data_filepath(saved_map))
+            with open(os.path.join(media_root, get_data_filepath(saved_map)), 'rb') as f:
+                content = f.read()
+            with open(os.path.join(media_root, get_data_filepath(saved_map, compressed=True)), 'rb') as f:
+                self.assertEqual(content, gzip.decompress(f.read()))
+            self.assertEqual(saved_map.get_data(), json.loads(content))
+            self.assertEqual(content, client.get(f'/load/{urlhash}').content.strip())
+
+            # Classic maps too
+            call_command('write_data_files', stdout=io.StringIO())
+            with open(os.path.join(media_root, get_data_filepath(self.saved_map)), 'rb') as f:
+                self.assertEqual(json.loads(self.saved_map.mapdata), json.loads(f.read()))
+
+            output = io.StringIO()
+            call_command('write_data_files', stdout=output)
+            self.assertIn('Wrote data files for 0 maps', output.getvalue())
+
+        # Maps still save if the files can't be written
+        with tempfile.NamedTemporaryFile() as not_a_directory:
+            with override_settings(MEDIA_ROOT=not_a_directory.name), self.assertLogs('map_saver.models', 'ERROR'):
+                mapdata['points_by_color']['bd1038']['1-solid']['3'] = {'3': 1}
+                response = client.post('/save/', {'metroMap': json.dumps(mapdata)})
+        urlhash = response.content.decode('utf-8').strip().split(',')[0]
+        self.assertTrue(SavedMap.objects.filter(urlhash=urlhash).exists())
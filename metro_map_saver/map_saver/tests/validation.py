@@ -1,12 +1,29 @@
+import io
 import json
-from unittest import expectedFailure
+from unittest import expectedFailure, mock
 
 from map_saver.forms import CreateMapForm
+from map_saver.importer import MapImport
 from map_saver.models import SavedMap
-from map_saver.validator import validate_metro_map
-
-from django.test import TestCase, Client
+from map_saver.validator import (
+    MAX_LINES,
+    MAX_MAP_DATA_BYTES,
+    MAX_MAP_SIZE,
+    MAX_NAME_LENGTH,
+    MAX_SAVE_REQUEST_BYTES,
+    MAX_STATIONS,
+    check_map_data_budget,
+    check_map_data_size,
+    validate_metro_map,
+    validate_metro_map_v3,
+)
+
+from django.conf import settings
+from django.test import TestCase, Client, override_settings
+from django.core.management import call_command
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError
+from django.forms import ValidationError
 
 class PostMapDataMixin:
     def _post_metromap(self, metro_map):
@@ -393,6 +410,7 @@ class ValidateMapV2(TestCase):
                 mapdata['global']['data_version'],
             )
 
+    @override_settings(CONVERT_V1_MAPS_ON_SAVE=False)
     def test_convert_v1_to_v2(self):
 
         """ Confirm that we can convert v1 maps to v2 and it's valid
@@ -917,6 +935,7 @@ class ValidateMap(PostMapDataMixin, TestCase):
             metro_map = {"global": {"lines": {"000000": {"displayName": "Black Line"} } }, "1": {"1": {"line": "000000", "station": {"name": "OK", "lines": ["ffffff"]} } } }
             validate_metro_map(metro_map)
 
+    @override_settings(CONVERT_V1_MAPS_ON_SAVE=False)
     def test_valid_map_saves(self):
 
         """ Confirm that a posting a valid map will save it
@@ -924,7 +943,7 @@ class ValidateMap(PostMapDataMixin, TestCase):
 
         # First, confirm that we do not have this map yet
         with self.assertRaises(ObjectDoesNotExist):
-            SavedMap.objects.get(urlhash='I0F8Rza4')
+            SavedMap.objects.get(urlhash='UkuCzTus')
 
         map_data = json.dumps({"8":{"8":{"line":"bd1038"}},"global":{"lines":{"0896d7":{"displayName":"Blue Line"},"df8600":{"displayName":"Orange Line"},"000000":{"displayName":"Logo"},"00b251":{"displayName":"Green Line"},"662c90":{"displayName":"Purple Line"},"a2a2a2":{"displayName":"Silver Line"},"f0ce15":{"displayName":"Yellow Line"},"bd1038":{"displayName":"Red Line"},"79bde9":{"displayName":"Rivers"},"cfe4a7":{"displayName":"Parks"}}}})
 
@@ -933,7 +952,7 @@ class ValidateMap(PostMapDataMixin, TestCase):
             'metroMap': map_data
         })
 
-        saved_map = SavedMap.objects.get(urlhash='I0F8Rza4')
+        saved_map = SavedMap.objects.get(urlhash='UkuCzTus')
         self.assertTrue(saved_map)
 
         # Confirm that multiple posts with the same data return the same urlhash
@@ -942,9 +961,24 @@ class ValidateMap(PostMapDataMixin, TestCase):
         })
 
         self.assertEqual(
-            b'I0F8Rza4',
+            b'UkuCzTus',
             response.content.strip().split(b',')[0]
         )
+        self.assertEqual(1, SavedMap.objects.filter(urlhash='UkuCzTus').count())
+
+        # The same map with its keys in a different order is the same map
+        response = client.post('/save/', {
+            'metroMap': json.dumps(dict(reversed(json.loads(map_data).items())))
+        })
+        self.assertEqual(b'UkuCzTus,', response.content.strip())
+        self.assertEqual(1, SavedMap.objects.filter(urlhash='UkuCzTus').count())
+
+        # Any other failure to save isn't mistaken for the map already being saved
+        other_map = json.loads(map_data)
+        other_map['9'] = {'9': {'line': 'bd1038'}}
+        with mock.patch.object(SavedMap.objects, 'create', side_effect=IntegrityError('NOT NULL constraint failed')):
+            with self.assertRaises(IntegrityError):
+                client.post('/save/', {'metroMap': json.dumps(other_map)})
 
         # Confirm that the mapdata and urlhash are both identical to the original
         # ... well, close to identical, anyway. validation adds some extra info:
@@ -958,9 +992,48 @@ class ValidateMap(PostMapDataMixin, TestCase):
         )
         self.assertEqual(
             saved_map.urlhash,
-            'I0F8Rza4'
+            'UkuCzTus'
         )
 
+    @override_settings(CONVERT_V1_MAPS_ON_SAVE=False)
+    def test_legacy_map_saves(self):
+
+        """ Confirm that a map saved before .data_hash was added
+                is found by its old urlhash when it's saved again,
+                and by its .data_hash once oneoff_backfill_data_hash has been run
+        """
+
+        map_data = json.dumps({"8":{"8":{"line":"bd1038"}},"global":{"lines":{"0896d7":{"displayName":"Blue Line"},"df8600":{"displayName":"Orange Line"},"000000":{"displayName":"Logo"},"00b251":{"displayName":"Green Line"},"662c90":{"displayName":"Purple Line"},"a2a2a2":{"displayName":"Silver Line"},"f0ce15":{"displayName":"Yellow Line"},"bd1038":{"displayName":"Red Line"},"79bde9":{"displayName":"Rivers"},"cfe4a7":{"displayName":"Parks"}}}})
+
+        client = Client()
+        client.post('/save/', {'metroMap': map_data})
+        data_hash = SavedMap.objects.get(urlhash='UkuCzTus').data_hash
+
+        # As it would have been saved before .data_hash was added
+        SavedMap.objects.filter(urlhash='UkuCzTus').update(urlhash='I0F8Rza4', data_hash=None)
+        response = client.post('/save/', {'metroMap': map_data})
+        self.assertEqual(b'I0F8Rza4,', response.content.strip())
+        self.assertEqual(1, SavedMap.objects.count())
+
+        importer = MapImport().import_lines([map_data])
+        self.assertEqual((0, 1), (importer.created, importer.duplicates))
+        self.assertEqual(1, SavedMap.objects.count())
+
+        # The same map saved twice back then; only the earliest gets the .data_hash
+        duplicate = SavedMap.objects.create(urlhash='I0F8Rza4', mapdata=SavedMap.objects.get().mapdata)
+        output = io.StringIO()
+        call_command('oneoff_backfill_data_hash', stdout=output)
+        self.assertIn('for 1 maps; 1 were duplicates', output.getvalue())
+        self.assertEqual(data_hash, SavedMap.objects.earliest('id').data_hash)
+        duplicate.refresh_from_db()
+        self.assertIsNone(duplicate.data_hash)
+        duplicate.delete()
+
+        with override_settings(LEGACY_URLHASH_LOOKUP=False):
+            response = client.post('/save/', {'metroMap': map_data})
+            self.assertEqual(b'I0F8Rza4,', response.content.strip())
+            self.assertEqual(1, SavedMap.objects.count())
+
     def test_valid_map_name(self):
 
         """ Confirm that a post containing the proper naming token will allow you to name a map
@@ -1083,6 +1156,161 @@ class ValidateMap(PostMapDataMixin, TestCase):
             # 73 = 8 character urlhash + comma + 64 char naming token
             self.assertTrue(len(response), 73)
 
+    def test_v1_saves_as_v3(self):
+
+        """ Confirm that a v1 map is saved as the same map in v3
+        """
+
+        mmap_v1 = {
+            "10": {
+                "10": {"line": "008800", "station": {"name": "A<b>", "orientation": "-135", "style": "rect", "lines": ["008800"], "transfer": 1}},
+                "11": {"line": "008800"},
+                "100": {"line": "bd1038"},
+                "101": {"line": "ffffff"},
+            },
+            "2": {"3": {"line": "bd1038", "station": {"name": "", "lines": []}}},
+            "global": {
+                "lines": {"008800": {"displayName": "Green Line"}, "bd1038": {"displayName": "Red Line"}},
+                "style": {"mapLineWidth": 0.5, "mapStationStyle": "circles-md"},
+            },
+        }
+
+        urlhash = self._post_metromap(json.dumps(mmap_v1)).strip().split(',')[0]
+        saved_map = SavedMap.objects.get(urlhash=urlhash)
+        self.assertFalse(saved_map.mapdata)
+        self.assertEqual(3, saved_map.data['global']['data_version'])
+        self.assertEqual(
+            {"mapLineWidth": 0.5, "mapLineStyle": "solid", "mapStationStyle": "circles-md"},
+            saved_map.data['global']['style'],
+        )
+        self.assertEqual(120, saved_map.data['global']['map_size'])
+        self.assertEqual(
+            {
+                "008800": {"0.5-solid": {"10": {"10": 1, "11": 1}}},
+                "bd1038": {"0.5-solid": {"10": {"100": 1}, "2": {"3": 1}}},
+            },
+            saved_map.data['points_by_color'],
+        )
+        self.assertEqual(
+            {
+                "10": {"10": {"name": "Ab", "orientation": -135, "style": "rect", "transfer": 1}},
+                "2": {"3": {"name": "_", "orientation": 0}},
+            },
+            saved_map.data['stations'],
+        )
+        self.assertEqual(2, saved_map.station_count)
+
+        # Already valid as v3
+        self.assertEqual(saved_map.data, validate_metro_map_v3(json.loads(json.dumps(saved_map.data))))
+
+    def test_map_data_too_large(self):
+
+        """ Reject map data that's too big before it's parsed,
+                and map data that's too deeply nested to parse
+        """
+
+        metro_map = {
+            "global": {"lines": {"bd1038": {"displayName": "Red Line"}}},
+            "points_by_color": {"bd1038": {"1-solid": {"1": {"1": 1}}}},
+        }
+
+        check_map_data_size(json.dumps(metro_map))
+
+        self.assertIn(
+            "This map is not in a format that can be saved.",
+            self._post_metromap('{"global": ' + '[' * 100000 + ']' * 100000 + '}')
+        )
+
+        metro_map["global"]["extra"] = "x" * MAX_MAP_DATA_BYTES
+        self.assertIn(
+            "This map is too large to save.",
+            self._post_metromap(json.dumps(metro_map))
+        )
+
+        # Counted in bytes, not characters
+        metro_map["global"]["extra"] = "é" * (MAX_MAP_DATA_BYTES // 2)
+        self.assertLess(len(json.dumps(metro_map, ensure_ascii=False)), MAX_MAP_DATA_BYTES)
+        with self.assertRaises(ValidationError):
+            check_map_data_size(json.dumps(metro_map, ensure_ascii=False))
+        self.assertFalse(SavedMap.objects.exists())
+
+    def test_map_data_budget(self):
+
+        """ Reject map data with too many colors, width/styles, points or stations
+                before it's validated
+        """
+
+        too_many = [
+            ("B-03", {"points_by_color": {f"{n:06}": {} for n in range(101)}}),
+            ("B-04", {"points_by_color": {"bd1038": {f"{n}-solid": {} for n in range(71)}}}),
+            ("B-05", {"points_by_color": {
+                color: {"xys": {str(x): {str(y): 1 for y in range(360)} for x in range(360)}}
+                for color in ("bd1038", "0896d7")
+            }}),
+            ("B-05", {str(x): {str(y): {"line": "bd1038"} for y in range(361)} for x in range(360)}),
+            ("B-06", {"points_by_color": {}, "stations": {str(x): {str(y): {} for y in range(361)} for x in range(360)}}),
+        ]
+        for error, metro_map in too_many:
+            with self.assertRaisesRegex(ValidationError, error):
+                check_map_data_budget(metro_map)
+
+        self.assertIn(
+            "This map has too many colors",
+            self._post_metromap(json.dumps(too_many[0][1]))
+        )
+
+        # Full-size maps are fine
+        check_map_data_budget({"points_by_color": {"bd1038": {"1-solid": {str(x): {str(y): 1 for y in range(360)} for x in range(360)}}}})
+        check_map_data_budget({str(x): {str(y): {"line": "bd1038"} for y in range(360)} for x in range(360)})
+
+    def test_max_size_maps_save(self):
+
+        """ Confirm that the largest maps the limits allow
+                (every point, MAX_STATIONS stations and MAX_LINES lines, with the longest names)
+                fit under the size caps and can be saved, both as v1 and v3
+        """
+
+        name = '漢' * MAX_NAME_LENGTH
+        colors = [f'{n:06x}' for n in range(MAX_LINES)]
+        lines = {color: {'displayName': name} for color in colors}
+        station_xys = [(x, y) for x in range(MAX_MAP_SIZE) for y in range(MAX_MAP_SIZE)][:MAX_STATIONS]
+        station = {'name': name, 'orientation': -45, 'style': 'rect-round', 'transfer': 1}
+
+        v1_map = {
+            str(x): {str(y): {'line': colors[x % MAX_LINES]} for y in range(MAX_MAP_SIZE)}
+            for x in range(MAX_MAP_SIZE)
+        }
+        for x, y in station_xys:
+            v1_map[str(x)][str(y)]['station'] = dict(station, lines=[])
+        v1_map['global'] = {'lines': lines}
+
+        v3_map = {
+            'global': {'data_version': 3, 'map_size': MAX_MAP_SIZE, 'lines': lines},
+            'points_by_color': {
+                color: {'1-solid': {str(x): {str(y): 1 for y in range(MAX_MAP_SIZE)} for x in range(MAX_MAP_SIZE) if x % MAX_LINES == n}}
+                for n, color in enumerate(colors)
+            },
+            'stations': {},
+        }
+        for x, y in station_xys:
+            v3_map['stations'].setdefault(str(x), {})[str(y)] = station
+
+        self.assertGreaterEqual(settings.DATA_UPLOAD_MAX_MEMORY_SIZE, MAX_SAVE_REQUEST_BYTES)
+
+        client = Client()
+        for metro_map in (v1_map, v3_map):
+            raw = json.dumps(metro_map, ensure_ascii=False)
+            self.assertLess(len(raw.encode('utf-8')), MAX_MAP_DATA_BYTES)
+            check_map_data_budget(metro_map)
+
+            response = client.post('/save/', {'metroMap': raw})
+            self.assertLess(int(response.wsgi_request.META['CONTENT_LENGTH']), MAX_SAVE_REQUEST_BYTES)
+            urlhash = response.content.decode('utf-8').strip().split(',')[0]
+            self.assertNotIn('ERROR', urlhash)
+            saved_stations = SavedMap.objects.get(urlhash=urlhash).get_data()['stations']
+            self.assertEqual(len(station_xys), sum(len(ys) for ys in saved_stations.values()))
+
+    @override_settings(CONVERT_V1_MAPS_ON_SAVE=False)
     def test_valid_map_v1_allows_styles(self):
 
         """ Confirm that styles can be backported to v1
@@ -1124,6 +1352,7 @@ class ValidateMap(PostMapDataMixin, TestCase):
                 metro_map['global']['style'],
             )
 
+    @override_settings(CONVERT_V1_MAPS_ON_SAVE=False)
     def test_orientation_string_to_int(self):
 
         """ Confirm that string orientations will be converted to ints
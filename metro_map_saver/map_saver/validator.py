@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import json
 import logging
 import re
@@ -12,6 +14,9 @@ logger = logging.getLogger(__name__)
 ALLOWED_MAP_SIZES = [80, 120, 160, 200, 240, 300, 360]
 MAX_MAP_SIZE = ALLOWED_MAP_SIZES[-1]
 VALID_XY = [str(x) for x in range(MAX_MAP_SIZE)]
+# Constant-time check for whether an x or y coordinate is in VALID_XY,
+#   and its integer value if it is
+XY_INTS = {xy: int(xy) for xy in VALID_XY}
 ALLOWED_LINE_WIDTHS = [1, 0.75, 0.5, 0.25, 0.125]
 # Note: hollow_round works; I only need to add it to ALLOWED_LINE_STYLES to re-add the functionality .
 ALLOWED_LINE_STYLES = ['solid', 'dashed', 'dashed_uneven', 'dense_thin', 'dense_thick', 'dotted_dense', 'dotted', 'dotted_square', 'hollow', 'hollow_open', 'color_outline', 'wide_stripes', 'square_stripes', 'stripes']
@@ -42,6 +47,28 @@ for allowed_width in ALLOWED_LINE_WIDTHS:
         # ALLOWED_LINE_WIDTH_STYLES has been populated
         ALLOWED_LINE_WIDTH_STYLES.append(f'{allowed_width}-{allowed_style}')
 
+# Limits on what will even be parsed and validated (see check_map_data_size, check_map_data_budget);
+#   well beyond anything the editor can make, so only hostile or broken maps reach them
+MAX_LINES = 100 # The editor allows up to 100 colors
+MAX_POINTS = MAX_MAP_SIZE * MAX_MAP_SIZE
+MAX_STATIONS = 10000
+MAX_NAME_LENGTH = 255 # For line and station names
+
+# The most bytes each point, station and line can take up in posted map data:
+#   a v1 point names its color, and every character of a name can take 3 bytes as UTF-8
+MAX_POINT_BYTES = len('"359": {"line": "bd1038"}, ')
+MAX_STATION_BYTES = len('"359": {"name": "", "orientation": "-45", "style": "rect-round", "transfer": 1}, ') + 3 * MAX_NAME_LENGTH
+MAX_LINE_BYTES = len('"bd1038": {"displayName": ""}, ') + 3 * MAX_NAME_LENGTH
+# So the largest map those limits allow (plus headroom for anything else in it) can always be saved
+MAX_MAP_DATA_BYTES = int(1.25 * (
+    MAX_POINTS * MAX_POINT_BYTES +
+    MAX_STATIONS * MAX_STATION_BYTES +
+    MAX_LINES * MAX_LINE_BYTES
+))
+# The map data is posted form-encoded, which can take up to 3 bytes per byte;
+#   settings.DATA_UPLOAD_MAX_MEMORY_SIZE must be at least this
+MAX_SAVE_REQUEST_BYTES = 3 * MAX_MAP_DATA_BYTES + 1024
+
 def is_hex(string):
 
     """ Determines whether a string is a hexademical string (0-9, a-f) or not
@@ -79,6 +106,31 @@ def hex64(hexdigest):
 
     return '{0}{1}{2}{3}'.format(hex2b64(hexdigest[:3]), hex2b64(hexdigest[3:6]), hex2b64(hexdigest[6:9]), hex2b64(hexdigest[9:]))
 
+def canonical_json(mapdata):
+
+    """ Serializes mapdata the same way every time,
+            no matter what order its keys are in,
+            so identical maps always hash identically
+    """
+
+    return json.dumps(mapdata, sort_keys=True, separators=(',', ':'))
+
+def get_data_hash(mapdata):
+
+    """ The sha256 of mapdata as canonical JSON,
+            stored as SavedMap.data_hash; the urlhash is made from it
+    """
+
+    return hashlib.sha256(canonical_json(mapdata).encode('utf-8')).hexdigest()
+
+def get_legacy_urlhash(mapdata):
+
+    """ The urlhash that maps were given before .data_hash was added,
+            made from the Python repr of the map data
+    """
+
+    return hex64(hashlib.sha256(str(mapdata).encode('utf-8')).hexdigest()[:12])
+
 def sanitize_string(string):
     return string.replace('<', '').replace('>', '').replace('"', '').replace("'", '&#x27;').replace('&', '&amp;').replace('/', '&#x2f;').replace('\x1b', '').replace('\\', '').replace('\t', ' ').replace('\n', ' ').replace('\b', ' ').replace('%', '')
 
@@ -121,6 +173,65 @@ def get_map_size(highest_xy_seen):
             return allowed_size
     return ALLOWED_MAP_SIZES[-1]
 
+def check_map_data_size(raw):
+
+    """ Rejects map data that's too big (in bytes, as UTF-8) before it's parsed
+    """
+
+    # No character takes more than 4 bytes, so short enough data needn't be encoded to check
+    if isinstance(raw, str) and len(raw) * 4 > MAX_MAP_DATA_BYTES:
+        raw = raw.encode('utf-8', errors='surrogatepass')
+
+    if len(raw) > MAX_MAP_DATA_BYTES:
+        raise ValidationError(f"[VALIDATIONFAILED] B-01 {len(raw)} BYTES: This map is too large to save.")
+
+def check_map_data_budget(metro_map):
+
+    """ Before parsed map data is validated, rejects any that has too many
+            colors, width/styles, points or stations to be worth validating.
+
+        Only the sizes of the dicts are counted, not the points in them,
+            so this costs very little next to validating.
+    """
+
+    if not isinstance(metro_map, dict):
+        return
+
+    points = stations = 0
+    points_by_color = metro_map.get('points_by_color')
+    if isinstance(points_by_color, dict):
+        # v2+: points_by_color[color][line_width_style (or 'xys', for v2)][x][y]
+        if len(points_by_color) > MAX_LINES:
+            raise ValidationError(f"[VALIDATIONFAILED] B-03 {len(points_by_color)} COLORS: This map has too many colors (limit is {MAX_LINES}); remove unused colors.")
+        for width_styles in points_by_color.values():
+            if not isinstance(width_styles, dict):
+                continue
+            if len(width_styles) > len(ALLOWED_LINE_WIDTH_STYLES):
+                raise ValidationError(f"[VALIDATIONFAILED] B-04 {len(width_styles)} WIDTH/STYLES: This map has too many line widths and styles.")
+            for xys in width_styles.values():
+                if not isinstance(xys, dict):
+                    continue
+                for ys in xys.values():
+                    if isinstance(ys, dict):
+                        points += len(ys)
+
+        station_xs = metro_map.get('stations')
+        if isinstance(station_xs, dict):
+            for ys in station_xs.values():
+                if isinstance(ys, dict):
+                    stations += len(ys)
+    else:
+        # v1: metro_map[x][y], with the stations on the points
+        for x, ys in metro_map.items():
+            if x in XY_INTS and isinstance(ys, dict):
+                points += len(ys)
+
+    if points > MAX_POINTS:
+        raise ValidationError(f"[VALIDATIONFAILED] B-05 {points} POINTS: This map has too many points.")
+
+    if stations > MAX_STATIONS:
+        raise ValidationError(f"[VALIDATIONFAILED] B-06 {stations} STATIONS: This map has too many stations (limit is {MAX_STATIONS}).")
+
 def validate_metro_map_v3(metro_map):
 
     """ Validate the MetroMap object, allowing mixing and matching line widths/styles.
@@ -229,99 +340,109 @@ def validate_metro_map_v3(metro_map):
     }
 
     # Points by Color
+    # Each dict is looked up once and each coordinate converted once,
+    #   and skipped points are only counted (by reason), since a hostile map
+    #   can have 130,000 of them
     all_points_seen = set() # Must confirm that stations exist on these points
-    points_skipped = []
+    points_skipped = collections.Counter()
     highest_xy_seen = -1 # Because 0 is a point
     valid_points_by_color = {}
-    for color in metro_map['points_by_color']:
+    for color, width_styles in metro_map['points_by_color'].items():
         if color not in validated_metro_map['global']['lines']:
-            points_skipped.append(f'Color {color} not in global')
+            points_skipped['Color not in global'] += 1
             continue
 
-        if not isinstance(metro_map['points_by_color'][color], dict):
-            points_skipped.append(f'BAD LINE WIDTH/STYLE at {color} (non-dict)')
+        if not isinstance(width_styles, dict):
+            points_skipped['BAD LINE WIDTH/STYLE (non-dict)'] += 1
             continue
 
-        for line_width_style in metro_map['points_by_color'][color]:
+        for line_width_style, xys in width_styles.items():
 
-            if not isinstance(metro_map['points_by_color'][color][line_width_style], dict):
-                points_skipped.append(f'BAD COORDS at {color} for {line_width_style}')
+            if not isinstance(xys, dict):
+                points_skipped['BAD COORDS'] += 1
                 continue
 
             if line_width_style not in ALLOWED_LINE_WIDTH_STYLES:
-                points_skipped.append(f'BAD LINE WIDTH/STYLE at {color}: {line_width_style}')
+                # Counted, but its points are still kept
+                points_skipped['BAD LINE WIDTH/STYLE'] += 1
 
-            for x in metro_map['points_by_color'][color][line_width_style]:
-                if not isinstance(metro_map['points_by_color'][color][line_width_style][x], dict):
-                    points_skipped.append(f'BAD X at {color}: {x}')
+            valid_xys = None
+            for x, ys in xys.items():
+                if not isinstance(ys, dict):
+                    points_skipped['BAD X'] += 1
                     continue
 
-                if not x.isdigit():
-                    points_skipped.append(f'NONINT X at {color}: {x}')
-                    continue
+                x_int = XY_INTS.get(x)
+                if x_int is None:
+                    # Not in its usual form (like '07'), but might still be allowed
+                    if not x.isdigit():
+                        points_skipped['NONINT X'] += 1
+                        continue
 
-                if int(x) < 0 or int(x) >= MAX_MAP_SIZE:
-                    points_skipped.append(f'OOB X at {color}: {x}')
-                    continue
+                    x_int = int(x)
+                    if x_int >= MAX_MAP_SIZE:
+                        points_skipped['OOB X'] += 1
+                        continue
 
-                for y in metro_map['points_by_color'][color][line_width_style][x]:
+                valid_ys = None
+                for y, value in ys.items():
 
-                    if not y.isdigit():
-                        points_skipped.append(f'NONINT Y at {color}: {x},{y}')
-                        continue
+                    y_int = XY_INTS.get(y)
+                    if y_int is None:
+                        if not y.isdigit():
+                            points_skipped['NONINT Y'] += 1
+                            continue
 
-                    if int(y) < 0 or int(y) >= MAX_MAP_SIZE:
-                        points_skipped.append(f'OOB Y at {color}: {x},{y}')
-                        continue
+                        y_int = int(y)
+                        if y_int >= MAX_MAP_SIZE:
+                            points_skipped['OOB Y'] += 1
+                            continue
 
                     if (x, y) in all_points_seen:
                         # Already seen in another color
-                        points_skipped.append(f'SKIPPING {color} POINT {x},{y}, ALREADY SEEN')
+                        points_skipped['ALREADY SEEN'] += 1
                         continue
 
-                    if metro_map['points_by_color'][color][line_width_style][x][y] == 1:
+                    if value == 1:
                         # Originally I'd considered setting the line width / style at the [x][y],
                         #   but I think it's better recorded at points_by_color[color][line_width_style]
                         all_points_seen.add((x, y))
 
-                        if int(x) > highest_xy_seen:
-                            highest_xy_seen = int(x)
-
-                        if int(y) > highest_xy_seen:
-                            highest_xy_seen = int(y)
+                        if x_int > highest_xy_seen:
+                            highest_xy_seen = x_int
 
-                        if not valid_points_by_color.get(color):
-                            valid_points_by_color[color] = {line_width_style: {}}
-                        elif not valid_points_by_color[color].get(line_width_style):
-                            valid_points_by_color[color][line_width_style] = {}
+                        if y_int > highest_xy_seen:
+                            highest_xy_seen = y_int
 
-                        if not valid_points_by_color[color][line_width_style].get(x):
-                            valid_points_by_color[color][line_width_style][x] = {}
+                        if valid_ys is None:
+                            if valid_xys is None:
+                                valid_xys = valid_points_by_color.setdefault(color, {}).setdefault(line_width_style, {})
+                            valid_ys = valid_xys.setdefault(x, {})
 
-                        valid_points_by_color[color][line_width_style][x][y] = 1
+                        valid_ys[y] = 1
 
     validated_metro_map['points_by_color'] = valid_points_by_color
     if points_skipped:
-        logger.warn(f'Points skipped: {len(points_skipped)} Details: {points_skipped}')
+        logger.warning(f'Points skipped: {sum(points_skipped.values())} Details: {dict(points_skipped)}')
 
     # Stations
-    stations_skipped = []
+    stations_skipped = collections.Counter()
     valid_stations = {}
     if metro_map.get('stations') and isinstance(metro_map['stations'], dict):
-        for x in metro_map['stations']:
-            if not isinstance(metro_map['stations'][x], dict):
-                stations_skipped.append(f'STA BAD X: {x}')
+        for x, stations_this_x in metro_map['stations'].items():
+            if not isinstance(stations_this_x, dict):
+                stations_skipped['STA BAD X'] += 1
                 continue
-            for y in metro_map['stations'][x]:
-                if not isinstance(metro_map['stations'][x][y], dict):
-                    stations_skipped.append(f'STA BAD Y: {y}')
+            for y, map_station in stations_this_x.items():
+                if not isinstance(map_station, dict):
+                    stations_skipped['STA BAD Y'] += 1
                     continue
 
                 if (x, y) not in all_points_seen:
-                    stations_skipped.append(f'STA BAD POS: {x},{y}')
+                    stations_skipped['STA BAD POS'] += 1
                     continue
 
-                station_name = metro_map['stations'][x][y].get('name', '_') or '_'
+                station_name = map_station.get('name', '_') or '_'
                 if len(station_name) < 1:
                     station_name = '_'
                 elif len(station_name) > 255:
@@ -330,7 +451,7 @@ def validate_metro_map_v3(metro_map):
                 station = {'name': station_name}
 
                 try:
-                    station_orientation = int(metro_map['stations'][x][y].get('orientation', ALLOWED_ORIENTATIONS[0]))
+                    station_orientation = int(map_station.get('orientation', ALLOWED_ORIENTATIONS[0]))
                 except Exception:
                     station_orientation = ALLOWED_ORIENTATIONS[0]
 
@@ -338,22 +459,19 @@ def validate_metro_map_v3(metro_map):
                     station_orientation = ALLOWED_ORIENTATIONS[0]
                 station['orientation'] = station_orientation
 
-                station_style = metro_map['stations'][x][y].get('style')
+                station_style = map_station.get('style')
                 if station_style and station_style in ALLOWED_STATION_STYLES:
                     station['style'] = station_style
 
-                if metro_map['stations'][x][y].get('transfer'):
+                if map_station.get('transfer'):
                     station['transfer'] = 1
 
                 # This station is valid, add it
-                if not valid_stations.get(x):
-                    valid_stations[x] = {}
-
-                valid_stations[x][y] = station
+                valid_stations.setdefault(x, {})[y] = station
     validated_metro_map['stations'] = valid_stations
 
     if stations_skipped:
-        logger.warn(f'Stations skipped: {len(stations_skipped)} Details: {stations_skipped}')
+        logger.warning(f'Stations skipped: {sum(stations_skipped.values())} Details: {dict(stations_skipped)}')
 
     # TODO: Add support for labels
 
@@ -587,9 +705,13 @@ def validate_metro_map_v2(metro_map):
 
     return validated_metro_map
 
-def validate_metro_map(metro_map):
+def validate_metro_map(metro_map, as_v3=False):
     
     """ Validate the MetroMap object by re-constructing it using only valid entries.
+
+        With as_v3, the valid entries are returned as a v3 map
+            (like validate_metro_map_v3 returns) instead of a v1 map,
+            so v1 maps never need to be converted later.
     """
 
     # root-level can only contain keys 0-79 and the key global
@@ -622,13 +744,13 @@ def validate_metro_map(metro_map):
         # and the map could fail to validate for other reasons,
         # but at least this check will pass if there are lines in the mapdata itself
         inferred_lines = {}
-        for x in metro_map.keys():
-            if x == 'global' or x not in VALID_XY:
+        for x, cells in metro_map.items():
+            if x not in XY_INTS:
                 continue
-            for y in metro_map[x].keys():
-                if y not in VALID_XY:
+            for y in cells.keys():
+                if y not in XY_INTS:
                     continue
-                line = metro_map[x][y].get('line')
+                line = cells[y].get('line')
                 if line:
                     inferred_lines[line] = {'displayName': line}
         if inferred_lines:
@@ -683,66 +805,105 @@ def validate_metro_map(metro_map):
             'displayName': sanitize_string(metro_map['global']['lines'][global_line]['displayName'])
         }
 
-    for x in metro_map.keys():
-        if x == 'global' or x not in VALID_XY:
+    if as_v3:
+        line_width_style = f'{line_width}-solid'
+        points_by_color = {}
+        stations = {}
+        highest_xy_seen = -1
+
+    # One pass over every point; XY_INTS is a constant-time check
+    #   that a coordinate is valid, unlike scanning VALID_XY
+    for x, cells in metro_map.items():
+        if x not in XY_INTS or not cells:
             continue
-        if metro_map.get(x):
-            if not validated_metro_map.get(x):
-                validated_metro_map[x] = {}
-            for y in metro_map[x].keys():
-                if y not in VALID_XY:
-                    continue
-                if metro_map[x].get(y):
-                    if not validated_metro_map[x].get(y):
-                        validated_metro_map[x][y] = {}
-                    assert is_hex(metro_map[x][y]["line"]), "[VALIDATIONFAILED] 08 {0} at ({1}, {2}) FAILED is_hex(): Point at ({3}, {4}) is not a valid color: {0}.".format(metro_map[x][y]["line"], x, y, int(x) + 1, int(y) + 1)
-                    assert len(metro_map[x][y]["line"]) == 6, "[VALIDATIONFAILED] 09 {0} at ({1}, {2}) IS NOT 6 CHARACTERS: Point at ({3}, {4}) has a color that needs to be 6 characters long: {0}".format(metro_map[x][y]["line"], x, y, int(x) + 1, int(y) + 1)
-                    try:
-                        assert metro_map[x][y]["line"] in valid_lines, "[VALIDATIONFAILED] 10 {0} at ({1}, {2}) NOT IN valid_lines: Point at ({3}, {4}) has a color that is not defined in the rail lines; please create a line matching the color {0}.".format(metro_map[x][y]["line"], x, y, int(x) + 1, int(y) + 1)
-                    except AssertionError:
-                        del validated_metro_map[x][y] # delete this coordinate or it'll be undefined
-                        continue # If the line isn't in valid_lines, we could just not add it
-                    else:
-                        validated_metro_map[x][y]["line"] = metro_map[x][y]["line"]
-                    if metro_map[x][y].get('station'):
-                        assert type(metro_map[x][y]["station"]) == dict, "[VALIDATIONFAILED] 11 metro_map[x][y]['station'] at ({0}, {1}) IS NOT DICT: Point at ({2}, {3}) has a malformed station, must be an object.".format(x, y, int(x) + 1, int(y) + 1)
-                        metro_map[x][y]["station"]["name"] = sanitize_string_without_html_entities(metro_map[x][y]["station"]["name"])
-                        if metro_map[x][y]["station"]["name"] == '':
-                            metro_map[x][y]["station"]["name"] = "_" # Gracefully rename a zero-length station name to be a single space
-                        assert 1 <= len(metro_map[x][y]["station"]["name"]) < 256, "[VALIDATIONFAILED] 12 station name at ({0}, {1}) BAD SIZE {2} is {3}: Point at ({4}, {5}) has a station whose name is not between 1 and 255 characters long. Please rename it.".format(x, y, metro_map[x][y]["station"]["name"], len(metro_map[x][y]["station"]["name"]), int(x) + 1, int(y) + 1)
-                        assert type(metro_map[x][y]["station"].get("lines", [])) == list, "[VALIDATIONFAILED] 13 station lines at ({0}, {1}) NOT A LIST: Point at ({2}, {3}) has its station lines in the incorrect format; must be a list.".format(x, y, int(x) + 1, int(y) + 1)
-                        # Okay, this probably *should* pass - but I think I have some bug in the javascript somewhere because https://metromapmaker.com/?map=zCq7R223 obviously passed validation but once reconstituted, fails. But this isn't a big enough deal that I can't wave this validation through while I figure out what's going on.
-                        # assert len(metro_map[x][y]["station"]["lines"]) > 0, "[VALIDATIONFAILED] 14: station lines at ({0}, {1}) HAS ZERO LENGTH".format(x, y)
-                        validated_metro_map[x][y]["station"] = {
-                            # "name": html_dom_id_safe(metro_map[x][y]["station"]["name"].replace('/', '').replace("'", '').replace('&', '').replace('`', '')),
-                            "name": metro_map[x][y]["station"]["name"],
-                            "lines": []
-                        }
-                        for station_line in metro_map[x][y]["station"].get("lines", []):
-                            if station_line in html_color_name_fragments:
-                                station_line = html_color_name_fragments[station_line]
-                            assert is_hex(station_line), "[VALIDATIONFAILED] 15 station_line {0} FAILED is_hex(): Station Rail line {0} is not a valid color.".format(station_line)
-                            assert len(station_line) == 6, "[VALIDATIONFAILED] 16 station_line {0} IS NOT 6 CHARACTERS: Station Rail line color {0} needs to be 6 characters long.".format(station_line)
-                            try:
-                                assert station_line in valid_lines, "[VALIDATIONFAILED] 17 station_line {0} NOT IN valid_lines: Station rail line color {0} is not defined; please create a rail line matching this color or remove it from all stations.".format(station_line)
-                            except AssertionError:
-                                # We can gracefully fail here by simply not adding that line to the station
-                                continue
-                            else:
-                                validated_metro_map[x][y]["station"]["lines"].append(station_line)
-                        if metro_map[x][y]["station"].get('transfer'):
-                           validated_metro_map[x][y]["station"]["transfer"] = 1
-
-                        try:
-                            station_orientation = int(metro_map[x][y]["station"].get('orientation', ALLOWED_ORIENTATIONS[0]))
-                        except Exception:
-                            station_orientation = ALLOWED_ORIENTATIONS[0]
-                        if station_orientation not in ALLOWED_ORIENTATIONS:
-                            station_orientation = ALLOWED_ORIENTATIONS[0]
-                        validated_metro_map[x][y]["station"]["orientation"] = station_orientation
-
-                        station_style = metro_map[x][y]["station"].get('style')
-                        if station_style and station_style in ALLOWED_STATION_STYLES:
-                            validated_metro_map[x][y]["station"]['style'] = station_style
+        if as_v3:
+            x_int = XY_INTS[x]
+        elif not validated_metro_map.get(x):
+            validated_metro_map[x] = {}
+        for y in cells.keys():
+            if y not in XY_INTS:
+                continue
+            cell = cells.get(y)
+            if not cell:
+                continue
+
+            line = cell["line"]
+            assert is_hex(line), "[VALIDATIONFAILED] 08 {0} at ({1}, {2}) FAILED is_hex(): Point at ({3}, {4}) is not a valid color: {0}.".format(line, x, y, XY_INTS[x] + 1, XY_INTS[y] + 1)
+            assert len(line) == 6, "[VALIDATIONFAILED] 09 {0} at ({1}, {2}) IS NOT 6 CHARACTERS: Point at ({3}, {4}) has a color that needs to be 6 characters long: {0}".format(line, x, y, XY_INTS[x] + 1, XY_INTS[y] + 1)
+            if line not in valid_lines:
+                # If the line isn't in valid_lines, we can just not add it
+                continue
+
+            if as_v3:
+                points_by_color.setdefault(line, {}).setdefault(line_width_style, {}).setdefault(x, {})[y] = 1
+                highest_xy_seen = max(highest_xy_seen, x_int, XY_INTS[y])
+            else:
+                validated_metro_map[x][y] = {"line": line}
+
+            map_station = cell.get('station')
+            if not map_station:
+                continue
+
+            assert type(map_station) == dict, "[VALIDATIONFAILED] 11 metro_map[x][y]['station'] at ({0}, {1}) IS NOT DICT: Point at ({2}, {3}) has a malformed station, must be an object.".format(x, y, XY_INTS[x] + 1, XY_INTS[y] + 1)
+            map_station["name"] = sanitize_string_without_html_entities(map_station["name"])
+            if map_station["name"] == '':
+                map_station["name"] = "_" # Gracefully rename a zero-length station name to be a single space
+            assert 1 <= len(map_station["name"]) < 256, "[VALIDATIONFAILED] 12 station name at ({0}, {1}) BAD SIZE {2} is {3}: Point at ({4}, {5}) has a station whose name is not between 1 and 255 characters long. Please rename it.".format(x, y, map_station["name"], len(map_station["name"]), XY_INTS[x] + 1, XY_INTS[y] + 1)
+            assert type(map_station.get("lines", [])) == list, "[VALIDATIONFAILED] 13 station lines at ({0}, {1}) NOT A LIST: Point at ({2}, {3}) has its station lines in the incorrect format; must be a list.".format(x, y, XY_INTS[x] + 1, XY_INTS[y] + 1)
+            # Okay, this probably *should* pass - but I think I have some bug in the javascript somewhere because https://metromapmaker.com/?map=zCq7R223 obviously passed validation but once reconstituted, fails. But this isn't a big enough deal that I can't wave this validation through while I figure out what's going on.
+            # assert len(map_station["lines"]) > 0, "[VALIDATIONFAILED] 14: station lines at ({0}, {1}) HAS ZERO LENGTH".format(x, y)
+            station = {
+                # "name": html_dom_id_safe(map_station["name"].replace('/', '').replace("'", '').replace('&', '').replace('`', '')),
+                "name": map_station["name"],
+                "lines": []
+            }
+            for station_line in map_station.get("lines", []):
+                if station_line in html_color_name_fragments:
+                    station_line = html_color_name_fragments[station_line]
+                assert is_hex(station_line), "[VALIDATIONFAILED] 15 station_line {0} FAILED is_hex(): Station Rail line {0} is not a valid color.".format(station_line)
+                assert len(station_line) == 6, "[VALIDATIONFAILED] 16 station_line {0} IS NOT 6 CHARACTERS: Station Rail line color {0} needs to be 6 characters long.".format(station_line)
+                if station_line in valid_lines:
+                    # Otherwise, we can gracefully fail here by simply not adding that line to the station
+                    station["lines"].append(station_line)
+            if map_station.get('transfer'):
+               station["transfer"] = 1
+
+            try:
+                station_orientation = int(map_station.get('orientation', ALLOWED_ORIENTATIONS[0]))
+            except Exception:
+                station_orientation = ALLOWED_ORIENTATIONS[0]
+            if station_orientation not in ALLOWED_ORIENTATIONS:
+                station_orientation = ALLOWED_ORIENTATIONS[0]
+            station["orientation"] = station_orientation
+
+            this_station_style = map_station.get('style')
+            if this_station_style and this_station_style in ALLOWED_STATION_STYLES:
+                station['style'] = this_station_style
+
+            if as_v3:
+                # As validate_metro_map_v3 would have it; v3 stations don't keep their lines
+                stations.setdefault(x, {})[y] = {
+                    key: station[key]
+                    for key in ('name', 'orientation', 'style', 'transfer')
+                    if key in station
+                }
+            else:
+                validated_metro_map[x][y]["station"] = station
+
+    if as_v3:
+        return {
+            'global': {
+                'data_version': 3,
+                'lines': validated_metro_map['global']['lines'],
+                'style': {
+                    'mapLineWidth': line_width,
+                    'mapLineStyle': 'solid',
+                    'mapStationStyle': station_style,
+                },
+                'map_size': get_map_size(highest_xy_seen),
+            },
+            'points_by_color': points_by_color,
+            'stations': stations,
+        }
 
     return validated_metro_map
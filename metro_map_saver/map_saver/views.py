@@ -1,7 +1,9 @@
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, PermissionDenied
+from django.core.files import File
+from django.db import IntegrityError, transaction
 from django.db.models import Count, F, Q
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
 from django.urls import reverse_lazy
@@ -11,11 +13,13 @@ from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.gzip import gzip_page
-from django.views.decorators.cache import cache_page, never_cache, cache_control
+from django.views.decorators.cache import never_cache, cache_control
 from django.conf import settings
 from django.views.generic.dates import (
     DayArchiveView,
@@ -38,13 +42,15 @@ from taggit.models import Tag
 
 from moderate.models import ActivityLog
 from citysuggester.models import TravelSystem
+from .content_encoding import compress, get_accepted_encoding
 from .forms import (
     CreateMapForm,
     IdentifyForm,
     RateForm,
     CustomListForm,
 )
-from .models import SavedMap, IdentifyMap, City
+from .mapdata_optimizer import get_mapdata_as_lines
+from .models import SavedMap, IdentifyMap, City, CompressedMapData, MapJob
 from .validator import (
     is_hex,
     validate_metro_map,
@@ -571,33 +577,109 @@ class MapDiffView(TemplateView):
 class MapDataView(TemplateView):
 
     """ Get: Given a hash URL, load a saved map
+            ?format=lines sends each color's lines and singletons
+            instead of every point (v2+ maps only; see get_mapdata_as_lines)
         Post: Save your map and generate a hash URL to facilitate sharing
     """
 
-    @method_decorator(cache_page(60 * 60 * 24 * 30))
-    @method_decorator(gzip_page)
+    # A map that hasn't changed since it was saved is content-addressed
+    #   (its urlhash is made from its data), so browsers and proxies can keep it for good
+    LOAD_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+    # Maps whose data was changed later (see SavedMap.set_data) could change again,
+    #   so these must be checked before they're used
+    EDITED_LOAD_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+
     def get(self, request, **kwargs):
         urlhash = kwargs.get('urlhash')
+        load_format = 'lines' if request.GET.get('format') == 'lines' else ''
+        encoding = get_accepted_encoding(request)
+
+        # Browsers and proxies cache these (see LOAD_CACHE_CONTROL),
+        #   and the stored compressed bodies cover the server side;
+        #   don't also keep a copy of every map in memcached (UpdateCacheMiddleware)
+        request._cache_update_cache = False
+
+        # urlhash isn't unique, so always load the earliest map with it;
+        #   only what's needed to answer a conditional request, for now
+        saved_map = SavedMap.objects.filter(urlhash=urlhash).order_by('id').only(
+            'pk', 'urlhash', 'data_hash', 'created_at', 'data_updated_at',
+        ).first()
+        if saved_map is None:
+            context = {'error': '[ERROR] The requested map does not exist ({0})'.format(urlhash)}
+            return render(request, 'MapDataView.html', context)
+
+        # Answered before the map data is loaded or compressed
+        etag, last_modified = self.get_validators(saved_map, load_format, encoding)
+        response = get_conditional_response(request, etag, last_modified, self.cache_headers(HttpResponse(), saved_map, etag))
+        if response.status_code == 304:
+            return response
+
+        # Once a response has been compressed, send it as-is from then on
+        if encoding:
+            body = CompressedMapData.objects.filter(
+                saved_map_id=saved_map.pk,
+                format=load_format,
+                encoding=encoding,
+            ).values_list('body', flat=True).first()
+            if body is not None:
+                return self.cache_headers(self.compressed_response(body, encoding), saved_map, etag)
+
+        # Maps with .packed_data never need to load .data (or .mapdata) at all
+        saved_map = SavedMap.objects.defer('data', 'thumbnail', 'stations').get(pk=saved_map.pk)
+
+        data = saved_map.get_data()
+        if data and load_format == 'lines':
+            mapdata = json.dumps(get_mapdata_as_lines(data))
+        elif data:
+            mapdata = json.dumps(data)
+        elif saved_map.mapdata:
+            mapdata = saved_map.mapdata
+        else:
+            mapdata = {}
+
+        response = render(request, 'MapDataView.html', {'saved_map': mapdata})
+        if encoding:
+            body = compress(response.content, encoding)
+            CompressedMapData.objects.get_or_create(
+                saved_map=saved_map,
+                format=load_format,
+                encoding=encoding,
+                defaults={'body': body},
+            )
+            response = self.compressed_response(body, encoding)
 
-        context = {}
+        return self.cache_headers(response, saved_map, etag)
 
-        try:
-            saved_map = SavedMap.objects.get(urlhash=urlhash)
-        except ObjectDoesNotExist:
-            context['error'] = '[ERROR] The requested map does not exist ({0})'.format(urlhash)
-        except MultipleObjectsReturned:
-            saved_map = SavedMap.objects.filter(urlhash=urlhash).earliest('id')
+    def get_validators(self, saved_map, load_format, encoding):
 
-        if not context.get('error'):
-            if saved_map.data:
-                mapdata = json.dumps(saved_map.data)
-            elif saved_map.mapdata:
-                mapdata = saved_map.mapdata
-            else:
-                mapdata = {}
-            context['saved_map'] = mapdata
+        """ Returns the ETag and Last-Modified (as a timestamp) for loading saved_map,
+                from what's stored on it rather than the map data itself:
+                an edited map gets a new one of each
+        """
 
-        return render(request, 'MapDataView.html', context)
+        modified = (saved_map.data_updated_at or saved_map.created_at).timestamp()
+        # Last-Modified is only to the second, so the ETag uses the full timestamp
+        version = f'{saved_map.data_hash or saved_map.urlhash}-{saved_map.pk}-{int(modified * 1000000)}'
+        etag = f'"{version}-{load_format or "points"}-{encoding or "identity"}"'
+        return etag, int(modified)
+
+    def cache_headers(self, response, saved_map, etag):
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date((saved_map.data_updated_at or saved_map.created_at).timestamp())
+        if saved_map.data_updated_at:
+            response['Cache-Control'] = self.EDITED_LOAD_CACHE_CONTROL
+        else:
+            response['Cache-Control'] = self.LOAD_CACHE_CONTROL
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def compressed_response(self, body, encoding):
+        body = bytes(body)
+        response = HttpResponse(body, content_type='text/html; charset=utf-8')
+        response['Content-Encoding'] = encoding
+        response['Content-Length'] = str(len(body))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
 
     # @method_decorator(csrf_exempt) # Break glass in case of CSRF failure
     @method_decorator(never_cache)
@@ -608,37 +690,34 @@ class MapDataView(TemplateView):
 
         form = CreateMapForm({'mapdata': mapdata})
         if form.is_valid():
-            mapdata = form.cleaned_data['mapdata']
             urlhash = form.cleaned_data['urlhash']
             naming_token = form.cleaned_data['naming_token']
-            data_version = form.cleaned_data['data_version']
-            try:
-                # Doesn't override the saved map if it already exists.
-                saved_map = SavedMap.objects.only('urlhash').get(urlhash=urlhash)
-                context['saved_map'] = f'{urlhash},'
-            except ObjectDoesNotExist:
-                stations = SavedMap.get_stations(mapdata, data_version)
-                map_details = {
-                    'urlhash': urlhash,
-                    'naming_token': naming_token,
-                    'station_count': len(stations),
-                    'stations': ','.join(stations),
-                    'map_size': mapdata.get('global', {}).get('map_size', -1) or -1,
-                }
-                if data_version >= 2:
-                    map_details['data'] = mapdata
-                else:
-                    map_details['mapdata'] = json.dumps(mapdata)
+            map_details = SavedMap.get_map_details(form.cleaned_data)
 
-                from citysuggester.utils import MINIMUM_STATION_OVERLAP
-                if len(stations) < MINIMUM_STATION_OVERLAP:
-                    # Don't need to check these ever
-                    map_details['suggested_city_overlap'] = -2
+            # Maps saved before .data_hash was added only have their old urlhash
+            #   until oneoff_backfill_data_hash has been run
+            legacy = SavedMap.get_legacy_urlhashes([form.cleaned_data['legacy_urlhash']])
+            if legacy:
+                context['saved_map'] = f'{legacy.pop()},'
+                return render(request, 'MapDataView.html', context)
 
-                saved_map = SavedMap.objects.create(**map_details)
+            # Insert it, and let the unique data_hash catch maps that were already saved
+            #   (even by another request at the same time), rather than checking first
+            try:
+                with transaction.atomic():
+                    saved_map = SavedMap.objects.create(**map_details)
+            except IntegrityError:
+                # Doesn't override the saved map if it already exists;
+                #   but anything else that failed isn't a duplicate
+                existing = SavedMap.objects.filter(data_hash=map_details['data_hash']).values_list('urlhash', flat=True).first()
+                if existing is None:
+                    raise
+                context['saved_map'] = f'{existing},'
+            else:
+                saved_map.try_write_data_files()
+                # Images and the suggested city are filled in by run_jobs
+                MapJob.enqueue(saved_map)
                 context['saved_map'] = f'{urlhash},{naming_token}'
-            except MultipleObjectsReturned:
-                context['saved_map'] = f'{urlhash},'
         else:
             # Anything that appears before the first colon will be internal-only;
             #   everything else is user-facing.
@@ -678,6 +757,27 @@ class AdminHomeView(TemplateView):
         return context
 
 
+class MapImportView(TemplateView):
+
+    """ Import many maps at once: POST newline-delimited JSON,
+            one map per line, just as it would be sent to /save/.
+
+        The import is queued up as a MapJob, and done by run_jobs;
+            its summary is in run_jobs' output.
+
+        See also: the import_maps command, for imports too large for one request
+    """
+
+    @method_decorator(staff_member_required)
+    def post(self, request, **kwargs):
+        # Written to the file a chunk at a time as the body is read, rather than all held in memory
+        job = MapJob.objects.create(
+            task=MapJob.IMPORT,
+            import_file=File(request, name='import.ndjson'),
+        )
+        return HttpResponse(f'Queued {job} (job #{job.pk}); run_jobs will import it.', content_type='text/plain', status=202)
+
+
 class MapsByDateView(TemplateView):
 
     def grouping(self, date, group_by):
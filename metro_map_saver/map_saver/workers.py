@@ -0,0 +1,31 @@
+""" Spreading work across several processes (see make_images and import_maps --workers)
+"""
+
+from django.db import connections
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+
+def close_db_connections():
+
+    """ Each worker process must open its own database connection,
+            not share the one it inherited from the parent
+    """
+
+    connections.close_all()
+
+
+def get_worker_pool(workers):
+
+    """ Returns a pool of this many forked worker processes,
+            each with its own database connection
+    """
+
+    # Forked workers would otherwise inherit (and share) this process's connections
+    close_db_connections()
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('fork'),
+        initializer=close_db_connections,
+    )
@@ -128,17 +128,31 @@ DATABASES = {
     }
 }
 
+MEMCACHED_LOCATION = 'unix:/home/sturner/apps/metromapmaker/memcached.sock'
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
-        'LOCATION': 'unix:/home/sturner/apps/metromapmaker/memcached.sock',
+        'LOCATION': MEMCACHED_LOCATION,
         "TIMEOUT": 60 * 15,
-    }
+    },
+    # The lines found for each color of a map (see find_lines_cached).
+    # Point SHAPES_CACHE_LOCATION at a memcached of its own
+    #   so a make_images backfill can't push everything else out of 'default'
+    'shapes': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': os.environ.get('SHAPES_CACHE_LOCATION', MEMCACHED_LOCATION),
+        'KEY_PREFIX': 'shapes',
+    },
 }
 
 CACHE_MIDDLEWARE_SECONDS = 60 * 60 * 24 # 1 day, can override per-view
 CACHE_MIDDLEWARE_KEY_PREFIX = 'metromapmaker'
 
+# How long to cache the lines found for each color of a map in the 'shapes' cache (see find_lines_cached);
+#   0 to not cache them (and not need the 'shapes' cache at all)
+SHAPES_CACHE_TIMEOUT = 60 * 60 * 24 * 7 # 1 week
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -179,6 +193,38 @@ STATIC_URL = '/static/'
 MEDIA_ROOT = '/home/sturner/apps/static_metromapmaker/media/'
 MEDIA_URL = 'media/'
 
+# Write each saved map's data to MEDIA_ROOT/data/<thousand>/<urlhash>.json (and .json.gz)
+#   so it can be served as a static file; /load/<urlhash> serves it either way
+WRITE_MAP_DATA_FILES = True
+
 PNG_CONVERSION_APP_PATH = '/home/sturner/src/squashfs-root/AppRun'
 PNG_CONVERSION_ARGS = ['-w', '1600', '-h', '1600', '--export-filename']
 PNG_CONVERSION_ARGS_THUMBNAIL = ['-w', '160', '-h', '160', '--export-filename']
+
+# How PNGs are drawn from the SVGs (see map_saver/rasterizer.py):
+#   'inkscape-shell' keeps one PNG_CONVERSION_APP_PATH --shell running per process,
+#   'subprocess' launches PNG_CONVERSION_APP_PATH once per PNG,
+#   'cairosvg' draws them in-process (pip install cairosvg);
+#   if PNG_CONVERSION_APP_PATH isn't installed, cairosvg is used if it's available
+PNG_RASTERIZER = 'inkscape-shell'
+# How many seconds 'inkscape-shell' gets to draw one PNG before it's killed (and restarted for the next one)
+PNG_CONVERSION_TIMEOUT = 120
+
+# Save maps posted in the legacy v1 format as v3 (validated and converted in one pass),
+#   rather than as v1 maps that oneoff_convert_v1_to_v2 would need to convert later
+CONVERT_V1_MAPS_ON_SAVE = True
+
+# Django's default (2.5 MB) would turn away the largest maps /save/ accepts before they're read;
+#   must be at least map_saver.validator.MAX_SAVE_REQUEST_BYTES.
+#   Checked against the Content-Length, so anything bigger is still never read.
+DATA_UPLOAD_MAX_MEMORY_SIZE = 44 * 1024 * 1024
+
+# Maps saved before SavedMap.data_hash was added have urlhashes made a different way;
+#   look those up too when a map is saved, so it isn't stored twice.
+#   Set to False once oneoff_backfill_data_hash has been run.
+LEGACY_URLHASH_LOOKUP = True
+
+# How SVGs for data_version >= 3 (and all stations) are drawn:
+#   'python' (faster, streamed) or 'template' (SVG_TEMPLATE_V3, STATIONS_SVG_TEMPLATE);
+#   both draw identical SVGs
+SVG_RENDERER = 'python'
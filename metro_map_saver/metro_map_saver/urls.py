@@ -66,6 +66,9 @@ urlpatterns = [
     # Admin HQ
     path('admin/home/', never_cache(map_saver.views.AdminHomeView.as_view()), name='admin_home'),
 
+    # Admin: Import many maps at once
+    path('admin/import/', never_cache(map_saver.views.MapImportView.as_view()), name='admin_import'),
+
     # Admin Gallery
     re_path(r'admin/gallery/(?P<tag>[\w\-\_^\d]+)?/?$', never_cache(map_saver.views.MapGalleryView.as_view()), name='admin_gallery'),
 